@@ -5,21 +5,45 @@
 
 var timer;
 
+// Previews are rendered here with MarkdownPreview (markdown_preview.js) when it can match the
+// server's output, otherwise, or while it loads, they are asked to /_preview.
+var LOCAL_PREVIEW_DELAY = 300;
+var SERVER_PREVIEW_DELAY = 2000;
+
+var showPreview = function(destId, html) {
+    MathJax.InputJax.TeX.resetEquationNumbers();
+    document.getElementById(destId).innerHTML = html;
+    MathJax.Hub.Queue(["Typeset", MathJax.Hub, destId]);
+};
+
+var serverPreview = function(sourceId, destId, wiki_p_id) {
+    inputText = document.getElementById(sourceId).value;
+    $.post("/_preview",
+	   {content : inputText,
+	    wiki_p_id : wiki_p_id},
+	   function (data, textStatus) {
+	       showPreview(destId, data);
+	   });
+};
+
 var Preview = function(sourceId, destId, wiki_p_id) {
     clearTimeout(timer);
-    timer=setTimeout(function () 
-		     {
-			 MathJax.InputJax.TeX.resetEquationNumbers();
-			 inputText = document.getElementById(sourceId).value;
-			 $.post("/_preview",
-				{content : inputText,
-				 wiki_p_id : wiki_p_id},
-				function (data, textStatus) {
-				    document.getElementById(destId).innerHTML = data;
-				    MathJax.Hub.Queue(["Typeset", MathJax.Hub, destId]);
-				});
-		     },
-		     2000);
+    if (typeof MarkdownPreview == "undefined") {
+	timer = setTimeout(function () { serverPreview(sourceId, destId, wiki_p_id); }, SERVER_PREVIEW_DELAY);
+	return;
+    }
+    MarkdownPreview.load();
+    timer = setTimeout(function ()
+		       {
+			   var html = MarkdownPreview.render(document.getElementById(sourceId).value, wiki_p_id);
+			   if (html !== null) {
+			       showPreview(destId, html);
+			       return;
+			   }
+			   timer = setTimeout(function () { serverPreview(sourceId, destId, wiki_p_id); },
+					      SERVER_PREVIEW_DELAY - LOCAL_PREVIEW_DELAY);
+		       },
+		       LOCAL_PREVIEW_DELAY);
 };
 
 
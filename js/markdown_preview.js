@@ -0,0 +1,1429 @@
+//
+// markdown_preview.js  -- Renders the markdown previews in the browser
+//
+// A port of the parts of Python-Markdown 2.2.1 (lib/markdown) that filters.render_md uses: the same
+// extensions ('extra', 'toc(title=Contents)', 'nl2br', 'mathjax', 'tables', 'codehilite'), doi links,
+// [[wikilinks]] and the sanitizer policy, which is fetched once from /_preview. It follows the Python
+// code closely, quirks included, so that both give the same html.
+//
+// render() returns null whenever its output could differ from the server's: raw html (other than the
+// wikilinks and entities), anything the server would pass through bleach, line numbered code blocks
+// or a browser without the regular expression features needed. The preview then falls back to
+// /_preview, which also stays the only renderer for what gets saved. Code blocks are not highlighted
+// (there is no pygments here), they get the same markup without the token spans.
+
+var MarkdownPreview = (function () {
+
+    var STX = "\u0002", ETX = "\u0003";
+    var INLINE_PLACEHOLDER_PREFIX = STX + "klzzwxh:";
+    var AMP_SUBSTITUTE = STX + "amp" + ETX;
+    var ESCAPED_CHARS = "\\`*_{}[]()>#+-.!";
+    var TAB = "    ";
+    var TOC_TITLE = "Contents", TOC_MARKER = "[TOC]";
+    var FN_PLACE_MARKER = "///Footnotes Go Here///";
+    var FN_BACKLINK_TEXT = "zz1337820767766393qq", NBSP_PLACEHOLDER = "qq3936677670287331zz";
+    var HTML_EMPTY = ["area", "base", "basefont", "br", "col", "frame", "hr", "img", "input", "isindex", "link", "metaparam"];
+    var MAIL_ENTITIES = {34 : "quot", 38 : "amp", 60 : "lt", 62 : "gt"};
+    var DOI_RE = /(doi|Doi|DOI):[^ \t\n\r\f\v]+/g;
+    var WIKILINKS_RE = /\[\[([^\|\]]+\|)?([^\]]+)\]\]/g;
+    var ENTITY_ONLY_RE = /^&[#a-zA-Z0-9]*;$/;
+    var BLOCK_LEVEL_RE = /^(p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math|hr|hr\/|style|li|dt|dd|thead|tbody|tr|th|td|section|footer|header|group|figure|figcaption|aside|article|canvas|output|progress|video)\n?$/i;
+
+    var RE = null;            // Regular expressions that need lookbehind, unicode classes or sticky matching
+    var policy = null;        // Sanitizer policy, see filters.sanitizer_policy
+    var policyRequested = false;
+
+    function Unsupported(reason) { this.reason = reason; }
+    function OutOfOrder() {}
+
+    ////////////////////
+    //   Helpers      //
+    ////////////////////
+
+    function has(obj, key) { return Object.prototype.hasOwnProperty.call(obj, key); }
+    function repeat(s, n) { return new Array(n + 1).join(s); }
+    function strip(s) { return s.replace(/^\s+|\s+$/g, ""); }
+    function lstrip(s) { return s.replace(/^\s+/, ""); }
+    function rstrip(s) { return s.replace(/\s+$/, ""); }
+    function replaceAll(s, a, b) { return s.split(a).join(b); }
+    function startsWith(s, prefix) { return s.slice(0, prefix.length) == prefix; }
+    function contains(list, x) { return list.indexOf(x) != -1; }
+    function pad4(n) { n = String(n); return n.length < 4 ? repeat("0", 4 - n.length) + n : n; }
+    function end(m) { return m.index + m[0].length; }
+
+    // Python-Markdown's AtomicString: text that inline patterns must leave alone. Concatenating
+    // one gives back a plain string, as in Python.
+    function atomic(s) { return s ? new String(s) : ""; }
+    function isAtomic(s) { return s instanceof String; }
+    function isString(s) { return typeof s == "string"; }
+
+    function isBlockLevel(tag) { return BLOCK_LEVEL_RE.test(tag); }
+
+    function expandTabs(s) {
+        var out = [], col = 0, c, i;
+        for (i = 0; i < s.length; i++) {
+            c = s.charAt(i);
+            if (c == "\t") {
+                out.push(repeat(" ", 4 - col % 4));
+                col += 4 - col % 4;
+            } else {
+                out.push(c);
+                col = (c == "\n" || c == "\r") ? 0 : col + 1;
+            }
+        }
+        return out.join("");
+    }
+
+    function escapeHtml(s) {
+        return s.replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;");
+    }
+
+    // Elements follow ElementTree's model, text and tail included. Python's "if element" is only
+    // true for elements with children, some of the processors rely on that.
+    function Element(tag) {
+        this.tag = tag;
+        this.attrib = {};
+        this.text = null;
+        this.tail = null;
+        this.children = [];
+    }
+    Element.prototype.last = function () { return this.children[this.children.length - 1]; };
+    Element.prototype.insert = function (i, el) { this.children.splice(i, 0, el); };
+    Element.prototype.remove = function (el) { this.children.splice(this.children.indexOf(el), 1); };
+    Element.prototype.set = function (name, value) { this.attrib[name] = String(value); };
+    Element.prototype.get = function (name) { return has(this.attrib, name) ? this.attrib[name] : null; };
+
+    function subElement(parent, tag) {
+        var el = new Element(tag);
+        parent.children.push(el);
+        return el;
+    }
+    function truthy(el) { return !!el && el.children.length > 0; }
+    function lastChild(parent) { return parent.children.length ? parent.last() : null; }
+
+    function iter(el, tag, out) {
+        out = out || [];
+        if (!tag || el.tag == tag) out.push(el);
+        for (var i = 0; i < el.children.length; i++) iter(el.children[i], tag, out);
+        return out;
+    }
+
+    function itertext(el, out) {
+        out = out || [];
+        if (el.text) out.push(String(el.text));
+        for (var i = 0; i < el.children.length; i++) {
+            itertext(el.children[i], out);
+            if (el.children[i].tail) out.push(String(el.children[i].tail));
+        }
+        return out;
+    }
+
+    // serializers.to_xhtml_string
+    function serialize(el, out) {
+        var names = Object.keys(el.attrib).sort(), i, tag = el.tag;
+        out.push("<" + tag);
+        for (i = 0; i < names.length; i++)
+            out.push(" " + names[i] + "=\"" + escapeHtml(el.attrib[names[i]]).replace(/"/g, "&quot;") + "\"");
+        if (contains(HTML_EMPTY, tag)) {
+            out.push(" />");
+        } else {
+            out.push(">");
+            if (el.text) out.push(tag == "script" || tag == "style" ? String(el.text) : escapeHtml(String(el.text)));
+            for (i = 0; i < el.children.length; i++) serialize(el.children[i], out);
+            out.push("</" + tag + ">");
+        }
+        if (el.tail) out.push(escapeHtml(String(el.tail)));
+        return out;
+    }
+    function toString(el) { return serialize(el, []).join(""); }
+
+    // Each inline pattern is matched as "^(.*?)<pattern>(.*?)$" against the whole text, with Python's
+    // "$" (which also matches before a final newline).
+    function compile() {
+        var W = "[\\p{L}\\p{N}_]";
+        var NOBRACKET = "[^\\]\\[]*";
+        var BRK = "\\[(" + repeat(NOBRACKET + "(\\[", 6) + repeat(NOBRACKET + "\\])*", 6) + NOBRACKET + ")\\]";
+        var NOIMG = "(?<!!)";
+        var inline = function (pattern) { return new RegExp("^([\\s\\S]*?)" + pattern + "([\\s\\S]*?)(?=\\n?$)", "su"); };
+        RE = {
+            wordBoundary : "(?:(?<=" + W + ")(?!" + W + ")|(?<!" + W + ")(?=" + W + "))",
+            inline : inline,
+            backtick : inline("(?<!\\\\)(`+)(.+?)(?<!`)\\2(?!`)"),
+            mathjax : inline("(?<!\\\\)(\\$\\$?)(.+?)\\2"),
+            escape : inline("\\\\(.)"),
+            footnote : inline("\\[\\^([^\\]]*)\\]"),
+            reference : inline(NOIMG + BRK + "\\s?\\[([^\\]]*)\\]"),
+            link : inline(NOIMG + BRK + "\\(\\s*(<.*?>|((?:(?:\\(.*?\\))|[^\\(\\)]))*?)\\s*((['\"])(.*?)\\12\\s*)?\\)"),
+            imageLink : inline("!" + BRK + "\\s*\\((<.*?>|([^\\)]*))\\)"),
+            imageReference : inline("!" + BRK + "\\s?\\[([^\\]]*)\\]"),
+            shortReference : inline(NOIMG + "\\[([^\\]]+)\\]"),
+            autolink : inline("<((?:[Ff]|[Hh][Tt])[Tt][Pp][Ss]?://[^>]*)>"),
+            automail : inline("<([^> !]*@[^> ]*)>"),
+            linebreak : inline("  \\n"),
+            html : inline("(<([a-zA-Z/][^>]*?|!--.*?--)>)"),
+            entity : inline("(&[#a-zA-Z0-9]*;)"),
+            notStrong : inline("((^| )(\\*|_)( |(?=\\n?$)))"),
+            strongEm : inline("(\\*{3}|_{3})(.+?)\\2"),
+            strong : inline("(\\*{2})(.+?)\\2"),
+            emphasis : inline("(\\*)([^\\*]+)\\2"),
+            emphasis2 : inline("(?<!" + W + ")(_)(?!_)(.+?)(?<!_)\\2(?!" + W + ")"),
+            strong2 : inline("(?<!" + W + ")(_{2})(?!_)(.+?)(?<!_)\\2(?!" + W + ")"),
+            nl : inline("\\n"),
+            fencedBlock : new RegExp("(^(?:~{3,}|`{3,}))[ ]*(\\{?\\.?([a-zA-Z0-9_+-]*)\\}?)?[ ]*\\n([\\s\\S]*?)(?<=\\n)\\1[ ]*$", "m"),
+            attrs : new RegExp("([^ ]+=\".*?\")|([^ ]+='.*?')|([^ ]+=[^ ]*)|([^ ]+)|( )", "y")
+        };
+    }
+
+    /////////////////////////
+    //   Preprocessors     //
+    /////////////////////////
+
+    var SHEBANG_RE = /(?:^::+|(^#!))((?:\/\w+)*[\/ ])?([\w+-]*)/;
+
+    // codehilite.CodeHilite.hilite, minus the highlighting
+    function hilite(src, lang) {
+        var lines, fl, m;
+        src = src.replace(/^\n+|\n+$/g, "");
+        if (lang === null) {
+            lines = src.split("\n");
+            fl = lines.shift();
+            m = SHEBANG_RE.exec(fl);
+            if (m) {
+                if (m[2]) lines.unshift(fl);
+                if (m[1]) throw new Unsupported("line numbers");
+            } else {
+                lines.unshift(fl);
+            }
+            src = lines.join("\n").replace(/^\n+|\n+$/g, "");
+        }
+        src = escapeHtml(src).replace(/"/g, "&quot;").replace(/'/g, "&#39;");
+        return "<div class=\"codehilite\"><pre>" + src + "\n</pre></div>\n";
+    }
+
+    function fencedCode(md, lines) {
+        var text = lines.join("\n"), m, placeholder;
+        while ((m = RE.fencedBlock.exec(text))) {
+            placeholder = md.store(hilite(m[4], m[3] || null), true);
+            text = text.slice(0, m.index) + "\n" + placeholder + "\n" + text.slice(end(m));
+        }
+        return text.split("\n");
+    }
+
+    // HtmlBlockPreprocessor. Html blocks are left to the server, this only keeps the way it splits
+    // and joins the text (which drops some blank lines).
+    function htmlBlock(md, lines) {
+        var text = lines.join("\n").split("\n\n"), newBlocks = [], block, m, tag;
+        while (text.length) {
+            block = text.shift();
+            if (startsWith(block, "\n")) block = block.slice(1);
+            if (startsWith(block, "\n")) block = block.slice(1);
+            if (startsWith(block, "<") && strip(block).length > 1) {
+                m = /^<([^> ]+)/.exec(block);
+                tag = m ? m[1] : block.slice(1).split(">")[0].toLowerCase();
+                if (isBlockLevel(tag) || "!?@%".indexOf(block.charAt(1)) != -1)
+                    throw new Unsupported("html block");
+            }
+            newBlocks.push(block);
+        }
+        return newBlocks.join("\n\n").split("\n");
+    }
+
+    var FN_DEF_RE = /^[ ]{0,3}\[\^([^\]]*)\]:[ \t\n\r\f\v]*(.*)/;
+    var TABBED_RE = /^((\t)|(    ))(.*)/;
+
+    function detectTabbed(lines) {
+        var items = [], blankLine = false, i = 0, k, j, nextLine, line, detabbed, found;
+        var detab = function (line) { var m = TABBED_RE.exec(line); return m ? m[4] : null; };
+        for (k = 0; k < lines.length; k++) {
+            line = lines[k];
+            if (strip(line)) {
+                detabbed = detab(line);
+                if (detabbed) {
+                    items.push(detabbed);
+                    i += 1;
+                    continue;
+                } else if (!blankLine && !FN_DEF_RE.test(line)) {
+                    items.push(line);
+                    i += 1;
+                    continue;
+                }
+                return [items, i + 1];
+            }
+            blankLine = true;
+            i += 1;
+            found = false;
+            for (j = i; j < lines.length; j++) {
+                if (strip(lines[j])) { nextLine = lines[j]; found = true; break; }
+            }
+            if (!found) return [items, i];
+            if (!detab(nextLine)) return [items, i];
+            items.push("");
+        }
+        return [items, i + 1];
+    }
+
+    function footnoteDefinitions(md, lines) {
+        var newlines = [], i = 0, m, r;
+        while (true) {
+            m = FN_DEF_RE.exec(lines[i]);
+            if (m) {
+                r = detectTabbed(lines.slice(i + 1));
+                r[0].unshift(m[2]);
+                i += r[1] - 1;
+                md.setFootnote(m[1], r[0].join("\n"));
+            } else {
+                newlines.push(lines[i]);
+            }
+            if (lines.length > i + 1) i += 1;
+            else break;
+        }
+        return newlines;
+    }
+
+    var ABBR_REF_RE = /^[*]\[([^\]]*)\][ ]?:[ \t\n\r\f\v]*(.*)/;
+
+    function abbreviations(md, lines) {
+        var newText = [], i, m, abbr, title, chars;
+        for (i = 0; i < lines.length; i++) {
+            m = ABBR_REF_RE.exec(lines[i]);
+            if (!m) {
+                newText.push(lines[i]);
+                continue;
+            }
+            abbr = strip(m[1]);
+            title = strip(m[2]);
+            if (!abbr || /[\\\]\[\^-]/.test(abbr)) throw new Unsupported("abbreviation");
+            chars = abbr.replace(/[.*+?$(){}|\/]/g, "\\$&");
+            md.addAbbreviation(abbr, RE.inline("(" + RE.wordBoundary + chars + RE.wordBoundary + ")"), title);
+        }
+        return newText;
+    }
+
+    var REFERENCE_TITLE = "[ ]*(\"(.*)\"|'(.*)'|\\((.*)\\))[ ]*";
+    var REFERENCE_RE = new RegExp("^[ ]{0,3}\\[([^\\]]*)\\]:[ \\t\\n\\r\\f\\v]*([^ ]*)[ ]*(" + REFERENCE_TITLE + ")?\\n?$");
+    var REFERENCE_TITLE_RE = new RegExp("^" + REFERENCE_TITLE + "\\n?$");
+
+    function references(md, lines) {
+        var newText = [], line, m, id, link, t, tm;
+        while (lines.length) {
+            line = lines.shift();
+            m = REFERENCE_RE.exec(line);
+            if (m) {
+                id = strip(m[1]).toLowerCase();
+                link = m[2].replace(/^<+/, "").replace(/>+$/, "");
+                t = m[5] || m[6] || m[7];
+                if (!t) {
+                    if (!lines.length) throw new Unsupported("reference");
+                    tm = REFERENCE_TITLE_RE.exec(lines[0]);
+                    if (tm) {
+                        lines.shift();
+                        t = tm[2] || tm[3] || tm[4];
+                    }
+                }
+                md.references[id] = [link, t || null];
+            } else {
+                newText.push(line);
+            }
+        }
+        return newText;
+    }
+
+    //////////////////////////
+    //   Block processors   //
+    //////////////////////////
+
+    function detab(text) {
+        var newtext = [], lines = text.split("\n"), i;
+        for (i = 0; i < lines.length; i++) {
+            if (startsWith(lines[i], TAB)) newtext.push(lines[i].slice(4));
+            else if (!strip(lines[i])) newtext.push("");
+            else break;
+        }
+        return [newtext.join("\n"), lines.slice(newtext.length).join("\n")];
+    }
+
+    function looseDetab(text, level) {
+        var lines = text.split("\n"), i, indent = repeat(TAB, level);
+        for (i = 0; i < lines.length; i++)
+            if (startsWith(lines[i], indent)) lines[i] = lines[i].slice(indent.length);
+        return lines.join("\n");
+    }
+
+    function listIndentProcessor(parser, itemTypes, listTypes) {
+        var getLevel = function (parent, block) {
+            var m = /^(([ ]{4})+)/.exec(block), indentLevel = m ? m[1].length / 4 : 0;
+            var level = parser.isstate("list") ? 1 : 0, child;
+            while (indentLevel > level) {
+                child = lastChild(parent);
+                if (truthy(child) && (contains(listTypes, child.tag) || contains(itemTypes, child.tag))) {
+                    if (contains(listTypes, child.tag)) level += 1;
+                    parent = child;
+                } else {
+                    break;
+                }
+            }
+            return [level, parent];
+        };
+        return {
+            test : function (parent, block) {
+                return startsWith(block, TAB) && !parser.isstate("detabbed") &&
+                    (contains(itemTypes, parent.tag) ||
+                     (parent.children.length > 0 && truthy(parent.last()) && contains(listTypes, parent.last().tag)));
+            },
+            run : function (parent, blocks) {
+                var block = blocks.shift(), r = getLevel(parent, block), sibling = r[1], item, p, li;
+                block = looseDetab(block, r[0]);
+                parser.state.push("detabbed");
+                if (contains(itemTypes, parent.tag)) {
+                    if (parent.children.length && contains(listTypes, parent.last().tag))
+                        parser.parseBlocks(parent.last(), [block]);
+                    else
+                        parser.parseBlocks(parent, [block]);
+                } else if (contains(itemTypes, sibling.tag)) {
+                    parser.parseBlocks(sibling, [block]);
+                } else if (sibling.children.length && contains(itemTypes, sibling.last().tag)) {
+                    item = sibling.last();
+                    if (item.text) {
+                        p = new Element("p");
+                        p.text = item.text;
+                        item.text = "";
+                        item.insert(0, p);
+                    }
+                    parser.parseChunk(item, block);
+                } else {
+                    // def_list's DefListIndentProcessor.create_item fails on the server
+                    if (itemTypes[0] != "li") throw new Unsupported("definition list");
+                    li = subElement(sibling, "li");
+                    parser.parseBlocks(li, [block]);
+                }
+                parser.state.pop();
+            }
+        };
+    }
+
+    function codeProcessor() {
+        return {
+            test : function (parent, block) { return startsWith(block, TAB); },
+            run : function (parent, blocks) {
+                var sibling = lastChild(parent), block = blocks.shift(), r, code, pre;
+                if (truthy(sibling) && sibling.tag == "pre" && sibling.children.length && sibling.children[0].tag == "code") {
+                    code = sibling.children[0];
+                    r = detab(block);
+                    code.text = atomic(code.text + "\n" + rstrip(r[0]) + "\n");
+                } else {
+                    pre = subElement(parent, "pre");
+                    code = subElement(pre, "code");
+                    r = detab(block);
+                    code.text = atomic(rstrip(r[0]) + "\n");
+                }
+                if (r[1]) blocks.unshift(r[1]);
+            }
+        };
+    }
+
+    function splitRow(row, border) {
+        if (border) {
+            if (startsWith(row, "|")) row = row.slice(1);
+            if (row.slice(-1) == "|") row = row.slice(0, -1);
+        }
+        return row.split("|");
+    }
+
+    function buildRow(row, parent, align, border) {
+        var tr = subElement(parent, "tr"), tag = parent.tag == "thead" ? "th" : "td";
+        var cells = splitRow(row, border), i, c;
+        for (i = 0; i < align.length; i++) {
+            c = subElement(tr, tag);
+            c.text = i < cells.length ? strip(cells[i]) : "";
+            if (align[i]) c.set("align", align[i]);
+        }
+    }
+
+    function tableProcessor() {
+        return {
+            test : function (parent, block) {
+                var rows = block.split("\n");
+                return rows.length > 2 && rows[0].indexOf("|") != -1 && rows[1].indexOf("|") != -1 &&
+                    rows[1].indexOf("-") != -1 && "|:-".indexOf(strip(rows[1]).charAt(0)) != -1;
+            },
+            run : function (parent, blocks) {
+                var block = blocks.shift().split("\n"), header = strip(block[0]), seperator = strip(block[1]);
+                var border = startsWith(header, "|"), align = [], cells = splitRow(seperator, border);
+                var i, c, table, thead, tbody;
+                for (i = 0; i < cells.length; i++) {
+                    c = cells[i];
+                    if (startsWith(c, ":") && c.slice(-1) == ":") align.push("center");
+                    else if (startsWith(c, ":")) align.push("left");
+                    else if (c.slice(-1) == ":") align.push("right");
+                    else align.push(null);
+                }
+                table = subElement(parent, "table");
+                thead = subElement(table, "thead");
+                buildRow(header, thead, align, border);
+                tbody = subElement(table, "tbody");
+                for (i = 2; i < block.length; i++) buildRow(strip(block[i]), tbody, align, border);
+            }
+        };
+    }
+
+    function hashHeaderProcessor(parser) {
+        var HEADER_RE = /(^|\n)(#{1,6})(.*?)#*(\n|$)/;
+        return {
+            test : function (parent, block) { return HEADER_RE.test(block); },
+            run : function (parent, blocks) {
+                var block = blocks.shift(), m = HEADER_RE.exec(block);
+                var before = block.slice(0, m.index), after = block.slice(end(m)), h;
+                if (before) parser.parseBlocks(parent, [before]);
+                h = subElement(parent, "h" + m[2].length);
+                h.text = strip(m[3]);
+                if (after) blocks.unshift(after);
+            }
+        };
+    }
+
+    function setextHeaderProcessor() {
+        var SETEXT_RE = /^.*?\n[=-]+[ ]*(\n|$)/;
+        return {
+            test : function (parent, block) { return SETEXT_RE.test(block); },
+            run : function (parent, blocks) {
+                var lines = blocks.shift().split("\n"), h;
+                h = subElement(parent, startsWith(lines[1], "=") ? "h1" : "h2");
+                h.text = strip(lines[0]);
+                if (lines.length > 2) blocks.unshift(lines.slice(2).join("\n"));
+            }
+        };
+    }
+
+    function hrProcessor(parser) {
+        var HR_RE = /^[ ]{0,3}((-+[ ]{0,2}){3,}|(_+[ ]{0,2}){3,}|(\*+[ ]{0,2}){3,})[ ]*/m, match;
+        return {
+            test : function (parent, block) {
+                var m = HR_RE.exec(block);
+                if (m && (end(m) == block.length || block.charAt(end(m)) == "\n")) {
+                    match = m;
+                    return true;
+                }
+                return false;
+            },
+            run : function (parent, blocks) {
+                var block = blocks.shift(), prelines = block.slice(0, match.index).replace(/\n+$/, "");
+                var postlines = block.slice(end(match)).replace(/^\n+/, "");
+                if (prelines) parser.parseBlocks(parent, [prelines]);
+                subElement(parent, "hr");
+                if (postlines) blocks.unshift(postlines);
+            }
+        };
+    }
+
+    function listProcessor(parser, tag, itemRe) {
+        var CHILD_RE = /^[ ]{0,3}((\d+\.)|[*+-])[ ]+(.*)/, INDENT_RE = /^[ ]{4,7}((\d+\.)|[*+-])[ ]+.*/;
+        var getItems = function (block) {
+            var items = [], lines = block.split("\n"), i, m;
+            for (i = 0; i < lines.length; i++) {
+                m = CHILD_RE.exec(lines[i]);
+                if (m) {
+                    items.push(m[3]);
+                } else if (INDENT_RE.test(lines[i])) {
+                    if (!items.length) throw new Unsupported("list");
+                    if (startsWith(items[items.length - 1], TAB)) items[items.length - 1] += "\n" + lines[i];
+                    else items.push(lines[i]);
+                } else {
+                    if (!items.length) throw new Unsupported("list");
+                    items[items.length - 1] += "\n" + lines[i];
+                }
+            }
+            return items;
+        };
+        return {
+            test : function (parent, block) { return itemRe.test(block); },
+            run : function (parent, blocks) {
+                var items = getItems(blocks.shift()), sibling = lastChild(parent), lst, item, lch, p, li, i;
+                if (truthy(sibling) && (sibling.tag == "ol" || sibling.tag == "ul")) {
+                    lst = sibling;
+                    item = lst.last();
+                    if (item.text) {
+                        p = new Element("p");
+                        p.text = item.text;
+                        item.text = "";
+                        item.insert(0, p);
+                    }
+                    lch = lastChild(item);
+                    if (lch !== null && lch.tail) {
+                        p = subElement(item, "p");
+                        p.text = lstrip(lch.tail);
+                        lch.tail = "";
+                    }
+                    li = subElement(lst, "li");
+                    parser.state.push("looselist");
+                    parser.parseBlocks(li, [items.shift()]);
+                    parser.state.pop();
+                } else if (parent.tag == "ol" || parent.tag == "ul") {
+                    lst = parent;
+                } else {
+                    lst = subElement(parent, tag);
+                }
+                parser.state.push("list");
+                for (i = 0; i < items.length; i++) {
+                    if (startsWith(items[i], TAB)) {
+                        if (!lst.children.length) throw new Unsupported("list");
+                        parser.parseBlocks(lst.last(), [items[i]]);
+                    } else {
+                        li = subElement(lst, "li");
+                        parser.parseBlocks(li, [items[i]]);
+                    }
+                }
+                parser.state.pop();
+            }
+        };
+    }
+
+    function defListProcessor(parser) {
+        var DEF_RE = /(^|\n)[ ]{0,3}:[ ]{1,3}(.*?)(\n|$)/, NO_INDENT_RE = /^[ ]{0,3}[^ :]/;
+        return {
+            test : function (parent, block) { return DEF_RE.test(block); },
+            run : function (parent, blocks) {
+                var block = blocks.shift(), m = DEF_RE.exec(block), terms = [], lines, i, d, theRest = null, r;
+                var sibling, state, dl, dd;
+                lines = block.slice(0, m.index).split("\n");
+                for (i = 0; i < lines.length; i++) if (strip(lines[i])) terms.push(strip(lines[i]));
+                block = block.slice(end(m));
+                if (NO_INDENT_RE.test(block)) {
+                    d = block;
+                } else {
+                    r = detab(block);
+                    d = r[0];
+                    theRest = r[1];
+                }
+                d = d ? m[2] + "\n" + d : m[2];
+                sibling = lastChild(parent);
+                if (!terms.length && sibling !== null && sibling.tag == "p") {
+                    state = "looselist";
+                    terms = String(sibling.text).split("\n");
+                    parent.remove(sibling);
+                    sibling = lastChild(parent);
+                } else if (!terms.length && sibling === null) {
+                    throw new Unsupported("definition list");
+                } else {
+                    state = "list";
+                }
+                if (truthy(sibling) && sibling.tag == "dl") {
+                    dl = sibling;
+                    if (dl.children.length && dl.last().tag == "dd" && dl.last().children.length) state = "looselist";
+                } else {
+                    dl = subElement(parent, "dl");
+                }
+                for (i = 0; i < terms.length; i++) subElement(dl, "dt").text = terms[i];
+                parser.state.push(state);
+                dd = subElement(dl, "dd");
+                parser.parseBlocks(dd, [d]);
+                parser.state.pop();
+                if (theRest) blocks.unshift(theRest);
+            }
+        };
+    }
+
+    function blockQuoteProcessor(parser) {
+        var QUOTE_RE = /(^|\n)[ ]{0,3}>[ ]?(.*)/;
+        var clean = function (line) {
+            var m = /^(^|\n)[ ]{0,3}>[ ]?(.*)/.exec(line);
+            if (strip(line) == ">") return "";
+            return m ? m[2] : line;
+        };
+        return {
+            test : function (parent, block) { return QUOTE_RE.test(block); },
+            run : function (parent, blocks) {
+                var block = blocks.shift(), m = QUOTE_RE.exec(block), sibling, quote;
+                if (m) {
+                    parser.parseBlocks(parent, [block.slice(0, m.index)]);
+                    block = block.slice(m.index).split("\n").map(clean).join("\n");
+                }
+                sibling = lastChild(parent);
+                quote = (truthy(sibling) && sibling.tag == "blockquote") ? sibling : subElement(parent, "blockquote");
+                parser.state.push("blockquote");
+                parser.parseChunk(quote, block);
+                parser.state.pop();
+            }
+        };
+    }
+
+    function emptyBlockProcessor() {
+        var EMPTY_RE = /^[ \t\n\r\f\v]*\n/;
+        return {
+            test : function (parent, block) { return EMPTY_RE.test(block); },
+            run : function (parent, blocks) {
+                var block = blocks.shift(), m = EMPTY_RE.exec(block);
+                blocks.unshift(block.slice(end(m)));
+                // Python-Markdown would append to a previous code block here, but its test never passes
+            }
+        };
+    }
+
+    function paragraphProcessor(parser) {
+        return {
+            test : function () { return true; },
+            run : function (parent, blocks) {
+                var block = blocks.shift(), sibling, p;
+                if (!strip(block)) return;
+                if (parser.isstate("list")) {
+                    sibling = lastChild(parent);
+                    if (sibling !== null) sibling.tail = sibling.tail ? sibling.tail + "\n" + block : "\n" + block;
+                    else parent.text = parent.text ? parent.text + "\n" + block : lstrip(block);
+                } else {
+                    p = subElement(parent, "p");
+                    p.text = lstrip(block);
+                }
+            }
+        };
+    }
+
+    function BlockParser() {
+        this.state = [];
+        this.processors = [
+            emptyBlockProcessor(),
+            listIndentProcessor(this, ["li"], ["ul", "ol"]),
+            listIndentProcessor(this, ["dd"], ["dl"]),
+            codeProcessor(),
+            tableProcessor(),
+            hashHeaderProcessor(this),
+            setextHeaderProcessor(),
+            hrProcessor(this),
+            listProcessor(this, "ol", /^[ ]{0,3}\d+\.[ ]+(.*)/),
+            listProcessor(this, "ul", /^[ ]{0,3}[*+-][ ]+(.*)/),
+            defListProcessor(this),
+            blockQuoteProcessor(this),
+            paragraphProcessor(this)
+        ];
+    }
+    BlockParser.prototype.isstate = function (state) {
+        return this.state.length > 0 && this.state[this.state.length - 1] == state;
+    };
+    BlockParser.prototype.parseChunk = function (parent, text) {
+        this.parseBlocks(parent, text.split("\n\n"));
+    };
+    BlockParser.prototype.parseBlocks = function (parent, blocks) {
+        var i;
+        while (blocks.length) {
+            for (i = 0; i < this.processors.length; i++) {
+                if (this.processors[i].test(parent, blocks[0])) {
+                    this.processors[i].run(parent, blocks);
+                    break;
+                }
+            }
+        }
+    };
+
+    ///////////////////////////
+    //   Inline patterns     //
+    ///////////////////////////
+
+    var INLINE_PLACEHOLDER_RE = /\u0002klzzwxh:([0-9]{4})\u0003/g;
+    var ATTR_RE = /\{@([^}]*)=([^}]*)\}/g;
+
+    function dequote(s) {
+        if ((startsWith(s, "\"") && s.slice(-1) == "\"") || (startsWith(s, "'") && s.slice(-1) == "'"))
+            return s.slice(1, -1);
+        return s;
+    }
+
+    function handleAttributes(text, parent) {
+        return String(text).replace(ATTR_RE, function (all, name, value) {
+            parent.set(name, value.replace(/\n/g, " "));
+            return "";
+        });
+    }
+
+    function sanitizeUrl(url) { return url.replace(/ /g, "%20"); }
+
+    function buildInlinePatterns(md) {
+        var simpleTag = function (tag) {
+            return function (m) { var el = new Element(tag); el.text = m[3]; return el; };
+        };
+        var referenceTag = function (makeTag) {
+            return function (m) {
+                var id = m.length > 9 && m[9] ? m[9].toLowerCase() : m[2].toLowerCase(), ref;
+                id = id.replace(/[ ]?\n/g, " ");
+                if (!has(md.references, id)) return null;
+                ref = md.references[id];
+                return makeTag(ref[0], ref[1], m[2]);
+            };
+        };
+        var linkTag = function (href, title, text) {
+            var el = new Element("a");
+            el.set("href", sanitizeUrl(href));
+            if (title) el.set("title", title);
+            el.text = text;
+            return el;
+        };
+        var imageTag = function (href, title, text) {
+            var el = new Element("img");
+            el.set("src", sanitizeUrl(href));
+            if (title) el.set("title", title);
+            el.set("alt", md.unescape(text));
+            return el;
+        };
+        var rawHtml = function (m) { return md.store(md.unescapeHtml(m[2])); };
+        return [
+            ["backtick", RE.backtick, function (m) {
+                var el = new Element("code");
+                el.text = atomic(strip(m[3]));
+                return el;
+            }],
+            ["mathjax", RE.mathjax, function (m) {
+                var el = new Element("mathjax");
+                el.text = atomic(m[2] + m[3] + m[2]);
+                return el;
+            }],
+            ["escape", RE.escape, function (m) {
+                if (ESCAPED_CHARS.indexOf(m[2]) != -1) return STX + m[2].codePointAt(0) + ETX;
+                return "\\" + m[2];
+            }],
+            ["footnote", RE.footnote, function (m) {
+                var index = md.footnoteIds.indexOf(m[2]), sup, a;
+                if (index == -1) return null;
+                sup = new Element("sup");
+                a = subElement(sup, "a");
+                sup.set("id", "fnref:" + m[2]);
+                a.set("href", "#fn:" + m[2]);
+                a.set("rel", "footnote");
+                a.set("class", "footnote-ref");
+                a.text = String(index + 1);
+                return sup;
+            }],
+            ["reference", RE.reference, referenceTag(linkTag)],
+            ["link", RE.link, function (m) {
+                var el = new Element("a"), title = m[13], href = m[9];
+                el.text = m[2];
+                if (href) {
+                    if (href.charAt(0) == "<") href = href.slice(1, -1);
+                    el.set("href", sanitizeUrl(md.unescape(strip(href))));
+                } else {
+                    el.set("href", "");
+                }
+                if (title) el.set("title", dequote(md.unescape(title)));
+                return el;
+            }],
+            ["image_link", RE.imageLink, function (m) {
+                var el = new Element("img"), parts = strip(m[9]) ? strip(m[9]).split(/\s+/) : [], src;
+                if (parts.length) {
+                    src = parts[0];
+                    if (src.charAt(0) == "<" && src.slice(-1) == ">") src = src.slice(1, -1);
+                    el.set("src", sanitizeUrl(md.unescape(src)));
+                } else {
+                    el.set("src", "");
+                }
+                if (parts.length > 1) el.set("title", dequote(md.unescape(parts.slice(1).join(" "))));
+                el.set("alt", md.unescape(handleAttributes(m[2], el)));
+                return el;
+            }],
+            ["image_reference", RE.imageReference, referenceTag(imageTag)],
+            ["short_reference", RE.shortReference, referenceTag(linkTag)],
+            ["autolink", RE.autolink, function (m) {
+                var el = new Element("a");
+                el.set("href", md.unescape(m[2]));
+                el.text = atomic(m[2]);
+                return el;
+            }],
+            ["automail", RE.automail, function (m) {
+                var el = new Element("a"), email = md.unescape(m[2]), letters = [], mailto = [], chars, code, i;
+                if (startsWith(email, "mailto:")) email = email.slice(7);
+                if (/[^\x00-\x7f]/.test(email)) throw new Unsupported("email");
+                for (i = 0; i < email.length; i++) {
+                    code = email.charCodeAt(i);
+                    letters.push(AMP_SUBSTITUTE + (has(MAIL_ENTITIES, code) ? MAIL_ENTITIES[code] : "#" + code) + ";");
+                }
+                el.text = atomic(letters.join(""));
+                chars = "mailto:" + email;
+                for (i = 0; i < chars.length; i++) mailto.push(AMP_SUBSTITUTE + "#" + chars.charCodeAt(i) + ";");
+                el.set("href", mailto.join(""));
+                return el;
+            }],
+            ["linebreak", RE.linebreak, function () { return new Element("br"); }],
+            ["html", RE.html, rawHtml],
+            ["entity", RE.entity, rawHtml],
+            ["not_strong", RE.notStrong, function (m) { return m[2] == INLINE_PLACEHOLDER_PREFIX ? null : m[2]; }],
+            ["strong_em", RE.strongEm, function (m) {
+                var el = new Element("strong");
+                subElement(el, "em").text = m[3];
+                return el;
+            }],
+            ["strong", RE.strong, simpleTag("strong")],
+            ["emphasis", RE.emphasis, simpleTag("em")],
+            ["emphasis2", RE.emphasis2, simpleTag("em")],
+            ["strong2", RE.strong2, simpleTag("strong")],
+            ["nl", RE.nl, function () { return new Element("br"); }]
+        ];
+    }
+
+    ////////////////////////////
+    //   Inline processor     //
+    ////////////////////////////
+
+    function InlineProcessor(md) {
+        this.md = md;
+        this.stash = {};
+        this.stashSize = 0;
+    }
+
+    InlineProcessor.prototype.stashNode = function (node) {
+        var id = pad4(this.stashSize);
+        if (!has(this.stash, id)) this.stashSize += 1;
+        this.stash[id] = node;
+        return INLINE_PLACEHOLDER_PREFIX + id + ETX;
+    };
+
+    InlineProcessor.prototype.handleInline = function (data, patternIndex) {
+        var patterns = this.md.inlinePatterns, startIndex = 0, r;
+        patternIndex = patternIndex || 0;
+        if (isAtomic(data)) return data;
+        while (patternIndex < patterns.length) {
+            r = this.applyPattern(patterns[patternIndex], data, patternIndex, startIndex);
+            data = r[0];
+            startIndex = r[2];
+            if (!r[1]) patternIndex += 1;
+        }
+        return data;
+    };
+
+    InlineProcessor.prototype.applyPattern = function (pattern, data, patternIndex, startIndex) {
+        var match = pattern[1].exec(data.slice(startIndex)), leftData = data.slice(0, startIndex);
+        var node, after, children, i;
+        if (!match) return [data, false, 0];
+        node = pattern[2](match);
+        after = match[match.length - 1];
+        if (node === null) return [data, true, leftData.length + match[0].length - after.length];
+        if (!isString(node) && !isAtomic(node.text)) {
+            children = [node].concat(node.children);
+            for (i = 0; i < children.length; i++) {
+                if (children[i].text) children[i].text = this.handleInline(children[i].text, patternIndex + 1);
+                if (children[i].tail) children[i].tail = this.handleInline(children[i].tail, patternIndex);
+            }
+        }
+        return [leftData + match[1] + this.stashNode(node) + after, true, 0];
+    };
+
+    InlineProcessor.prototype.processElementText = function (node, subnode, isText) {
+        var text, childResult, pos = 0, i;
+        if (isText) {
+            text = subnode.text;
+            subnode.text = null;
+        } else {
+            text = subnode.tail;
+            subnode.tail = null;
+        }
+        childResult = this.processPlaceholders(text, subnode);
+        if (!isText && node !== subnode) {
+            pos = node.children.indexOf(subnode);
+            node.remove(subnode);
+        }
+        for (i = childResult.length - 1; i >= 0; i--) node.insert(pos, childResult[i]);
+    };
+
+    InlineProcessor.prototype.processPlaceholders = function (data, parent) {
+        var result = [], startIndex = 0, index, m, id, node, children, i, text, phEnd;
+        var linkText = function (text) {
+            if (!text) return;
+            if (result.length) {
+                var last = result[result.length - 1];
+                last.tail = last.tail ? last.tail + text : text;
+            } else {
+                parent.text = parent.text ? parent.text + text : text;
+            }
+        };
+        while (data) {
+            index = data.indexOf(INLINE_PLACEHOLDER_PREFIX, startIndex);
+            if (index == -1) {
+                text = data.slice(startIndex);
+                linkText(isAtomic(data) ? atomic(text) : text);
+                data = "";
+                continue;
+            }
+            INLINE_PLACEHOLDER_RE.lastIndex = index;
+            m = INLINE_PLACEHOLDER_RE.exec(data);
+            id = m ? m[1] : null;
+            phEnd = m ? end(m) : index + 1;
+            if (id !== null && has(this.stash, id)) {
+                node = this.stash[id];
+                if (index > 0) linkText(data.slice(startIndex, index));
+                if (isString(node)) {
+                    linkText(node);
+                    startIndex = phEnd;
+                    continue;
+                }
+                children = [node].concat(node.children);
+                for (i = 0; i < children.length; i++) {
+                    if (children[i].tail && strip(String(children[i].tail))) this.processElementText(node, children[i], false);
+                    if (children[i].text && strip(String(children[i].text))) this.processElementText(children[i], children[i], true);
+                }
+                startIndex = phEnd;
+                result.push(node);
+            } else {
+                linkText(data.slice(startIndex, index + INLINE_PLACEHOLDER_PREFIX.length));
+                startIndex = index + INLINE_PLACEHOLDER_PREFIX.length;
+            }
+        }
+        return result;
+    };
+
+    InlineProcessor.prototype.run = function (tree) {
+        var stack = [tree], curr, insertQueue, children, child, text, lst, dummy, tailResult, pos, i, j, element;
+        while (stack.length) {
+            curr = stack.pop();
+            insertQueue = [];
+            children = curr.children.slice();
+            for (i = 0; i < children.length; i++) {
+                child = children[i];
+                if (child.text && !isAtomic(child.text)) {
+                    text = child.text;
+                    child.text = null;
+                    lst = this.processPlaceholders(this.handleInline(text), child);
+                    stack = stack.concat(lst);
+                    insertQueue.push([child, lst]);
+                }
+                if (child.tail) {
+                    dummy = new Element("d");
+                    tailResult = this.processPlaceholders(this.handleInline(child.tail), dummy);
+                    child.tail = dummy.text ? dummy.text : null;
+                    pos = curr.children.indexOf(child) + 1;
+                    for (j = tailResult.length - 1; j >= 0; j--) curr.insert(pos, tailResult[j]);
+                }
+                if (child.children.length) stack.push(child);
+            }
+            for (i = 0; i < insertQueue.length; i++) {
+                element = insertQueue[i][0];
+                lst = insertQueue[i][1];
+                if (element.text) element.text = handleAttributes(element.text, element);
+                for (j = 0; j < lst.length; j++) {
+                    if (lst[j].tail) lst[j].tail = handleAttributes(lst[j].tail, element);
+                    if (lst[j].text) lst[j].text = handleAttributes(lst[j].text, lst[j]);
+                    element.insert(j, lst[j]);
+                }
+            }
+        }
+    };
+
+    ///////////////////////////
+    //   Tree processors     //
+    ///////////////////////////
+
+    function footnotesDiv(md, root) {
+        var div, ol, li, backlink, node, p, i, id;
+        if (!md.footnoteIds.length) return;
+        div = new Element("div");
+        div.set("class", "footnote");
+        subElement(div, "hr");
+        ol = subElement(div, "ol");
+        for (i = 0; i < md.footnoteIds.length; i++) {
+            id = md.footnoteIds[i];
+            li = subElement(ol, "li");
+            li.set("id", "fn:" + id);
+            md.parser.parseChunk(li, md.footnotes[id]);
+            backlink = new Element("a");
+            backlink.set("href", "#fnref:" + id);
+            backlink.set("rev", "footnote");
+            backlink.set("class", "footnote-backref");
+            backlink.set("title", "Jump back to footnote " + (i + 1) + " in the text");
+            backlink.text = FN_BACKLINK_TEXT;
+            if (li.children.length) {
+                node = li.last();
+                if (node.tag == "p") {
+                    if (node.text === null) throw new Unsupported("footnote");
+                    node.text = node.text + NBSP_PLACEHOLDER;
+                    node.children.push(backlink);
+                } else {
+                    p = subElement(li, "p");
+                    p.children.push(backlink);
+                }
+            }
+        }
+        // Only the top level is searched for the place marker, as in footnotes.py
+        for (i = 0; i < root.children.length; i++) {
+            node = root.children[i];
+            if (node.text && node.text.indexOf(FN_PLACE_MARKER) != -1) {
+                root.children[i] = div;
+                return;
+            }
+            if (node.tail && node.tail.indexOf(FN_PLACE_MARKER) != -1) {
+                root.insert(i + 1, div);
+                node.tail = null;
+                return;
+            }
+        }
+        root.children.push(div);
+    }
+
+    function codeHilite(md, root) {
+        var blocks = iter(root, "pre"), i, block;
+        for (i = 0; i < blocks.length; i++) {
+            block = blocks[i];
+            if (block.children.length == 1 && block.children[0].tag == "code") {
+                block.text = md.store(hilite(String(block.children[0].text), null), true);
+                block.tag = "p";
+                block.attrib = {};
+                block.children = [];
+                block.tail = null;
+            }
+        }
+    }
+
+    function getAttrs(str) {
+        var result = [], pos = 0, m, parts;
+        while (pos < str.length) {
+            RE.attrs.lastIndex = pos;
+            m = RE.attrs.exec(str);
+            if (!m || !m[0]) break;
+            pos = RE.attrs.lastIndex;
+            if (m[1] || m[2] || m[3]) {
+                parts = m[0].split("=");
+                if (parts.length != 2) throw new Unsupported("attribute list");
+                if (m[1]) parts[1] = parts[1].replace(/^"+|"+$/g, "");
+                if (m[2]) parts[1] = parts[1].replace(/^'+|'+$/g, "");
+                result.push(parts);
+            } else if (m[4]) {
+                if (startsWith(m[4], ".")) result.push([".", m[4].slice(1)]);
+                else if (startsWith(m[4], "#")) result.push(["id", m[4].slice(1)]);
+                else result.push([m[4], m[4]]);
+            }
+        }
+        return result;
+    }
+
+    function assignAttrs(elem, attrs) {
+        var list = getAttrs(attrs), i, cls;
+        for (i = 0; i < list.length; i++) {
+            if (list[i][0] == ".") {
+                cls = elem.get("class");
+                elem.set("class", cls ? cls + " " + list[i][1] : list[i][1]);
+            } else {
+                elem.set(list[i][0], list[i][1]);
+            }
+        }
+    }
+
+    function attrList(root) {
+        var BASE = "\\{:?([^}]*)\\}", END = "[ ]*(?=\\n?$)";
+        var HEADER_RE = new RegExp("[ ]*" + BASE + END), BLOCK_RE = new RegExp("\\n[ ]*" + BASE + END);
+        var INLINE_RE = new RegExp("^" + BASE);
+        var elems = iter(root), i, elem, re, header, last, m;
+        for (i = 0; i < elems.length; i++) {
+            elem = elems[i];
+            if (isBlockLevel(elem.tag)) {
+                header = /^h[1-6]$/.test(elem.tag);
+                re = header ? HEADER_RE : BLOCK_RE;
+                last = lastChild(elem);
+                if (last !== null && last.tail) {
+                    m = re.exec(last.tail);
+                    if (m) {
+                        assignAttrs(elem, m[1]);
+                        last.tail = last.tail.slice(0, m.index);
+                        if (header) last.tail = rstrip(last.tail.replace(/#+$/, ""));
+                    }
+                } else if (elem.text) {
+                    m = re.exec(elem.text);
+                    if (m) {
+                        assignAttrs(elem, m[1]);
+                        elem.text = elem.text.slice(0, m.index);
+                        if (header) elem.text = rstrip(elem.text.replace(/#+$/, ""));
+                    }
+                }
+            } else if (elem.tail) {
+                m = INLINE_RE.exec(elem.tail);
+                if (m) {
+                    assignAttrs(elem, m[1]);
+                    elem.tail = elem.tail.slice(end(m));
+                }
+            }
+        }
+    }
+
+    function slugify(value) {
+        value = value.normalize("NFKD").replace(/[^\x00-\x7f]/g, "");
+        value = strip(value.replace(/[^\w \t\n\r\f\v-]/g, "")).toLowerCase();
+        return value.replace(/[- \t\n\r\f\v]+/g, "-");
+    }
+
+    function unique(id, ids) {
+        var m;
+        while (contains(ids, id) || !id) {
+            m = /^(.*)_([0-9]+)$/.exec(id);
+            id = m ? m[1] + "_" + (parseInt(m[2], 10) + 1) : id + "_1";
+        }
+        ids.push(id);
+        return id;
+    }
+
+    function toc(root) {
+        var div = new Element("div"), header, level = 0, listStack, lastLi = null, usedIds = [], all = iter(root), i;
+        div.set("class", "toc");
+        header = subElement(div, "span");
+        header.set("class", "toctitle");
+        header.text = TOC_TITLE;
+        listStack = [div];
+        for (i = 0; i < all.length; i++) if (has(all[i].attrib, "id")) usedIds.push(all[i].attrib.id);
+
+        // Python's IndexError, headers out of order leave the rest of the header alone
+        var top = function () {
+            if (!listStack.length) throw new OutOfOrder();
+            return listStack[listStack.length - 1];
+        };
+        var visit = function (c, p, index) {
+            var text = strip(itertext(c).join("")), headerP = /^[Hh][1-6]/.test(c.tag), tagLevel, newlist, id, link;
+            if (!text) return;
+            if (c.text && strip(String(c.text)) == TOC_MARKER && !headerP && c.tag != "pre" && c.tag != "code")
+                p.children[index] = div;
+            if (!headerP) return;
+            tagLevel = parseInt(c.tag.slice(-1), 10);
+            try {
+                while (tagLevel < level) {
+                    top();
+                    listStack.pop();
+                    level -= 1;
+                }
+                if (tagLevel > level) {
+                    newlist = new Element("ul");
+                    if (lastLi) lastLi.children.push(newlist);
+                    else top().children.push(newlist);
+                    listStack.push(newlist);
+                    level = level == 0 ? tagLevel : level + 1;
+                }
+                if (!has(c.attrib, "id")) {
+                    id = unique(slugify(text), usedIds);
+                    c.set("id", id);
+                } else {
+                    id = c.attrib.id;
+                }
+                lastLi = new Element("li");
+                link = subElement(lastLi, "a");
+                link.text = text;
+                link.set("href", "#" + id);
+                top().children.push(lastLi);
+            } catch (e) {
+                if (!(e instanceof OutOfOrder)) throw e;
+            }
+        };
+        // Same order as toc.py's iterparent: the children of each element, taking the elements in document order
+        var walk = function (parent) {
+            var i;
+            for (i = 0; i < parent.children.length; i++) visit(parent.children[i], parent, i);
+            for (i = 0; i < parent.children.length; i++) walk(parent.children[i]);
+        };
+        walk(root);
+    }
+
+    function prettify(elem) {
+        var i;
+        if (isBlockLevel(elem.tag) && elem.tag != "code" && elem.tag != "pre") {
+            if ((!elem.text || !strip(String(elem.text))) && elem.children.length && isBlockLevel(elem.children[0].tag))
+                elem.text = "\n";
+            for (i = 0; i < elem.children.length; i++)
+                if (isBlockLevel(elem.children[i].tag)) prettify(elem.children[i]);
+            if (!elem.tail || !strip(String(elem.tail))) elem.tail = "\n";
+        }
+        if (!elem.tail || !strip(String(elem.tail))) elem.tail = "\n";
+    }
+
+    function prettifyBreaks(root) {
+        var brs = iter(root, "br"), i;
+        for (i = 0; i < brs.length; i++)
+            brs[i].tail = (!brs[i].tail || !strip(String(brs[i].tail))) ? "\n" : "\n" + brs[i].tail;
+    }
+
+    ///////////////////////
+    //   Sanitizer       //
+    ///////////////////////
+
+    // Same checks as filters.SanitizeTreeprocessor. What the server would hand over to bleach
+    // (and style attributes, which go through bleach's css sanitizer) is left to the server.
+    var URI_STRIP_RE = /[`\x00-\x20\x7f-\xa0\t\n\r\f\v]+/g, URI_SCHEME_RE = /^[a-z0-9][-+.a-z0-9]*:/;
+
+    function allowedUri(value) {
+        value = value.replace(/&lt;/g, "<").replace(/&gt;/g, ">").replace(/&amp;/g, "&");
+        value = value.replace(URI_STRIP_RE, "").toLowerCase().replace(/�/g, "");
+        return !(URI_SCHEME_RE.test(value) && !contains(policy.uri_protocols, value.split(":")[0]));
+    }
+
+    function sanitizeTree(root) {
+        var elems = iter(root), i, el, allowed, name;
+        for (i = 0; i < elems.length; i++) {
+            el = elems[i];
+            if (!contains(policy.tags, el.tag)) throw new Unsupported("tag " + el.tag);
+            allowed = has(policy.attrs, el.tag) ? policy.attrs[el.tag] : policy.attrs["*"];
+            for (name in el.attrib) {
+                if (!has(el.attrib, name)) continue;
+                if (name != name.toLowerCase()) throw new Unsupported("attribute " + name);
+                if (!contains(allowed, name) || (contains(policy.uri_attrs, name) && !allowedUri(el.attrib[name])))
+                    delete el.attrib[name];
+                else if (name == "style")
+                    throw new Unsupported("style");
+            }
+        }
+    }
+
+    ///////////////////////
+    //   Markdown        //
+    ///////////////////////
+
+    function Markdown(wikiPrefix) {
+        this.wikiPrefix = wikiPrefix;
+        this.rawHtmlBlocks = [];
+        this.references = {};
+        this.footnotes = {};
+        this.footnoteIds = [];
+        this.parser = new BlockParser();
+        this.inlinePatterns = buildInlinePatterns(this);
+        this.inline = new InlineProcessor(this);
+    }
+
+    Markdown.prototype.store = function (html, safe) {
+        this.rawHtmlBlocks.push([html, !!safe]);
+        return STX + "wzxhzdk:" + (this.rawHtmlBlocks.length - 1) + ETX;
+    };
+
+    Markdown.prototype.setFootnote = function (id, text) {
+        if (!has(this.footnotes, id)) this.footnoteIds.push(id);
+        this.footnotes[id] = text;
+    };
+
+    Markdown.prototype.addAbbreviation = function (abbr, re, title) {
+        var name = "abbr-" + abbr, i, pattern = [name, re, function (m) {
+            var el = new Element("abbr");
+            el.text = m[2];
+            el.set("title", title);
+            return el;
+        }];
+        for (i = 0; i < this.inlinePatterns.length; i++) {
+            if (this.inlinePatterns[i][0] == name) {
+                this.inlinePatterns[i] = pattern;
+                return;
+            }
+        }
+        this.inlinePatterns.push(pattern);
+    };
+
+    // Pattern.unescape: placeholders become the text of what they stand for
+    Markdown.prototype.unescape = function (text) {
+        var stash = this.inline.stash;
+        return String(text).replace(INLINE_PLACEHOLDER_RE, function (all, id) {
+            if (!has(stash, id)) return "";
+            return isString(stash[id]) ? stash[id] : itertext(stash[id]).join("");
+        });
+    };
+
+    // HtmlPattern.unescape: placeholders become html
+    Markdown.prototype.unescapeHtml = function (text) {
+        var stash = this.inline.stash;
+        return String(text).replace(INLINE_PLACEHOLDER_RE, function (all, id) {
+            if (!has(stash, id)) return "";
+            return isString(stash[id]) ? "\\" + stash[id] : toString(stash[id]);
+        });
+    };
+
+    // Only entities and the links made out of [[wikilinks]] are let through as raw html
+    Markdown.prototype.safeRawHtml = function (html) {
+        var link = "<a href=\"" + this.wikiPrefix;
+        if (ENTITY_ONLY_RE.test(html) || (this.wikiPrefix && html == "</a>")) return true;
+        return !!this.wikiPrefix && startsWith(html, link) && /^[^"<>&]*">$/.test(html.slice(link.length));
+    };
+
+    Markdown.prototype.convert = function (source) {
+        var lines, root, output, i, html, placeholder;
+        if (!strip(source)) return "";
+        source = source.replace(/[\u0002\u0003]/g, "").replace(/\r\n/g, "\n").replace(/\r/g, "\n") + "\n\n";
+        source = expandTabs(source.replace(/\n[ \t\n\r\f\v]+\n/g, "\n\n"));
+
+        lines = source.split("\n");
+        lines = fencedCode(this, lines);
+        lines = htmlBlock(this, lines);
+        lines = footnoteDefinitions(this, lines);
+        lines = abbreviations(this, lines);
+        lines = references(this, lines);
+
+        root = new Element("div");
+        this.parser.parseChunk(root, lines.join("\n"));
+
+        footnotesDiv(this, root);
+        codeHilite(this, root);
+        this.inline.run(root);
+        attrList(root);
+        toc(root);
+        prettify(root);
+        prettifyBreaks(root);
+        sanitizeTree(root);
+
+        output = toString(root);
+        output = strip(output.slice(output.indexOf("<div>") + 5, output.lastIndexOf("</div>")));
+        for (i = 0; i < this.rawHtmlBlocks.length; i++) {
+            html = this.rawHtmlBlocks[i][0];
+            if (!this.rawHtmlBlocks[i][1] && !this.safeRawHtml(html)) throw new Unsupported("raw html");
+            placeholder = STX + "wzxhzdk:" + i + ETX;
+            if (rawBlockLevel(html)) output = replaceAll(output, "<p>" + placeholder + "</p>", html + "\n");
+            output = replaceAll(output, placeholder, html);
+        }
+        output = replaceAll(output, AMP_SUBSTITUTE, "&");
+        output = replaceAll(replaceAll(output, FN_BACKLINK_TEXT, "&#8617;"), NBSP_PLACEHOLDER, "&#160;");
+        output = output.replace(/\u0002(\d+)\u0003/g, function (all, code) { return String.fromCodePoint(parseInt(code, 10)); });
+        return strip(output);
+    };
+
+    function rawBlockLevel(html) {
+        var m = /^<\/?([^ >]+)/.exec(html);
+        if (!m) return false;
+        return "!?@%".indexOf(m[1].charAt(0)) != -1 || isBlockLevel(m[1]);
+    }
+
+    ///////////////////////
+    //   filters.py      //
+    ///////////////////////
+
+    // urllib.quote, which fails on the server for anything but ascii
+    function quote(s) {
+        if (/[^\x00-\x7f]/.test(s)) throw new Unsupported("doi");
+        return s.replace(/[^A-Za-z0-9_.\-\/]/g, function (c) {
+            return "%" + (c.charCodeAt(0) < 16 ? "0" : "") + c.charCodeAt(0).toString(16).toUpperCase();
+        });
+    }
+
+    function wikilink(prefix) {
+        return function (all, link, text) {
+            var posfix;
+            text = strip(text);
+            posfix = link ? strip(link.slice(0, -1)).replace(/ /g, "_") : text.replace(/ /g, "_");
+            if (posfix.charAt(0).toUpperCase().length != 1) throw new Unsupported("wikilink");
+            posfix = posfix.charAt(0).toUpperCase() + posfix.slice(1);
+            return "<a href=\"" + prefix + posfix + "\">" + text + "</a>";
+        };
+    }
+
+    // Same as filters.render_md, or null if this has to be left to the server
+    function render(value, wikiPId) {
+        var prefix = wikiPId ? "/" + wikiPId + "/wiki/page/" : "";
+        if (!policy || !RE) return null;
+        try {
+            value = value.replace(DOI_RE, function (s) { return "[" + s + "](http://dx.doi.org/" + quote(s.slice(4)) + ")"; });
+            if (wikiPId) value = value.replace(WIKILINKS_RE, wikilink(prefix));
+            return new Markdown(prefix).convert(value);
+        } catch (e) {
+            if (!(e instanceof Unsupported) && typeof console != "undefined") console.log(e);
+            return null;
+        }
+    }
+
+    // The sanitizer policy is only asked for when a preview is first needed
+    function load() {
+        if (policyRequested || !RE || typeof $ == "undefined") return;
+        policyRequested = true;
+        $.getJSON("/_preview", function (data) { policy = data; });
+    }
+
+    try {
+        compile();
+    } catch (e) {
+        RE = null;            // No lookbehind or unicode property escapes, everything goes to the server
+    }
+
+    return {
+        render : render,
+        load : load,
+        ready : function () { return !!(policy && RE); },
+        setPolicy : function (data) { policy = data; }
+    };
+})();
@@ -36,6 +36,20 @@ routes = [
     Route('/cron/send_email_notifications', 'src.email_messages.SendNotifications'),
     Route('/cron/send_group_biblio_notifications', 'src.groups.SendBiblioNotifications'),
     Route('/cron/send_pending_emails', 'src.email_messages.SendPendingEmails'),
+    Route('/cron/report_item', 'src.projects.ReportItem'),
+    Route('/cron/notify_subscribers', 'src.projects.NotifySubscribers'),
+    Route('/cron/backfill_rendered_html', 'src.maintenance.BackfillRenderedHtml'),
+    Route('/cron/backfill_user_indexes', 'src.maintenance.BackfillUserIndexes'),
+    Route('/cron/backfill_activity_snapshots', 'src.maintenance.BackfillActivitySnapshots'),
+    Route('/cron/backfill_update_flags', 'src.maintenance.BackfillUpdateFlags'),
+    Route('/cron/move_project_updates', 'src.maintenance.MoveProjectUpdates'),
+    Route('/cron/move_notification_lists', 'src.maintenance.MoveNotificationLists'),
+    Route('/cron/move_memberships', 'src.maintenance.MoveMemberships'),
+    Route('/cron/reconcile_counters', 'src.maintenance.ReconcileCounters'),
+    Route('/cron/backfill_revision_metadata', 'src.maintenance.BackfillRevisionMetadata'),
+    Route('/cron/compact_revisions', 'src.maintenance.CompactRevisions'),
+    Route('/cron/compress_text_properties', 'src.maintenance.CompressTextProperties'),
+    Route('/cron/load_test_project_writes', 'src.maintenance.LoadTestProjectWrites'),
     ##
     #  Projects
     ##
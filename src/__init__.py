@@ -1,3 +1,3 @@
 # __init__.py
 
-__all__ = ["bibliography", "code", "collab_writing", "datasets", "email_messages", "filters", "forum", "frontend", "generic", "groups", "images", "notebooks", "outreach", "projects", "secrets", "users", "wiki"]
+__all__ = ["bibliography", "code", "collab_writing", "datasets", "email_messages", "filters", "forum", "frontend", "generic", "groups", "images", "maintenance", "notebooks", "outreach", "projects", "secrets", "users", "wiki"]
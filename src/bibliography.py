@@ -8,6 +8,7 @@ from google.appengine.ext import ndb
 
 CROSSREF_QUERY_URL = "http://doi.crossref.org/servlet/query?pid=" + generic.ADMIN_EMAIL + "&format=unixsd&id="
 ARXIV_QUERY_URL = "http://export.arxiv.org/api/query?id_list="
+ITEMS_PER_PAGE = 20
 
 def get_dom(identifier, kind):
     error_message = ''
@@ -86,7 +87,7 @@ def make_link(identifier, kind):
 ###########################
 
 # Each BiblioItem should have a Project as parent
-class BiblioItems(ndb.Model):
+class BiblioItems(generic.ChildCounters, ndb.Model):
     title = ndb.StringProperty(required = True)
     link = ndb.StringProperty(required = True)
     kind = ndb.StringProperty(required = True)          # article, arXiv, book, etc...
@@ -95,21 +96,24 @@ class BiblioItems(ndb.Model):
     last_updated = ndb.DateTimeProperty(auto_now = True)
     metadata = ndb.JsonProperty(required = True)
     open_p = ndb.BooleanProperty(default = True)
+    comments_count = ndb.IntegerProperty(required = False, indexed = False)
+    counters = {"comments_count" : "BiblioComments"}
 
     def get_number_of_comments(self):
-        return BiblioComments.query(ancestor = self.key).count()
+        return self.get_count("comments_count")
         
     def is_open_p(self):
         return self.open_p
 
 # Each BiblioComment should have a BiblioItem as parent
-class BiblioComments(ndb.Model):
+class BiblioComments(generic.RenderedMarkdown, ndb.Model):
+    parent_counter = "comments_count"
     content = ndb.TextProperty(required = True)
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
 
     def is_open_p(self):
-        return self.key.parent().get().open_p
+        return generic.item_open_p(self.key)
 
 ######################
 ##   Web Handlers   ##
@@ -120,8 +124,7 @@ class BiblioPage(projects.ProjectPage):
         projects.ProjectPage.render(self, bibliography_tab_class = "active", *a, **kw)
 
     def get_BiblioItems_list(self, project):
-        self.log_read(BiblioItems, "Fetching all bibliography items for a project. ")
-        return BiblioItems.query(ancestor = project.key).order(-BiblioItems.last_updated).fetch()
+        return self.fetch_page(BiblioItems.query(ancestor = project.key).order(-BiblioItems.last_updated), ITEMS_PER_PAGE)
 
     def get_item(self, project, itemid, log_message = ''):
         self.log_read(BiblioItems, log_message)
@@ -144,7 +147,8 @@ class MainPage(BiblioPage):
             self.error(404)
             self.render("404.html", info = "Project with key <em>%s</em> not found." % projectid)
             return
-        self.render("biblio_main.html", project = project, items = self.get_BiblioItems_list(project),
+        items, pager = self.get_BiblioItems_list(project)
+        self.render("biblio_main.html", project = project, items = items, pager = pager,
                     visitor_p = not (user and project.user_is_author(user)))
 
 
@@ -265,6 +269,7 @@ class ItemPage(BiblioPage):
         elif action == "toggle_visibility":
             item.open_p = not item.open_p
             self.log_and_put(item)
+            projects.update_visibility(item.key, item.open_p)
         elif action == "edit_comment":
             commentid = self.request.get("commentid")
             comment = self.get_comment(item, commentid)
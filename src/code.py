@@ -9,35 +9,40 @@ import json, re
 GITHUB_REPO_RE = r'^https://github.com/[a-zA-Z0-9_-]+/[a-zA-Z0-9_-]+$'
 GITHUB_PREFIX  = r'https://github.com/'
 GITHUB_API_PREFIX = 'https://api.github.com/repos/'
+REPOSITORIES_PER_PAGE = 20
 
 ###########################
 ##   Datastore Objects   ##
 ###########################
 
 # Each CodeRepository have a Project as parent
-class CodeRepositories(ndb.Model):
+class CodeRepositories(generic.ChildCounters, ndb.Model):
     name = ndb.StringProperty(required = True)
     description = ndb.TextProperty(required = True)
     last_updated = ndb.DateTimeProperty(auto_now_add = True)
     link = ndb.StringProperty(required = True)
-    github_json = ndb.JsonProperty()
+    github_json = ndb.JsonProperty(compressed = True)
     open_p = ndb.BooleanProperty(default = True)
+    comments_count = ndb.IntegerProperty(required = False, indexed = False)
+    counters = {"comments_count" : "CodeComments"}
 
     def is_open_p(self):
         return self.open_p
 
     def get_number_of_comments(self):
-        return CodeComments.query(ancestor = self.key).count()
+        return self.get_count("comments_count")
 
 
 # Each RepositoryComment should have a CodeRepository as parent
-class CodeComments(ndb.Model):
+class CodeComments(generic.RenderedMarkdown, ndb.Model):
+    md_source = "comment"
+    parent_counter = "comments_count"
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
     comment = ndb.TextProperty(required = True)
 
     def is_open_p(self):
-        return self.key.parent().get().open_p
+        return generic.item_open_p(self.key)
 
 
 ######################
@@ -49,8 +54,7 @@ class CodePage(projects.ProjectPage):
         projects.ProjectPage.render(self, code_tab_class = "active", *a, **kw)
 
     def get_codes_list(self, project):
-        self.log_read(CodeRepositories, "Fetching all the code reposirtories. ")
-        return CodeRepositories.query(ancestor = project.key).order(-CodeRepositories.last_updated).fetch()
+        return self.fetch_page(CodeRepositories.query(ancestor = project.key).order(-CodeRepositories.last_updated), REPOSITORIES_PER_PAGE)
 
     def get_code(self, project, codeid, log_message = ''):
         self.log_read(CodeRepositories, log_message)
@@ -72,8 +76,9 @@ class CodesListPage(CodePage):
             self.error(404)
             self.render("404.html", info = 'Project with key <em>%s</em> not found' % projectid)
             return
-        self.render("code_list.html", project = project, 
-                    items = self.get_codes_list(project), visitor_p = not (user and project.user_is_author(user)))
+        items, pager = self.get_codes_list(project)
+        self.render("code_list.html", project = project, items = items, pager = pager,
+                    visitor_p = not (user and project.user_is_author(user)))
 
 
 class NewCodePage(CodePage):
@@ -302,6 +307,8 @@ class EditCodePage(CodePage):
                 code.name = repo_json["full_name"]
                 code.link = kw["name_value"]
             if code.description != kw["content_value"]: code.description = kw["content_value"]
-            if code.open_p != kw["open_p"]: code.open_p = kw["open_p"]
+            visibility_changed_p = code.open_p != kw["open_p"]
+            if visibility_changed_p: code.open_p = kw["open_p"]
             self.log_and_put(code)
+            if visibility_changed_p: projects.update_visibility(code.key, code.open_p)
             self.redirect("/%s/code/%s" % (projectid, code.key.integer_id()))
@@ -3,6 +3,9 @@
 from google.appengine.ext import ndb
 import generic, projects, filters, groups
 
+WRITINGS_PER_PAGE = 20
+REVISIONS_PER_PAGE = 20
+
 ###########################
 ##   Datastore Objects   ##
 ###########################
@@ -20,24 +23,25 @@ class CollaborativeWritings(ndb.Model):
         return self.open_p
 
 # Should have as parent a CollaborativeWriting
-class WritingRevisions(ndb.Model):
+class WritingRevisions(generic.Revision, ndb.Model):
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
-    date = ndb.DateTimeProperty(auto_now = True)
-    content = ndb.TextProperty(required = True)
+    date = ndb.DateTimeProperty(auto_now_add = True)
+    content = ndb.TextProperty(required = False, compressed = True)     # None when stored as a delta, see generic.Revision
     summary = ndb.TextProperty(required = False)
 
     def is_open_p(self):
-        return self.key.parent().get().open_p
+        return generic.item_open_p(self.key)
 
 
 # Should have as parent a CollaborativeWriting
-class WritingComments(ndb.Model):
+class WritingComments(generic.RenderedMarkdown, ndb.Model):
+    md_source = "comment"
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
     comment = ndb.TextProperty(required = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
 
     def is_open_p(self):
-        return self.key.parent().get().open_p
+        return generic.item_open_p(self.key)
 
 
 ######################
@@ -49,11 +53,8 @@ class WritingPage(projects.ProjectPage):
         projects.ProjectPage.render(self, writings_tab_class = "active", *a, **kw)
 
     def get_writings_list(self, project, log_message = ''):
-        writings = []
-        for w in CollaborativeWritings.query(ancestor = project.key).order(-CollaborativeWritings.last_updated).iter():
-            self.log_read(CollaborativeWritings, log_message)
-            writings.append(w)
-        return writings
+        return self.fetch_page(CollaborativeWritings.query(ancestor = project.key).order(-CollaborativeWritings.last_updated),
+                               WRITINGS_PER_PAGE, log_message)
 
     def get_writing(self, project, writingid, log_message = ''):
         self.log_read(CollaborativeWritings, log_message)
@@ -68,11 +69,7 @@ class WritingPage(projects.ProjectPage):
         return WritingRevisions.get_by_id(int(revid), parent = writing.key)
 
     def get_revisions(self, writing, log_message = ''):
-        revisions = []
-        for r in WritingRevisions.query(ancestor = writing.key).order(-WritingRevisions.date).iter():
-            self.log_read(WritingRevisions, log_message)
-            revisions.append(r)
-        return revisions
+        return generic.get_revisions_page(self, writing, WritingRevisions, REVISIONS_PER_PAGE, log_message)
 
     def get_comments(self, writing, log_message = ''):
         comments = []
@@ -94,7 +91,8 @@ class WritingsListPage(WritingPage):
             self.error(404)
             self.render("404.html", info = 'Project with key <em>%s</em> not found' % projectid)
             return
-        self.render("writings_list.html", project = project, user = user, items = self.get_writings_list(project),
+        items, pager = self.get_writings_list(project)
+        self.render("writings_list.html", project = project, user = user, items = items, pager = pager,
                     visitor_p = not (user and project.user_is_author(user)))
 
 
@@ -210,7 +208,7 @@ class EditWritingPage(WritingPage):
             return
         last_revision = self.get_last_revision(writing)
         if last_revision:
-            content = last_revision.content
+            content = last_revision.get_content()
         else:
             content = ''
         self.render("writings_edit.html", project = project, writing = writing, edit_p = True,
@@ -244,7 +242,7 @@ class EditWritingPage(WritingPage):
             have_error = True
             kw["error_message"] = "Please write some content before saving. "
             kw["cClass"] = "has-error"
-        if last_revision and (kw["content"] == last_revision.content) and (kw["status"] == writing.status):
+        if last_revision and (kw["content"] == last_revision.get_content()) and (kw["status"] == writing.status):
             have_error = True
             error_message = "There aren't any changes to save. "
         if have_error:
@@ -252,7 +250,8 @@ class EditWritingPage(WritingPage):
         else:
             new_revision = WritingRevisions(author = user.key, content = kw["content"], summary = kw["summary"], parent = writing.key)
             if kw["status"]: writing.status = kw["status"]
-            self.put_and_report(new_revision, user, project, writing)
+            # The writing, the revision and the previous one stored as a delta, in a single transaction
+            self.put_and_report(new_revision, user, project, writing, new_revision.writes_with)
             self.redirect("/%s/writings/%s" % (projectid, writingid))
 
 
@@ -272,9 +271,9 @@ class HistoryWritingPage(WritingPage):
         if not (writing.is_open_p() or (user and project.user_is_author(user))):
             self.render("project_page_not_visible.html", project = project, user = user)
             return
-        revisions = self.get_revisions(writing)
+        revisions, pager = self.get_revisions(writing)
         self.render("writings_history.html", project = project, user = user, writing = writing, hist_p = True, 
-                    visitor_p = not (user and project.user_is_author(user)), revisions = revisions)
+                    visitor_p = not (user and project.user_is_author(user)), revisions = revisions, pager = pager)
 
 
 class ViewRevisionPage(WritingPage):
@@ -412,10 +411,12 @@ class InfoPage(WritingPage):
             kw["error_message"] = "Please provide a description for this writing before saving. "
             kw["dClass"] = "has-error"
         if (not have_error) and (kw["title"] != writing.title or kw["description"] != writing.description or kw["open_p"] != writing.open_p):
+            visibility_changed_p = kw["open_p"] != writing.open_p
             writing.title = kw["title"]
             writing.description = kw["description"]
             writing.open_p = kw["open_p"]
             self.log_and_put(writing)
+            if visibility_changed_p: projects.update_visibility(writing.key, writing.open_p)
         kw["success_message"] = 'Changes saved'
         self.render("writings_info.html", project = project, writing = writing, **kw)
 
@@ -439,6 +440,6 @@ class WritingUtils(WritingPage):
         content = filters.md("# " +
                              writing.title +
                              "\n" +
-                             (last_revision.content if last_revision else ""))
+                             (last_revision.get_content() if last_revision else ""))
         self.render("html_export.html", title = writing.title, content = content)
         
@@ -6,49 +6,56 @@ import generic, projects, groups
 from google.appengine.ext import ndb,blobstore
 from google.appengine.ext.webapp import blobstore_handlers
 
+DATASETS_PER_PAGE = 20
 
 ###########################
 ##   Datastore Objects   ##
 ###########################
 
 # Each instance should have a Project as parent.
-class DataSets(ndb.Model):
+class DataSets(generic.ChildCounters, ndb.Model):
     name = ndb.StringProperty(required = True)
     description = ndb.TextProperty(required = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
     last_updated = ndb.DateTimeProperty(auto_now = True)
     open_p = ndb.BooleanProperty(default = True)
+    concepts_count = ndb.IntegerProperty(required = False, indexed = False)
+    counters = {"concepts_count" : "DataConcepts"}
 
     def get_number_of_concepts(self):
-        return DataConcepts.query(ancestor = self.key).count()
+        return self.get_count("concepts_count")
 
     def is_open_p(self):
         return self.open_p
 
 
 # Should have a DataSet as parent
-class DataConcepts(ndb.Model):
+class DataConcepts(generic.ChildCounters, ndb.Model):
+    parent_counter = "concepts_count"
     name = ndb.StringProperty(required = True)
     description = ndb.TextProperty(required = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
     last_updated = ndb.DateTimeProperty(auto_now = True)
+    revisions_count = ndb.IntegerProperty(required = False, indexed = False)
+    counters = {"revisions_count" : "DataRevisions"}
 
     def get_number_of_revisions(self):
-        return DataRevisions.query(ancestor = self.key).count()
+        return self.get_count("revisions_count")
 
     def is_open_p(self):
-        return self.key.parent().get().is_open_p()
+        return generic.item_open_p(self.key)
 
 
 # Should have a DataConcept as parent
 class DataRevisions(ndb.Model):
+    parent_counter = "revisions_count"
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
     meta = ndb.TextProperty(required = False)
     datafile = ndb.BlobKeyProperty(required = True)
 
     def is_open_p(self):
-        return self.key.parent().get().is_open_p()
+        return generic.item_open_p(self.key)
 
 
 ######################
@@ -60,8 +67,7 @@ class DataPage(projects.ProjectPage):
         projects.ProjectPage.render(self, datasets_tab_class = "active", *a, **kw)
 
     def get_datasets(self, project):
-        self.log_read(DataSets, "Fetching all DataSets for a project. ")
-        return DataSets.query(ancestor = project.key).order(-DataSets.last_updated).fetch()
+        return self.fetch_page(DataSets.query(ancestor = project.key).order(-DataSets.last_updated), DATASETS_PER_PAGE)
 
     def get_dataset(self, project, datasetid, log_message = ''):
         self.log_read(DataSets, log_message)
@@ -92,7 +98,8 @@ class MainPage(DataPage):
             self.error(404)
             self.render("404.html", info = 'Project with key <em>%s</em> not found' % projectid)
             return
-        self.render("datasets_list.html", project = project, items = self.get_datasets(project),
+        items, pager = self.get_datasets(project)
+        self.render("datasets_list.html", project = project, items = items, pager = pager,
                     visitor_p = not (user and project.user_is_author(user)))
 
 
@@ -264,10 +271,12 @@ class EditDataSetPage(DataPage):
             self.render("project_form_2.html", project = project, **kw)
         else:
             if (kw["name_value"] != dataset.name) or (kw["content_value"] != dataset.description) or (kw["open_p"] != dataset.open_p):
+                visibility_changed_p = kw["open_p"] != dataset.open_p
                 dataset.name = kw["name_value"]
                 dataset.description = kw["content_value"]
                 dataset.open_p = kw["open_p"]
                 self.log_and_put(dataset)
+                if visibility_changed_p: projects.update_visibility(dataset.key, dataset.open_p)
             self.redirect("/%s/datasets/%s" % (project.key.integer_id(), dataset.key.integer_id()))
 
 
@@ -535,15 +544,8 @@ class DataSetBlobstoreUpload(generic.GenericBlobstoreUpload):
         return DataRevisions.get_by_id(int(revid), parent = datac.key)
 
     def put_and_report(self, item, author, project, list_of_things_to_update = []):
-        self.log_and_put(item)
-        # Log user activity
-        u_activity = generic.UserActivities(parent = author.key, item = item.key, relative_to = project.key, actv_kind = "Projects")
-        self.log_and_put(u_activity)
-        # Log project update
-        p_update = projects.ProjectUpdates(parent = project.key, author = author.key, item = item.key)
-        self.log_and_put(p_update)
-        for i in list_of_things_to_update:
-            self.log_and_put(i)
+        # As in projects.ProjectPage.put_and_report, without writing the project
+        projects.put_and_report(item, author, project, list_of_things_to_update, touch_project_p = False)
         return
 
 
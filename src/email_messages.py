@@ -17,8 +17,8 @@ class EmailsToSend(ndb.Model):
     sender  = ndb.StringProperty(default = PRETTY_ADMIN_EMAIL)
     to      = ndb.StringProperty(required = True)
     subject = ndb.StringProperty(required = True)
-    body    = ndb.TextProperty(required = True)
-    html    = ndb.TextProperty(default = "") 
+    body    = ndb.TextProperty(required = True, compressed = True)
+    html    = ndb.TextProperty(default = "", compressed = True)
 
 
 ######################
@@ -39,6 +39,19 @@ class SendPendingEmails(generic.GenericPage):
             email.key.delete()
 
 
+class SendNotifications(generic.GenericPage):
+    # The ones projects.notify_subscribers wrote, in an email for each user
+    def get(self):
+        self.log_read(generic.EmailNotifications, "Fetching the notifications not sent yet. ")
+        pending = generic.EmailNotifications.query(generic.EmailNotifications.sent == False).fetch()
+        by_user = {}
+        for n in pending:
+            by_user.setdefault(n.key.parent(), []).append(n)
+        user_keys = by_user.keys()
+        for user_key, user in zip(user_keys, ndb.get_multi(user_keys)):
+            if user and user.email: send_notifications(by_user[user_key], user)
+
+
 ##########################
 ##   Helper Functions   ##
 ##########################
@@ -54,6 +67,7 @@ def classify_notifications(notifications_list):
 def send_notifications(notifications_list, user):
     if len(notifications_list) == 0: return
     notifs = classify_notifications(notifications_list)
+    notifs.update(APP_NAME = generic.APP_NAME, APP_URL = generic.APP_URL)
     message = mail.EmailMessage(sender = PRETTY_ADMIN_EMAIL,
                                 to = user.email,
                                 subject = "Recent activity in your projects",
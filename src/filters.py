@@ -1,6 +1,11 @@
 # Definitions for my own filters
 
 import markdown, re, urllib, bleach
+import collections, hashlib, threading
+from xml.sax.saxutils import unescape
+from bleach.sanitizer import BleachSanitizerMixin
+from markdown.extensions import abbr, footnotes
+from google.appengine.api import memcache
 
 
 # Parsing doi (digital object identifier
@@ -8,6 +13,7 @@ import markdown, re, urllib, bleach
 # and transform it to [doi:this/is.the/actual-doi](http://dx.doi.org/this/is.the/actual-doi"
 # before passing it to markdown
 DOI_REGEXP = r'(doi|Doi|DOI):\S+'
+DOI_RE = re.compile(DOI_REGEXP)
 
 def make_doi_link(doi_match_object):
     s = doi_match_object.group(0)
@@ -18,6 +24,7 @@ def make_doi_link(doi_match_object):
 # A simple [[link and text]]                 -->   (''       , 'link and text')
 # Another [[link | display text]]   -->   ('link |' , 'display text') 
 WIKILINKS_RE = r'\[\[([^\|\]]+\|)?([^\]]+)\]\]'
+WIKILINKS_RE_COMPILED = re.compile(WIKILINKS_RE)
 
 # Given a link prefix and assuming the regex r'\[\[([^\|\]]+\|)?([^\]]+)\]\]'
 # was used, this function returns the link and display text to be used un an
@@ -38,18 +45,387 @@ def make_sub_repl(projectid):
     return lambda x: '<a href="%s">%s</a>' % (link_and_text(x, link_prefix))
 
 
-def md(value, wiki_p_id = ""):
-    "wiki_p_id is the project id and should only be present when rendering a wiki page. This is used to generate the 'wikilinks'."
-    allowed_tags = bleach.ALLOWED_TAGS + ['br', 'caption', 'colgroup', 'div', 'figcaption', 'figure', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr',
-                                          'iframe', 'img', 'mathjax', 'p', 'pre', 'span', 'style', 'sub', 'sup','table', 'tbody', 'tfoot',
-                                          'td', 'th', 'thead', 'tr']
-    allowed_attrs = dict(bleach.ALLOWED_ATTRIBUTES.items() + 
-                         {'*' : ['class', 'id', 'align', 'style', 'role', 'data-target', 'data-ride', 'data-slide-to', 'data-slide', 'data-interval'],
-                          'img': ['alt', 'src', 'title', 'width', 'height'],
-                          'iframe' : ['width', 'height', 'src', 'frameborder', 'allowfullscreen'],
-                          'style' : ['type']}.items())
-    value = re.sub(DOI_REGEXP, make_doi_link, value)     # doi links
-    if wiki_p_id: value = re.sub(WIKILINKS_RE, make_sub_repl(wiki_p_id), value) 
-    value = markdown.markdown(value, extensions = ['extra', 'toc(title=Contents)', 'nl2br', 'mathjax', 'tables', 'codehilite'])
-    value = bleach.clean(value, tags = allowed_tags, attributes = allowed_attrs)
-    return value
+# Renderer configuration. RENDERER_VERSION is derived from it so that any change
+# in the extensions or in the sanitizer whitelist invalidates every cached rendering.
+MD_EXTENSIONS = ['extra', 'toc(title=Contents)', 'nl2br', 'mathjax', 'tables', 'codehilite']
+ALLOWED_TAGS = bleach.ALLOWED_TAGS + ['br', 'caption', 'colgroup', 'div', 'figcaption', 'figure', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr',
+                                      'iframe', 'img', 'mathjax', 'p', 'pre', 'span', 'style', 'sub', 'sup','table', 'tbody', 'tfoot',
+                                      'td', 'th', 'thead', 'tr']
+ALLOWED_ATTRS = dict([(tag, list(attrs)) for tag, attrs in bleach.ALLOWED_ATTRIBUTES.items()] +
+                     {'*' : ['class', 'id', 'align', 'style', 'role', 'data-target', 'data-ride', 'data-slide-to', 'data-slide', 'data-interval'],
+                      'img': ['alt', 'src', 'title', 'width', 'height'],
+                      'iframe' : ['width', 'height', 'src', 'frameborder', 'allowfullscreen'],
+                      'style' : ['type']}.items())
+SANITIZER_REVISION = 1             # Bump it when changing how SanitizeExtension works
+RENDERER_VERSION = hashlib.md5(repr((MD_EXTENSIONS, sorted(ALLOWED_TAGS), sorted(ALLOWED_ATTRS.items()),
+                                     SANITIZER_REVISION, markdown.version, bleach.__version__))).hexdigest()[:8]
+
+# The policy actually handed to bleach, built once. Attribute lists are tuples with the '*' ones
+# already merged in: bleach does "allowed += wildcard" on whatever it finds in the dict, which
+# on a list would grow it in place on every call (and from every thread).
+SANITIZER_TAGS = frozenset(ALLOWED_TAGS)
+SANITIZER_ATTRS = dict((tag, tuple(attrs) + tuple(ALLOWED_ATTRS['*']) if tag != '*' else tuple(attrs))
+                       for tag, attrs in ALLOWED_ATTRS.items())
+
+
+# Rendered markdown is cached in two levels: a small LRU local to this instance and memcache,
+# shared by all instances. Keys are a hash of the source text, wiki_p_id and RENDERER_VERSION.
+MD_CACHE_SIZE = 2000               # Entries kept in the instance's LRU cache (see md_blocks)
+MD_MEMCACHE_NAMESPACE = "md"
+MD_MEMCACHE_TIME = 7 * 86400       # In seconds
+MD_MEMCACHE_MAX_BYTES = 1000000 - 1024     # Memcache refuses larger values, those are only kept locally
+
+_md_cache = collections.OrderedDict()
+_md_cache_lock = threading.Lock()
+
+def md_cache_key(value, wiki_p_id = ""):
+    if isinstance(value, unicode): value = value.encode("utf-8")
+    return "%s:%s" % (RENDERER_VERSION, hashlib.sha1("%s|%s" % (wiki_p_id, value)).hexdigest())
+
+def _md_local_get(key):
+    with _md_cache_lock:
+        html = _md_cache.pop(key, None)
+        if html is not None: _md_cache[key] = html    # Move to the most recently used end
+    return html
+
+def _memcacheable_p(html):
+    return len(html.encode("utf-8") if isinstance(html, unicode) else html) <= MD_MEMCACHE_MAX_BYTES
+
+def _md_cache_get(key, local_only = False):
+    html = _md_local_get(key)
+    if html is None and not local_only:
+        html = memcache.get(key, namespace = MD_MEMCACHE_NAMESPACE)
+        if html is not None: _md_cache_set(key, html, local_only = True)
+    return html
+
+def _md_cache_set(key, html, local_only = False):
+    with _md_cache_lock:
+        _md_cache[key] = html
+        while len(_md_cache) > MD_CACHE_SIZE:
+            _md_cache.popitem(last = False)
+    if not local_only and _memcacheable_p(html):
+        memcache.set(key, html, time = MD_MEMCACHE_TIME, namespace = MD_MEMCACHE_NAMESPACE)
+
+
+# Sanitization is done on Markdown's element tree, applying the same policy bleach would: tags
+# in SANITIZER_TAGS, attributes in SANITIZER_ATTRS, no URIs with unknown protocols and styles
+# run through bleach's sanitize_css. Markdown only builds a known set of elements, so this is
+# enough unless there is raw html (stored aside by Markdown and pasted back after serializing)
+# or something we can't reproduce exactly on the tree. In those cases the whole output goes
+# through bleach.clean as before.
+URI_ATTRS = frozenset(BleachSanitizerMixin.attr_val_is_uri)
+URI_PROTOCOLS = frozenset(BleachSanitizerMixin.allowed_protocols)
+URI_STRIP_RE = re.compile(u"[`\000-\040\177-\240\s]+")
+URI_SCHEME_RE = re.compile(r'^[a-z0-9][-+.a-z0-9]*:')
+ENTITY_ONLY_RE = re.compile(r'^&[\#a-zA-Z0-9]*;$')     # Markdown stores these as raw html too
+
+_css_sanitizer = BleachSanitizerMixin()
+_css_sanitizer.allowed_css_properties = bleach.ALLOWED_STYLES
+
+def allowed_uri_p(value):
+    value = URI_STRIP_RE.sub('', unescape(value)).lower().replace(u"\ufffd", "")
+    return not (URI_SCHEME_RE.match(value) and value.split(':')[0] not in URI_PROTOCOLS)
+
+class SanitizeTreeprocessor(markdown.treeprocessors.Treeprocessor):
+    def __init__(self, md, extension):
+        markdown.treeprocessors.Treeprocessor.__init__(self, md)
+        self.extension = extension
+
+    def run(self, root):
+        for el in root.getiterator():
+            if el.tag not in SANITIZER_TAGS:        # bleach escapes them, also catches comments
+                self.extension.needs_bleach_p = True
+                return
+            allowed = SANITIZER_ATTRS.get(el.tag, SANITIZER_ATTRS['*'])
+            for name, value in el.items():
+                if name != name.lower():            # html5lib would lowercase it first
+                    self.extension.needs_bleach_p = True
+                    return
+                if name not in allowed or (name in URI_ATTRS and not allowed_uri_p(value)):
+                    del el.attrib[name]
+                elif name == 'style':
+                    el.set(name, _css_sanitizer.sanitize_css(value))
+
+class SanitizePostprocessor(markdown.postprocessors.Postprocessor):
+    def __init__(self, md, extension):
+        markdown.postprocessors.Postprocessor.__init__(self, md)
+        self.extension = extension
+
+    def run(self, text):
+        raw_html_p = any(not safe and not ENTITY_ONLY_RE.match(html)
+                         for html, safe in self.markdown.htmlStash.rawHtmlBlocks)
+        if raw_html_p or self.extension.needs_bleach_p:
+            return bleach.clean(text.strip(), tags = SANITIZER_TAGS, attributes = SANITIZER_ATTRS)
+        return text
+
+class SanitizeExtension(markdown.Extension):
+    "Must be the last extension so that it sees the final tree and output."
+    needs_bleach_p = False
+
+    def extendMarkdown(self, md, md_globals):
+        md.treeprocessors.add('sanitize', SanitizeTreeprocessor(md, self), '_end')
+        md.postprocessors.add('sanitize', SanitizePostprocessor(md, self), '_end')
+        md.registerExtension(self)
+
+    def reset(self):
+        self.needs_bleach_p = False
+
+def sanitizer_policy():
+    "The policy above as plain lists, for the previews rendered on the browser (js/markdown_preview.js)."
+    return {"tags" : sorted(SANITIZER_TAGS),
+            "attrs" : dict((tag, sorted(attrs)) for tag, attrs in SANITIZER_ATTRS.items()),
+            "uri_attrs" : sorted(URI_ATTRS),
+            "uri_protocols" : sorted(URI_PROTOCOLS)}
+
+
+# Building a Markdown instance loads and configures every extension, so each thread keeps its own
+# and resets it between documents (instances are not safe to share with threadsafe: true).
+_md_local = threading.local()
+
+def get_markdown():
+    "Returns this thread's Markdown instance, ready to convert a new document."
+    engine = getattr(_md_local, "engine", None)
+    if engine is None:
+        engine = _md_local.engine = markdown.Markdown(extensions = MD_EXTENSIONS + [SanitizeExtension()])
+    else:
+        engine.reset()
+        # The abbr extension adds a pattern per abbreviation defined and reset() leaves them there
+        for key in [k for k in engine.inlinePatterns.keys() if k.startswith('abbr-')]:
+            del engine.inlinePatterns[key]
+    return engine
+
+def render_md(value, wiki_p_id = ""):
+    "Does the actual (uncached) markdown rendering and sanitization. You probably want md(...) instead."
+    value = DOI_RE.sub(make_doi_link, value)     # doi links
+    if wiki_p_id: value = WIKILINKS_RE_COMPILED.sub(make_sub_repl(wiki_p_id), value)
+    return get_markdown().convert(value)
+
+def md(value, wiki_p_id = "", local_only = False):
+    """wiki_p_id is the project id and should only be present when rendering a wiki page. This is used to generate the 'wikilinks'.
+    With local_only the html is only cached in this instance, not in memcache: for text that won't be seen again, like previews."""
+    if not value: return u''
+    key = md_cache_key(value, wiki_p_id)
+    html = _md_cache_get(key, local_only)
+    if html is None:
+        html = render_md(value, wiki_p_id)
+        _md_cache_set(key, html, local_only)
+    return html
+
+def md_multi(values, wiki_p_id = "", local_only = False):
+    "Same as [md(v, wiki_p_id) for v in values] but with a single memcache call for the ones not cached locally."
+    keys = [md_cache_key(v, wiki_p_id) for v in values]
+    html = {}
+    for key in keys:
+        h = _md_local_get(key)
+        if h is not None: html[key] = h
+    missing = [key for key in keys if key not in html]
+    if missing and not local_only:
+        found = memcache.get_multi(missing, namespace = MD_MEMCACHE_NAMESPACE)
+        for key, h in found.items(): _md_cache_set(key, h, local_only = True)
+        html.update(found)
+    rendered = {}
+    for key, value in zip(keys, values):
+        if key not in html:
+            html[key] = rendered[key] = render_md(value, wiki_p_id) if value else u''
+            _md_cache_set(key, html[key], local_only = True)
+    rendered = dict((key, h) for key, h in rendered.items() if _memcacheable_p(h))
+    if rendered and not local_only:
+        memcache.set_multi(rendered, time = MD_MEMCACHE_TIME, namespace = MD_MEMCACHE_NAMESPACE)
+    return [html[key] for key in keys]
+
+
+# Incremental rendering for long documents (wiki pages, writings). The source is split in top
+# level blocks that are rendered, and cached, one by one; so after editing a paragraph only its
+# block is rendered again. Document-wide things are stitched back together:
+#  - Reference links and abbreviations: their definitions are added to every block.
+#  - Footnotes: definitions are taken out of the blocks and rendered once, at the end where
+#    Markdown puts them. Blocks get stubs for the ones they use and are renumbered afterwards.
+#  - Header ids and [TOC]: ids made unique and the table of contents come from a document with
+#    only the headers. Equations are numbered by MathJax on the browser, over the whole page.
+# When a document can't be split safely md_blocks renders it whole with md(...).
+MD_BLOCKS_MIN_SIZE = 4096          # Shorter documents are rendered whole
+
+FENCE_RE = re.compile(r'^(~{3,}|`{3,})[ ]*(\{?\.?[a-zA-Z0-9_+-]*\}?)?[ ]*$')
+LIST_ITEM_RE = re.compile(r'^([*+-]|\d+\.)[ \t]')
+HTML_BLOCK_RE = re.compile(r'^<(!--|[a-zA-Z][a-zA-Z0-9]*)')
+HEADER_RE = re.compile(r'^#')
+SETEXT_RE = re.compile(r'^(=+|-+)[ ]*$')
+HEADER_ID_RE = re.compile(r'(<h[1-6]\b[^>]*?\bid=")([^"]*)(")')
+TOC_DIV_RE = re.compile(r'<div class="toc">.*?</div>', re.DOTALL)
+FOOTNOTES_DIV = u'<div class="footnote">'
+FOOTNOTE_REF_RE = re.compile(r'\[\^([^\]]*)\]')
+FOOTNOTE_LINK_RE = re.compile(r'(<a\b[^>]*\bhref="#fn:([^"]*)"[^>]*>)\d+(</a>)')
+ATTR_ID_RE = re.compile(r'\{:?[^}\n]*#')       # attr_list ids can clash with the header ones
+RAW_TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)(?:\s[^<>]*)?(/?)>')
+CODE_SPAN_RE = re.compile(r'(`+).+?\1', re.DOTALL)
+VOID_TAGS = frozenset(["area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"])
+BLOCKS_UNSAFE = ["///Footnotes Go Here///"]
+
+def md_chunks(lines):
+    "Splits lines into chunks separated by blank lines, keeping fenced code together. Yields (blank_lines_before, lines)."
+    chunk, blanks, fence = [], 0, None
+    for line in lines:
+        if fence:
+            if line.rstrip(' ') == fence: fence = None
+            chunk.append(line)
+        elif not line.strip():
+            if chunk:
+                yield blanks, chunk
+                chunk, blanks = [], 0
+            blanks += 1
+        else:
+            m = FENCE_RE.match(line)
+            if m: fence = m.group(1)
+            chunk.append(line)
+    if chunk: yield blanks, chunk
+
+def block_start_p(chunk):
+    "Can this chunk be rendered on its own? (It can't continue a list, quote, definition list, etc.)"
+    line = chunk[0]
+    if len(chunk) > 1 and chunk[1][:1] == ':': return False
+    return not line[0].isspace() and line[0] not in '>:' and not LIST_ITEM_RE.match(line)
+
+def definitions_p(chunk):
+    "Does the chunk have a definition list? Markdown joins it with one right before it."
+    return any(line[:1] == ':' for line in chunk[1:])
+
+def raw_tags_closed_p(block):
+    """Is every raw html tag in the block closed within it? An unclosed one takes in what follows,
+    once sanitized, so the html of the document isn't the one of its blocks. Code isn't looked at."""
+    lines, fence = [], None
+    for line in block.split("\n"):
+        if fence:
+            if line.rstrip(' ') == fence: fence = None
+            continue
+        m = FENCE_RE.match(line)
+        if m: fence = m.group(1)
+        else: lines.append(line)
+    open_tags = collections.Counter()
+    for closing, tag, self_closing in RAW_TAG_RE.findall(CODE_SPAN_RE.sub('', "\n".join(lines))):
+        tag = tag.lower()
+        if self_closing or tag in VOID_TAGS: continue
+        open_tags[tag] += -1 if closing else 1
+        if open_tags[tag] < 0: return False
+    return not any(open_tags.values())
+
+def html_block_closed_p(chunk):
+    "None if the chunk doesn't start a raw html block, otherwise whether the block ends with the chunk."
+    m = HTML_BLOCK_RE.match(chunk[0])
+    if not m: return None
+    tag = m.group(1).lower()
+    if tag != '!--' and not markdown.util.isBlockLevel(tag): return None
+    end = chunk[-1].rstrip().lower()
+    return end.endswith('-->') if tag == '!--' else end.endswith('</%s>' % tag)
+
+def split_md_blocks(value):
+    """Returns (blocks, footnotes, definitions) as text, or None when value can't be split safely.
+    definitions are the references and abbreviations used by every block."""
+    if any(marker in value for marker in BLOCKS_UNSAFE) or ATTR_ID_RE.search(value): return None
+    lines = value.replace("\r\n", "\n").replace("\r", "\n").expandtabs(4).split("\n")
+    blocks, fn_lines, definitions = [], [], []
+    in_footnote, definitions_before_p = False, False
+    for blanks, chunk in md_chunks(lines):
+        if in_footnote and chunk[0][:4] == "    ":
+            fn_lines.extend([""] * blanks + chunk)
+            continue
+        in_footnote = False
+        fenced_p = FENCE_RE.match(chunk[0]) is not None
+        n_definitions = len(definitions)
+        for i, line in enumerate(chunk):
+            if fenced_p: break
+            if footnotes.DEF_RE.match(line):
+                fn_lines.extend([""] + chunk[i:])
+                chunk, in_footnote = chunk[:i], True
+                break
+            if markdown.preprocessors.ReferencePreprocessor.RE.match(line) or abbr.ABBR_REF_RE.match(line):
+                definitions.append(line)
+                if i + 1 < len(chunk) and markdown.preprocessors.ReferencePreprocessor.TITLE_RE.match(chunk[i + 1]):
+                    definitions.append(chunk[i + 1])
+        if not chunk: continue
+        closed_p = html_block_closed_p(chunk)
+        if closed_p is False: return None
+        if definitions_p(chunk):
+            if definitions_before_p: return None
+            definitions_before_p = True
+        else:
+            definitions_before_p = False
+        # Markdown removes the definitions, so a chunk with only those doesn't end a list or a quote
+        only_definitions_p = len(definitions) - n_definitions == len(chunk)
+        if blocks and (only_definitions_p or not block_start_p(chunk)):
+            blocks[-1].extend([""] * blanks + chunk)
+        else:
+            blocks.append(chunk)
+    blocks = ["\n".join(b) for b in blocks]
+    if not all(raw_tags_closed_p(b) for b in blocks): return None
+    return blocks, "\n".join(fn_lines).strip(), "\n".join(definitions)
+
+def md_headers(block):
+    "The header lines of a block, as markdown."
+    lines, headers, fence = block.split("\n"), [], None
+    for i, line in enumerate(lines):
+        if fence:
+            if line.rstrip(' ') == fence: fence = None
+            continue
+        m = FENCE_RE.match(line)
+        if m: fence = m.group(1)
+        elif HEADER_RE.match(line):
+            headers.append(line)
+        elif i + 1 < len(lines) and line.strip() and SETEXT_RE.match(lines[i + 1]):
+            headers.append(line + "\n" + lines[i + 1])
+    return headers
+
+def md_blocks(value, wiki_p_id = "", local_only = False):
+    "Same output as md(value, wiki_p_id) but rendering (and caching) long documents block by block."
+    if not value: return u''
+    if len(value) < MD_BLOCKS_MIN_SIZE: return md(value, wiki_p_id, local_only)
+    key = md_cache_key(value, wiki_p_id)
+    html = _md_cache_get(key, local_only)
+    if html is not None: return html
+    html = _md_blocks(value, wiki_p_id, local_only)
+    if html is None: html = render_md(value, wiki_p_id)
+    _md_cache_set(key, html, local_only)
+    return html
+
+def _md_blocks(value, wiki_p_id, local_only = False):
+    split = split_md_blocks(value)
+    if split is None: return None
+    blocks, fn_source, definitions = split
+    numbers = collections.OrderedDict()
+    for line in fn_source.split("\n"):
+        m = footnotes.DEF_RE.match(line)
+        if m: numbers.setdefault(m.group(1), len(numbers) + 1)
+    def stubs(block):
+        # Only for the footnotes used in the block, their numbers are fixed afterwards
+        used = set(FOOTNOTE_REF_RE.findall(block)) if block is not None else numbers
+        return ["[^%s]: ." % label for label in numbers if label in used]
+    def context(block):
+        text = "\n\n".join([definitions] + stubs(block)).strip()
+        return "\n\n" + text if text else ""
+    sources = [b + context(b) for b in blocks]
+    headers = sum([md_headers(b) for b in blocks], [])
+    headers_p = bool(headers) or "[TOC]" in value
+    if headers_p:
+        sources.append("[TOC]\n\n" + "\n\n".join(headers) + context(None))
+    if fn_source:
+        sources.append(fn_source + ("\n\n" + definitions if definitions else ""))
+    rendered = md_multi(sources, wiki_p_id, local_only)
+    fn_html = rendered.pop() if fn_source else u''
+    headers_html = rendered.pop() if headers_p else u''
+    rendered = [h[:h.rfind(FOOTNOTES_DIV)].rstrip() if stubs(b) and FOOTNOTES_DIV in h else h
+                for b, h in zip(blocks, rendered)]
+    html = u"\n".join(h for h in rendered if h)
+    def renumber(m):
+        if "footnote-ref" not in m.group(1) or m.group(2) not in numbers: return m.group(0)
+        return "%s%s%s" % (m.group(1), numbers[m.group(2)], m.group(3))
+    html = FOOTNOTE_LINK_RE.sub(renumber, html)
+    # Header ids are unique within each block; take the ones for the whole document instead.
+    ids = [m.group(2) for m in HEADER_ID_RE.finditer(headers_html)]
+    if len(ids) != len(HEADER_ID_RE.findall(html)): return None
+    ids.reverse()
+    html = HEADER_ID_RE.sub(lambda m: m.group(1) + ids.pop() + m.group(3), html)
+    if TOC_DIV_RE.search(html):
+        toc = TOC_DIV_RE.search(headers_html)
+        if not toc: return None
+        html = TOC_DIV_RE.sub(lambda m: toc.group(0), html)
+    if fn_html: html += u"\n" + fn_html
+    return html
@@ -4,13 +4,15 @@
 from google.appengine.ext import ndb
 import generic, projects, secrets, groups
 
+THREADS_PER_PAGE = 20
+
 
 ###########################
 ##   Datastore Objects   ##
 ###########################
 
 # Each ForumThread should have a project as parent.
-class ForumThreads(ndb.Model):
+class ForumThreads(generic.RenderedMarkdown, generic.ChildCounters, ndb.Model):
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
     title = ndb.StringProperty(required = True)
     content = ndb.TextProperty(required = True)
@@ -18,21 +20,25 @@ class ForumThreads(ndb.Model):
     date = ndb.DateTimeProperty(auto_now = True)
     last_updated = ndb.DateTimeProperty(auto_now = True)
     open_p = ndb.BooleanProperty(default = True)
+    comments_count = ndb.IntegerProperty(required = False, indexed = False)
+    counters = {"comments_count" : "ForumComments"}
 
     def get_number_of_comments(self):
-        return ForumComments.query(ancestor = self.key).count()
+        return self.get_count("comments_count")
 
     def is_open_p(self):
         return self.open_p
 
 # each ForumComment should have a ForumThread as parent.
-class ForumComments(ndb.Model):
+class ForumComments(generic.RenderedMarkdown, ndb.Model):
+    md_source = "comment"
+    parent_counter = "comments_count"
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
     comment = ndb.TextProperty(required = True)
 
     def is_open_p(self):
-        return self.key.parent().get().open_p
+        return generic.item_open_p(self.key)
 
 
 ######################
@@ -44,8 +50,7 @@ class ForumPage(projects.ProjectPage):
         projects.ProjectPage.render(self, forum_tab_class = "active", *a, **kw)
 
     def get_threads(self, project, log_message = ''):
-        self.log_read(ForumComments, "Fetching all the thread in a project's forum. ")
-        return ForumThreads.query(ancestor = project.key).order(-ForumThreads.last_updated).fetch()
+        return self.fetch_page(ForumThreads.query(ancestor = project.key).order(-ForumThreads.last_updated), THREADS_PER_PAGE, log_message)
 
     def get_thread(self, project, threadid, log_message = ''):
         self.log_read(ForumThreads, log_message)
@@ -68,7 +73,8 @@ class MainPage(ForumPage):
             self.error(404)
             self.render("404.html", info = 'Project with key <em>%s</em> not found' % projectid)
             return
-        self.render("forum_main.html", project = project, user = user, items = self.get_threads(project))
+        items, pager = self.get_threads(project)
+        self.render("forum_main.html", project = project, user = user, items = items, pager = pager)
 
 
 class NewThreadPage(ForumPage):
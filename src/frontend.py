@@ -7,13 +7,9 @@ import bibliography, code, collab_writing, datasets, forum, images, notebooks, w
 class RootPage(generic.GenericPage):
     def get(self):
         user = self.get_login_user()
-        projects = user.list_of_projects() if user else []
-        p_updates = []
-        if user:
-            for p in projects:
-                p_updates += p.list_updates(self, user)          # I query more items than needed... there should be a smart way to do this.
-        p_updates.sort(key=lambda u: u.date, reverse = True)
-        self.render("root.html", user = user, projects = projects, p_updates = p_updates[:30], show_project_p = True)
+        project_list = user.list_of_projects() if user else []
+        p_updates = projects.merge_updates(self, project_list, user) if user else []
+        self.render("root.html", user = user, projects = project_list, p_updates = p_updates, show_project_p = True)
 
 
 class UnderConstructionPage(generic.GenericPage):
@@ -39,11 +35,15 @@ class OverviewPage(projects.ProjectPage):
             self.error(404)
             self.render("404.html", info = 'Project with key <em>%s</em> not found' % projectid)
             return
-        updates = project.list_updates(self, user, projects.UPDATES_TO_DISPLAY)
-        intro_p = (not updates) and user and user.list_of_projects() and (len(user.list_of_projects()) == 1)  # Display the intro if the project is new and its the only one.
+        show = self.request.get("show")
+        kinds = dict((name, kinds) for name, label, kinds in projects.UPDATE_FILTERS).get(show)
+        updates = project.list_updates(self, user, projects.UPDATES_TO_DISPLAY, kinds)
+        intro_p = (not updates) and (not kinds) and user and user.list_of_projects() and (len(user.list_of_projects()) == 1)  # Display the intro if the project is new and its the only one.
         self.render("project_overview.html", project = project, 
                     overview_tab_class = "active",
                     authors = project.list_of_authors(self),
                     updates = updates,
+                    update_filters = projects.UPDATE_FILTERS,
+                    show = show if kinds else "",
                     intro_p = intro_p,
                     visitor_p = not (user and project.user_is_author(user)))
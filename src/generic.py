@@ -4,10 +4,11 @@
 
 import webapp2
 import jinja2
-import os, re, string, hashlib, logging, datetime, json
+import os, re, string, hashlib, logging, datetime, time, json, difflib
 from google.appengine.ext import ndb, db, blobstore
 from google.appengine.ext.webapp import blobstore_handlers
-from google.appengine.api import urlfetch
+from google.appengine.api import urlfetch, memcache, datastore_errors, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from webapp2_extras import auth, sessions
 
 import filters, secrets
@@ -17,6 +18,25 @@ jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir), a
 
 DEBUG = True             # Debug messages using logging.debug
 SALT_LENGTH = 16
+LOGIN_COOKIE = "user_id"             # Signed with the user's salt, see get_user_by_cookies
+LEGACY_LOGIN_COOKIE = "username"     # Login cookies used to carry the username instead
+LOGIN_COOKIE_MAXAGE = 2 * 604800     # In seconds; 604800s = 1 week
+USER_INDEXES_MIGRATION = "user_indexes"
+REVISION_METADATA_MIGRATION = "revision_metadata"
+SIDEBAR_MEMCACHE_NAMESPACE = "sidebar"
+SIDEBAR_MEMCACHE_TIME = 3600         # In seconds, Projects and Groups also clear it when written
+PAGE_SIZE = 20                       # Default number of items in a page of a list, see GenericPage.fetch_page
+VISIBILITY_MEMCACHE_NAMESPACE = "visibility"
+VISIBILITY_MEMCACHE_TIME = 86400     # In seconds, forget_visibility clears them when a setting changes
+ROOTS_MEMCACHE_NAMESPACE = "roots"
+ROOTS_MEMCACHE_TIME = 600            # In seconds, the longest a copy from CachedRoot.get_cached can be stale
+LOCAL_TASK_QUEUE = None              # Set it to a list and enqueue appends the tasks there instead, e.g. for tests
+REVISION_SNAPSHOT_INTERVAL = 10      # Every this many revisions one is stored whole, see Revision
+REVISIONS_MEMCACHE_NAMESPACE = "revisions"
+REVISIONS_MEMCACHE_TIME = 86400      # In seconds, a revision never changes once written
+MEMBERSHIPS_MIGRATION = "memberships"
+MEMBERSHIPS_MEMCACHE_NAMESPACE = "memberships"
+MEMBERSHIPS_MEMCACHE_TIME = 86400    # In seconds, join clears them
 
 jinja_env.filters['md'] = filters.md
 
@@ -53,12 +73,505 @@ def get_secure_val(h, salt):
         return val
     return None
 
+# Done migrations are remembered for the life of the instance
+_completed_migrations = set()
+
+def migration_done_p(name):
+    if name not in _completed_migrations:
+        if not CompletedMigrations.get_by_id(name): return False
+        _completed_migrations.add(name)
+    return True
+
+def username_key(username):
+    return ndb.Key(UniqueUsernames, username.strip().lower())
+
+def email_key(email):
+    return ndb.Key(UniqueEmails, email.strip().lower())
+
+def get_unique_owners(username = None, email = None):
+    """Keys of the users (registered or unverified) holding username and email, or None. A single
+    get_multi, until maintenance.BackfillUserIndexes has run it falls back to queries."""
+    keys = [username_key(username) if username else None, email_key(email) if email else None]
+    indexes = iter(ndb.get_multi([k for k in keys if k]))
+    owners = []
+    for k in keys:
+        i = next(indexes) if k else None
+        owners.append(i.owner if i else None)
+    if not migration_done_p(USER_INDEXES_MIGRATION):
+        for i, (prop, value) in enumerate([("username", username), ("email", email)]):
+            if value and not owners[i]:
+                owners[i] = (RegisteredUsers.query(getattr(RegisteredUsers, prop) == value).get(keys_only = True) or
+                             UnverifiedUsers.query(getattr(UnverifiedUsers, prop) == value).get(keys_only = True))
+    return owners[0], owners[1]
+
+def get_user_by_username(username):
+    owner = get_unique_owners(username = username)[0]
+    return owner.get() if owner and owner.kind() == "RegisteredUsers" else None
+
+def get_user_by_email(email):
+    owner = get_unique_owners(email = email)[1]
+    return owner.get() if owner and owner.kind() == "RegisteredUsers" else None
+
+@ndb.transactional(xg = True)
+def put_user_p(user, old_username = None, old_email = None, replaces = None):
+    """Writes user (a RegisteredUsers or UnverifiedUsers) and points the username and email indexes to
+    it, dropping the ones for old_username and old_email. replaces is the key of an UnverifiedUsers
+    it takes over from, which is deleted along with what it held. Returns False, writing nothing, if
+    someone else holds the username or email."""
+    claims = [(UniqueUsernames, username_key(user.username))]
+    if user.email: claims.append((UniqueEmails, email_key(user.email)))
+    releases = [username_key(old_username) if old_username else None, email_key(old_email) if old_email else None]
+    replaced = replaces.get() if replaces else None
+    if replaced: releases += [username_key(replaced.username), email_key(replaced.email)]
+    indexes = ndb.get_multi([key for model, key in claims])
+    if any(i and i.owner not in (user.key, replaces) for i in indexes): return False
+    user.put()
+    ndb.put_multi([model(key = key, owner = user.key) for model, key in claims])
+    claimed = [key for model, key in claims]
+    ndb.delete_multi([key for key in set(releases) if key and key not in claimed] + ([replaces] if replaces else []))
+    return True
+
+# Where each kind of project item is shown, below the project's path. "{id}" is the item's id,
+# "{pid}" and "{gid}" the ones of its parent and grandparent, "{url}" the url of its wiki page.
+ACTIVITY_PATHS = {"Notebooks" : "notebooks/{id}", "NotebookNotes" : "notebooks/{pid}/{id}", "NoteComments" : "notebooks/{gid}/{pid}",
+                  "CodeRepositories" : "code/{id}", "CodeComments" : "code/{pid}",
+                  "DataSets" : "datasets/{id}", "DataConcepts" : "datasets/{pid}/{id}", "DataRevisions" : "datasets/{gid}/{pid}",
+                  "WikiPages" : "wiki/page/{url}", "WikiRevisions" : "wiki/page/{url}", "WikiComments" : "wiki/talk/{url}",
+                  "CollaborativeWritings" : "writings/{id}", "WritingRevisions" : "writings/{pid}",
+                  "WritingComments" : "writings/{pid}/discussion",
+                  "ForumThreads" : "forum/{id}", "ForumComments" : "forum/{pid}",
+                  "BiblioItems" : "bibliography/{id}", "BiblioComments" : "bibliography/{pid}",
+                  "Images" : "images"}
+
+def activity_snapshot(item, author, project):
+    """What project_activity.html shows about an update, so that feeds are rendered without reading
+    anything else: the item's kind, title and path, the ones of its parent and grandparent, the
+    project's name and the author's username and avatar. Taken when the update is written."""
+    ancestors = [item.key.parent(), item.key.parent() and item.key.parent().parent()]
+    ancestors = ndb.get_multi([k for k in ancestors if k and k != project.key])
+    entities = [item] + ancestors + [None] * (2 - len(ancestors))
+    wiki_page = ([e for e in entities if e and e.key.kind() == "WikiPages"] + [None])[0]
+    def title(e):
+        if not e: return None
+        return e.url.replace("_", " ") if e.key.kind() == "WikiPages" else getattr(e, "title", None) or getattr(e, "name", None)
+    def path(e):
+        if not (e and e.key.kind() in ACTIVITY_PATHS): return None
+        ids = [k.integer_id() if k else None for k in (e.key, e.key.parent(), e.key.parent() and e.key.parent().parent())]
+        return ACTIVITY_PATHS[e.key.kind()].format(id = ids[0], pid = ids[1], gid = ids[2],
+                                                   url = wiki_page.url if wiki_page else None)
+    return {"kind" : item.key.kind(),
+            "title" : title(item), "path" : path(item),
+            "parent_title" : title(entities[1]), "parent_path" : path(entities[1]),
+            "grandparent_title" : title(entities[2]), "grandparent_path" : path(entities[2]),
+            "project_name" : project.name,
+            "author" : author.username, "avatar" : author.get_profile_image(20)}
+
+def allocate_key(item):
+    """Gives item a key with an allocated id if it doesn't have one yet, so the entities that refer to
+    it can be built before it is written. Returns the key."""
+    if not (item.key and item.key.id()):
+        parent = item.key.parent() if item.key else None
+        first, last = item.allocate_ids(1, parent = parent)
+        if isinstance(item, ChildCounters): item.init_counters()
+        item.key = ndb.Key(item.__class__, first, parent = parent)
+    return item.key
+
+def put_reported(item, reports, others = [], atomic_p = False):
+    """Writes item, the entities reporting it (activities and updates, built with its key from
+    allocate_key) and others in a single batch, instead of a round trip each. If item's model has a
+    parent_counter (see ChildCounters) the count in its parent is incremented in a transaction along
+    with item and the rest of its entity group, while the other groups are written in parallel. With
+    atomic_p everything goes in a single cross-group transaction instead. Returns the parent as
+    written with its new count, or None."""
+    counter = getattr(item, "parent_counter", None)
+    if counter:
+        # The parent is written by the transaction, with its new count
+        others = [e for e in others if e.key != item.key.parent()]
+    rest = reports + others
+    if DEBUG: logging.debug("DB WRITE: Writing an instance of %s with %s more entities in a batch. %s"
+                            % (item.__class__.__name__, len(rest), "Incrementing %s in its parent. " % counter if counter else ""))
+    if atomic_p:
+        return ndb.transaction(lambda: put_counted_with(item, counter, rest), xg = True)
+    if not counter:
+        ndb.put_multi([item] + rest)
+        return None
+    apart = [e for e in rest if e.key.root() != item.key.root()]
+    futures = ndb.put_multi_async(apart)
+    parent = ndb.transaction(lambda: put_counted_with(item, counter, [e for e in rest if e.key.root() == item.key.root()]))
+    for f in futures: f.get_result()
+    return parent
+
+def put_and_enqueue(item, others, url, params, more_writes = None):
+    """Writes item, incrementing its parent's count if it has a parent_counter (see ChildCounters), and
+    others in a transaction that also queues a task for url with params. The task only runs if they
+    are written, so it can do the writes that don't need to happen before the response. This is a
+    single commit unless others are in other entity groups. more_writes, if given, is called first
+    thing in the transaction (again if it is retried) and what it returns is written as well, so what
+    it reads in item's entity group can't change before that commit. Returns the parent as written,
+    or None."""
+    counter = getattr(item, "parent_counter", None)
+    if counter: others = [e for e in others if e.key != item.key.parent()]
+    if DEBUG: logging.debug("DB WRITE: Writing an instance of %s with %s more entities and queueing %s. "
+                            % (item.__class__.__name__, len(others), url))
+    def txn():
+        parent = put_counted_with(item, counter, others + (more_writes() if more_writes else []))
+        enqueue(url, params, transactional_p = True)
+        return parent
+    return ndb.transaction(txn, xg = any(e.key.root() != item.key.root() for e in others))
+
+def enqueue(url, params, transactional_p = False):
+    "Queues a task, or appends it to LOCAL_TASK_QUEUE if set. Tasks are POSTs and should be under /cron/."
+    if LOCAL_TASK_QUEUE is not None:
+        LOCAL_TASK_QUEUE.append((url, params))
+        return
+    taskqueue.add(url = url, params = params, transactional = transactional_p)
+
+def put_counted_with(item, counter, entities):
+    # Call it within a transaction
+    parent = item.key.parent().get() if counter else None
+    if parent and getattr(parent, counter) is not None: setattr(parent, counter, getattr(parent, counter) + 1)
+    ndb.put_multi([item] + ([parent] if parent else []) + entities)
+    return parent
+
+# Whether a project item is publicly visible depends on a single setting: the project's wiki_open_p
+# for wiki items, otherwise is_open_p of the top level item holding it (notebook, dataset...).
+def visibility_key(item_key):
+    "The key of the entity holding the setting that decides whether the item with item_key is visible."
+    pairs = item_key.pairs()
+    return ndb.Key(pairs = pairs[:1] if pairs[1][0] == "WikiPages" else pairs[:2])
+
+def visibility_settings(vkeys):
+    """Whether the settings of these visibility keys (see visibility_key) are open, as a dict. They are
+    memcached, and the ones that aren't are fetched in a single batch."""
+    vkeys = list(set(vkeys))
+    cached = memcache.get_multi([k.urlsafe() for k in vkeys], namespace = VISIBILITY_MEMCACHE_NAMESPACE)
+    settings = dict((k, cached[k.urlsafe()]) for k in vkeys if k.urlsafe() in cached)
+    missing = [k for k in vkeys if k not in settings]
+    if not missing: return settings
+    if DEBUG: logging.debug("DB READ: Fetching the visibility settings of %s items. " % len(missing))
+    for k, e in zip(missing, ndb.get_multi(missing)):
+        if not e:
+            settings[k] = False
+        elif k.kind() == "Projects":
+            settings[k] = e.wiki_open_p
+        else:
+            settings[k] = e.is_open_p() if hasattr(e, "is_open_p") else False
+    # add_multi doesn't overwrite, and fails for a few seconds after forget_visibility
+    # so a setting read right before it changed doesn't get cached
+    memcache.add_multi(dict((k.urlsafe(), settings[k]) for k in missing),
+                       time = VISIBILITY_MEMCACHE_TIME, namespace = VISIBILITY_MEMCACHE_NAMESPACE)
+    return settings
+
+def items_open_p(item_keys, memo = None):
+    """Whether the items with these keys are publicly visible, as a dict by key. Pass the same memo
+    dict to reuse the settings already looked up, as GenericPage.items_open_p does for a request."""
+    if memo is None: memo = {}
+    vkeys = dict((k, visibility_key(k)) for k in item_keys)
+    missing = [v for v in set(vkeys.values()) if v not in memo]
+    if missing: memo.update(visibility_settings(missing))
+    return dict((k, memo[v]) for k, v in vkeys.items())
+
+def item_open_p(item_key):
+    return items_open_p([item_key])[item_key]
+
+def forget_visibility(vkey):
+    "Call it after the setting of vkey (see visibility_key) changes."
+    memcache.delete(vkey.urlsafe(), seconds = 5, namespace = VISIBILITY_MEMCACHE_NAMESPACE)
+
+def after_commit(callback):
+    "Calls callback once the current transaction commits, or right away outside of one."
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(callback)
+    else:
+        callback()
+
+def clear_sidebar_cache(user_keys):
+    "Forgets the navigation bar lists (see RegisteredUsers.sidebar_async) of these users."
+    if user_keys: memcache.delete_multi([str(k.id()) for k in user_keys], namespace = SIDEBAR_MEMCACHE_NAMESPACE)
+
+# Who is in which project or group is kept in Memberships. Both ways are keys only queries, memcached.
+@ndb.tasklet
+def memberships_of_async(user_key):
+    "The keys of the projects and groups user_key is in, oldest first."
+    ctx = ndb.get_context()
+    name = "user:" + user_key.urlsafe()
+    keys = yield ctx.memcache_get(name, namespace = MEMBERSHIPS_MEMCACHE_NAMESPACE)
+    if keys is None:
+        if DEBUG: logging.debug("DB READ: Fetching the projects and groups of a user. ")
+        memberships = yield Memberships.query(ancestor = user_key).order(Memberships.date).fetch_async(keys_only = True)
+        keys = [ndb.Key(urlsafe = k.id()) for k in memberships]
+        # Doesn't overwrite, and fails for a few seconds after forget_memberships, see visibility_settings
+        yield ctx.memcache_add(name, keys, time = MEMBERSHIPS_MEMCACHE_TIME, namespace = MEMBERSHIPS_MEMCACHE_NAMESPACE)
+    raise ndb.Return(keys)
+
+def members_of(target_key):
+    "The keys of the users in the project or group with target_key, the first to join first."
+    name = "target:" + target_key.urlsafe()
+    keys = memcache.get(name, namespace = MEMBERSHIPS_MEMCACHE_NAMESPACE)
+    if keys is None:
+        if DEBUG: logging.debug("DB READ: Fetching the users in %s. " % target_key)
+        # Not an ancestor query, so it may miss the latest ones for a moment. The seconds in
+        # forget_memberships keep that from being cached.
+        memberships = Memberships.query(Memberships.target == target_key).order(Memberships.date).fetch(keys_only = True)
+        keys = [k.parent() for k in memberships]
+        memcache.add(name, keys, time = MEMBERSHIPS_MEMCACHE_TIME, namespace = MEMBERSHIPS_MEMCACHE_NAMESPACE)
+    return keys
+
+def forget_memberships(user_keys, target_keys):
+    "Call it after the memberships of these users in these projects or groups change."
+    names = ["user:" + k.urlsafe() for k in user_keys] + ["target:" + k.urlsafe() for k in target_keys]
+    memcache.delete_multi(names, seconds = 5, namespace = MEMBERSHIPS_MEMCACHE_NAMESPACE)
+    clear_sidebar_cache(user_keys)
+
+def join(user, target, role):
+    "Makes user a member of target, a project or group, with role. Returns False if it already was."
+    key = Memberships.key_for(user.key, target.key)
+    if key.get(): return False
+    if DEBUG: logging.debug("DB WRITE: Adding a user to an instance of %s as %s. " % (target.__class__.__name__, role))
+    Memberships(key = key, target = target.key, role = role).put()
+    forget_memberships([user.key], [target.key])
+    user._membership_keys = None
+    return True
+
+def get_user_by_cookies(cookies):
+    """Returns the logged in user (or None) and whether it came from a legacy cookie. The login
+    cookie has the user's id so it's a get_by_id, served from ndb's caches most of the time."""
+    cookie = cookies.get(LOGIN_COOKIE)
+    if cookie:
+        user_id = cookie.split("|")[0]
+        if not user_id.isdigit(): return None, False
+        u = RegisteredUsers.get_by_id(int(user_id))
+        if u and get_secure_val(cookie, u.salt): return u, False
+        return None, False
+    cookie = cookies.get(LEGACY_LOGIN_COOKIE)
+    if not cookie: return None, False
+    u = get_user_by_username(cookie.split("|")[0])
+    if u and get_secure_val(cookie, u.salt): return u, True
+    return None, False
+
 
 
 ###########################
 ##   Datastore Objects   ##
 ###########################
 
+# Mixin for models holding markdown text (use it before ndb.Model in the bases). The sanitized html
+# is rendered once when the entity is written and stored in rendered_html, stamped with the
+# filters.RENDERER_VERSION used. md_source is the name of the property holding the markdown.
+class RenderedMarkdown(object):
+    md_source = "content"
+    md_blocks_p = False                   # Render block by block, for long documents that are edited in parts
+    rendered_html = ndb.TextProperty(required = False, compressed = True)
+    rendered_version = ndb.StringProperty(required = False, indexed = False)
+
+    def md_wiki_p_id(self):
+        "Override in wiki models to return the project id used for the wikilinks."
+        return ""
+
+    def md_text(self):
+        return getattr(self, self.md_source)
+
+    def render_markdown(self):
+        render = filters.md_blocks if self.md_blocks_p else filters.md
+        self.rendered_html = render(self.md_text(), self.md_wiki_p_id())
+        self.rendered_version = filters.RENDERER_VERSION
+
+    def rendered_p(self):
+        return (self.rendered_html is not None) and (self.rendered_version == filters.RENDERER_VERSION)
+
+    def content_html(self):
+        # Entities written before this existed, or with an older renderer, are rendered here
+        # but not written back: some kinds have auto_now dates that a put would change.
+        if not self.rendered_p(): self.render_markdown()
+        return self.rendered_html
+
+    def _pre_put_hook(self):
+        self.render_markdown()
+        super(RenderedMarkdown, self)._pre_put_hook()
+
+
+# Mixin for models that keep how many children of some kinds they have, instead of counting them
+# on every page. counters maps the name of each IntegerProperty to the kind it counts, and that
+# kind names the property in its parent_counter so put_reported increments it. Entities written
+# before a counter existed hold None and are counted with a query until maintenance.ReconcileCounters
+# has gone through them.
+class ChildCounters(object):
+    counters = {}
+
+    def get_count(self, counter):
+        count = getattr(self, counter)
+        if count is None: count = ndb.Query(kind = self.counters[counter], ancestor = self.key).count()
+        return count
+
+    def init_counters(self):
+        for counter in self.counters:
+            if getattr(self, counter) is None: setattr(self, counter, 0)
+
+    def _pre_put_hook(self):
+        # New entities, allocate_key already did it for the ones it gave an id to
+        if not (self.key and self.key.id()): self.init_counters()
+        super(ChildCounters, self)._pre_put_hook()
+
+
+# Mixin for root entities that most pages only read, like Projects and Groups (use it before ndb.Model
+# in the bases). get_cached returns a copy with only the cached_fields, kept in memcache with the
+# version the entity had. Every write bumps the version, so older copies are never returned. If the
+# version itself gets evicted a copy can be stale, but never for longer than ROOTS_MEMCACHE_TIME.
+# The copies are read only: writing one would drop the properties it doesn't have.
+class CachedRoot(object):
+    cached_fields = []
+    read_only_p = False
+
+    @classmethod
+    def cache_keys(cls, entity_id):
+        return ["%s:%s" % (cls.__name__, entity_id), "%s:%s:version" % (cls.__name__, entity_id)]
+
+    @classmethod
+    def get_cached(cls, entity_id):
+        copy_key, version_key = cls.cache_keys(entity_id)
+        cached = memcache.get_multi([copy_key, version_key], namespace = ROOTS_MEMCACHE_NAMESPACE)
+        version = cached.get(version_key)
+        if version is None:
+            # Starting from the time, not 0, so a lost version doesn't match the copies made before
+            memcache.add(version_key, int(time.time() * 1000), namespace = ROOTS_MEMCACHE_NAMESPACE)
+            version = memcache.get(version_key, namespace = ROOTS_MEMCACHE_NAMESPACE)
+        elif copy_key in cached and cached[copy_key]["version"] == version:
+            return cls.from_cached(entity_id, cached[copy_key])
+        if DEBUG: logging.debug("DB READ: Fetching an instance of %s to cache it. " % cls.__name__)
+        entity = cls.get_by_id(entity_id)
+        if not entity: return None
+        values = dict((f, getattr(entity, f)) for f in cls.cached_fields)
+        if version is not None:
+            memcache.set(copy_key, dict(values, version = version), time = ROOTS_MEMCACHE_TIME, namespace = ROOTS_MEMCACHE_NAMESPACE)
+        return cls.from_cached(entity_id, values)
+
+    @classmethod
+    def from_cached(cls, entity_id, values):
+        copy = cls(id = entity_id, **dict((f, values[f]) for f in cls.cached_fields))
+        copy.read_only_p = True
+        return copy
+
+    def _pre_put_hook(self):
+        assert not self.read_only_p, "A copy from %s.get_cached can't be written. " % self.__class__.__name__
+        super(CachedRoot, self)._pre_put_hook()
+
+    def _post_put_hook(self, future):
+        # In a transaction the hook runs before the commit, a reader in between would cache the old entity
+        # under the new version
+        copy_key, version_key = self.cache_keys(self.key.id())
+        after_commit(lambda: memcache.incr(version_key, initial_value = int(time.time() * 1000), namespace = ROOTS_MEMCACHE_NAMESPACE))
+        super(CachedRoot, self)._post_put_hook(future)
+
+
+# Mixin for the revisions of a document (use it before ndb.Model in the bases), with author, date and
+# summary properties. Each one is written with its RevisionMetadata (see writes_with), so history
+# pages list those instead of reading every revision with its whole content.
+# Revisions of a document are stored as reverse deltas: the newest one keeps its whole content
+# and each older one only the delta that rebuilds it from the next newer revision (its base).
+# Every REVISION_SNAPSHOT_INTERVAL revisions one is kept whole as well, so rebuilding any
+# revision applies fewer deltas than that. Subclasses need content and date properties.
+# Unlike the current pages (see RenderedMarkdown) revisions don't store their html, it would take as
+# much as the revisions themselves: the few ever viewed are rendered then, through the md cache.
+class Revision(object):
+    delta = ndb.JsonProperty(required = False, compressed = True)
+    base = ndb.KeyProperty(required = False, indexed = False)
+    deltas_behind = ndb.IntegerProperty(required = False, indexed = False)    # Deltas right before this whole revision
+
+    def delta_p(self):
+        return self.content is None
+
+    def get_content(self):
+        if not self.delta_p(): return self.content
+        cache_key = self.key.urlsafe()
+        content = memcache.get(cache_key, namespace = REVISIONS_MEMCACHE_NAMESPACE)
+        if content is not None: return content
+        chain = [self]
+        while chain[-1].delta_p():
+            if DEBUG: logging.debug("DB READ: Fetching the base of a %s. " % self.__class__.__name__)
+            chain.append(chain[-1].base.get())
+        content = chain.pop().content
+        for revision in reversed(chain):
+            content = apply_delta(content, revision.delta)
+        memcache.set(cache_key, content, time = REVISIONS_MEMCACHE_TIME, namespace = REVISIONS_MEMCACHE_NAMESPACE)
+        return content
+
+    def md_wiki_p_id(self):
+        "Override in wiki models to return the project id used for the wikilinks."
+        return ""
+
+    def content_html(self):
+        return filters.md_blocks(self.get_content(), self.md_wiki_p_id())
+
+    def drop_rendered_html(self):
+        """Revisions written when they were RenderedMarkdown still hold the properties it stores.
+        Drops them, so the next put doesn't write them back. Returns whether there were any."""
+        names = [n for n in ["rendered_html", "rendered_version"] if n in self._values]
+        for n in names:
+            del self._values[n]
+            self._properties.pop(n, None)     # The model has no such property, ndb made up one for this entity
+        return bool(names)
+
+    def follow(self, previous):
+        """Call it on a new revision before writing it, with the one that was the newest (or None).
+        Returns previous if it should be stored as a delta against this one, written along with
+        this one (see store_as_delta and writes_with), or None if it stays whole."""
+        self.deltas_behind = 0
+        if not previous or previous.delta_p(): return None
+        behind = (previous.deltas_behind or 0) + 1
+        if behind >= REVISION_SNAPSHOT_INTERVAL: return None
+        self.deltas_behind = behind
+        return previous
+
+    def writes_with(self):
+        """What is written along with this new revision, in the same transaction because it reads the
+        newest revision so far (see follow): its metadata and that revision stored as a delta against
+        this one, if it should be. Pass it as the more_writes of put_and_enqueue."""
+        model = self.__class__
+        previous = self.follow(model.query(ancestor = self.key.parent()).order(-model.date).get())
+        if self.date is None: self.date = datetime.datetime.now()      # For the metadata, auto_now_add leaves it
+        return [self.metadata()] + ([previous.store_as_delta(self)] if previous else [])
+
+    def store_as_delta(self, newer, newer_content = None):
+        """Replaces the content with a delta against newer, which must be written already or in the
+        same transaction. Pass newer_content if newer is itself stored as a delta. Returns self."""
+        self.delta = make_delta(newer.content if newer_content is None else newer_content, self.content)
+        self.base = newer.key
+        self.content = None
+        self.deltas_behind = None
+        return self
+
+    def metadata(self):
+        return RevisionMetadata(parent = self.key.parent(), id = self.key.id(),
+                                author = self.author, date = self.date, summary = self.summary)
+
+
+# A delta is a list of [i, j] (copy lines i to j of the base) and strings (insert them).
+def make_delta(base, target):
+    a, b = base.splitlines(True), target.splitlines(True)
+    delta = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk = False).get_opcodes():
+        if tag == "equal":
+            delta.append([i1, i2])
+        elif j2 > j1:
+            delta.append("".join(b[j1:j2]))
+    return delta
+
+def apply_delta(base, delta):
+    lines = base.splitlines(True)
+    return "".join(op if isinstance(op, basestring) else "".join(lines[op[0]:op[1]]) for op in delta)
+
+
+def get_revisions_page(handler, document, revision_model, page_size, log_message = ''):
+    """A page of the history of document, newest first, with handler.fetch_page. These are
+    RevisionMetadata, with the same id as their revisions, or the revisions themselves until
+    maintenance.BackfillRevisionMetadata is done."""
+    if migration_done_p(REVISION_METADATA_MIGRATION):
+        query = RevisionMetadata.query(ancestor = document.key).order(-RevisionMetadata.date)
+    else:
+        query = revision_model.query(ancestor = document.key).order(-revision_model.date)
+    return handler.fetch_page(query, page_size, log_message)
+
+
 # User related stuff.
 
 class UnverifiedUsers(ndb.Model):
@@ -74,16 +587,35 @@ class RegisteredUsers(ndb.Model):
     salt = ndb.StringProperty(required = True)
     email = ndb.StringProperty(required = False)
     about_me = ndb.TextProperty(required = False)
-    my_projects = ndb.KeyProperty(repeated = True)                   # keys to Projects (defined in projects.py)
-    my_groups = ndb.KeyProperty(repeated = True)                     # keys to Groups (defined in groups.py)
+    # Keys to Projects and Groups (defined in projects.py and groups.py). Now in Memberships,
+    # maintenance.MoveMemberships empties them.
+    my_projects = ndb.KeyProperty(repeated = True)
+    my_groups = ndb.KeyProperty(repeated = True)
     profile_image_url = ndb.StringProperty(required = False)
     gplusid = ndb.StringProperty(required = False)
     gplus_profile_json = ndb.JsonProperty(required = False)
 
+    _membership_keys = None
+
+    @ndb.tasklet
+    def membership_keys_async(self):
+        "The keys of the user's projects and groups, see memberships_of_async. Looked up once per instance."
+        if self._membership_keys is None:
+            keys = yield memberships_of_async(self.key)
+            legacy = self.my_projects + self.my_groups
+            self._membership_keys = legacy + [k for k in keys if k not in legacy]
+        raise ndb.Return(self._membership_keys)
+
+    def project_keys(self):
+        return [k for k in self.membership_keys_async().get_result() if k.kind() == "Projects"]
+
+    def group_keys(self):
+        return [k for k in self.membership_keys_async().get_result() if k.kind() == "Groups"]
+
     def list_of_projects(self):
         projects_list = []
-        for p_key in self.my_projects:
-            project = p_key.get()
+        project_keys = self.project_keys()
+        for p_key, project in zip(project_keys, ndb.get_multi(project_keys)):
             if project:
                 projects_list.append(project)
             else:
@@ -95,8 +627,8 @@ class RegisteredUsers(ndb.Model):
 
     def list_of_groups(self):
         groups_list = []
-        for g_key in self.my_groups:
-            group = g_key.get()
+        group_keys = self.group_keys()
+        for g_key, group in zip(group_keys, ndb.get_multi(group_keys)):
             if group:
                 groups_list.append(group)
             else:
@@ -106,6 +638,28 @@ class RegisteredUsers(ndb.Model):
             groups_list.sort(key=lambda g: g.last_updated, reverse=True)
         return groups_list
 
+    @ndb.tasklet
+    def sidebar_async(self):
+        """The user's projects and groups for the navigation bar, as dicts with name, id and last_updated
+        and the most recently updated first. Fetched with a single get_multi and kept in memcache, where
+        writing a project or group clears it (see clear_sidebar_cache)."""
+        ctx = ndb.get_context()
+        keys = yield self.membership_keys_async()
+        sidebar = yield ctx.memcache_get(str(self.key.id()), namespace = SIDEBAR_MEMCACHE_NAMESPACE)
+        if sidebar and sidebar["keys"] == keys: raise ndb.Return(sidebar)
+        entities = yield ndb.get_multi_async(keys)
+        sidebar = {"keys" : keys, "projects" : [], "groups" : []}
+        for i, (key, e) in enumerate(zip(keys, entities)):
+            if e:
+                sidebar["projects" if key.kind() == "Projects" else "groups"].append(
+                    {"name" : e.name, "id" : key.integer_id(), "last_updated" : e.last_updated})
+            else:
+                logging.warning("RegisteredUser with key (%s) contains a broken reference to %s" % (self.key, key))
+        for items in (sidebar["projects"], sidebar["groups"]):
+            items.sort(key = lambda item: item["last_updated"], reverse = True)
+        yield ctx.memcache_set(str(self.key.id()), sidebar, time = SIDEBAR_MEMCACHE_TIME, namespace = SIDEBAR_MEMCACHE_NAMESPACE)
+        raise ndb.Return(sidebar)
+
     def set_gplus_profile(self):
         assert self.gplusid
         try:
@@ -147,8 +701,9 @@ class RegisteredUsers(ndb.Model):
                                              UserActivities.date > (datetime.datetime.now() - datetime.timedelta(days=days)),
                                              ancestor = self.key).fetch()
         counts = {}
+        open_p = {} if self_user_p else items_open_p([a.item for a in actvs])
         for a in actvs:
-            if self_user_p or a.is_open_p():
+            if self_user_p or open_p[a.item]:
                 if a.relative_to in counts:
                     counts[a.relative_to] += 1
                 else:
@@ -156,38 +711,78 @@ class RegisteredUsers(ndb.Model):
         return counts
 
 
+# Usernames and emails are unique. These are keyed by the normalized value (see username_key and
+# email_key) and point to the RegisteredUsers or UnverifiedUsers holding it, so looking a user up is
+# a strongly consistent get. Kept up to date by put_user_p.
+class UniqueUsernames(ndb.Model):
+    owner = ndb.KeyProperty(required = True)
+
+
+class UniqueEmails(ndb.Model):
+    owner = ndb.KeyProperty(required = True)
+
+
+# See Revision. Has the same parent (the document) and id as the revision it describes.
+class RevisionMetadata(ndb.Model):
+    author = ndb.KeyProperty(kind = RegisteredUsers, required = True)
+    date = ndb.DateTimeProperty(required = True)
+    summary = ndb.TextProperty(required = False)
+
+
+# Migrations already run by maintenance.BatchJob, keyed by name
+class CompletedMigrations(ndb.Model):
+    date = ndb.DateTimeProperty(auto_now_add = True)
+
+
 # Each Notification should have as parent a RegisteredUser, this parent is the one who will receive the notification
 class EmailNotifications(ndb.Model):
     author = ndb.KeyProperty(kind = RegisteredUsers)
     category = ndb.StringProperty(required = True)
-    html = ndb.TextProperty(required = True)
-    txt = ndb.TextProperty(required = False)
+    html = ndb.TextProperty(required = True, compressed = True)
+    txt = ndb.TextProperty(required = False, compressed = True)
     sent = ndb.BooleanProperty(required = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
 
 
+# One for each user in a project or group, with the user as parent and the urlsafe key of the project
+# or group as id. So the ones of a user are a keys only ancestor query, and the users in a project
+# or group one on target. See memberships_of_async and members_of.
+class Memberships(ndb.Model):
+    target = ndb.KeyProperty(required = True)
+    role = ndb.StringProperty(required = True)          # "author" of a project or "member" of a group
+    date = ndb.DateTimeProperty(auto_now_add = True)
+
+    @classmethod
+    def key_for(cls, user_key, target_key):
+        return ndb.Key(cls, target_key.urlsafe(), parent = user_key)
+
+
 # Each UserActivity should have a RegisteredUser as parent
 class UserActivities(ndb.Model):
     date = ndb.DateTimeProperty(auto_now_add = True)
     actv_kind = ndb.StringProperty(required = True)  # Wether is a "Project" update or, in the future, something else
     relative_to = ndb.KeyProperty(required = True) # For now this is only the project the activity is related to. In the future might be something else
     item = ndb.KeyProperty(required = True)
+    snapshot = ndb.JsonProperty(required = False)  # See activity_snapshot, only for "Projects" activities
+
+    def get_snapshot(self):
+        # Older activities don't have one until maintenance.BackfillActivitySnapshots gets to them.
+        # None if their item, author or project is gone, those aren't shown.
+        if self.snapshot is None:
+            item, author, project = ndb.get_multi([self.item, self.key.parent(), self.relative_to])
+            if not (item and author and project): return None
+            self.snapshot = activity_snapshot(item, author, project)
+        return self.snapshot
 
     def description_html(self, hide_username_p = False, show_project_p = True):
         html = ''
-        relative_to = self.relative_to.get()
-        author = self.key.parent().get()
-        if relative_to.__class__.__name__ == "Projects":
-            html = render_str("project_activity.html", author = author, item = self.item, project = relative_to,
+        if self.actv_kind == "Projects" and self.get_snapshot():
+            html = render_str("project_activity.html", s = self.get_snapshot(), project_id = self.relative_to.integer_id(),
                               hide_username_p = hide_username_p, show_project_p = show_project_p)
         return html
 
     def is_open_p(self):
-        try:
-            val = self.item.get().is_open_p()
-        except:
-            val = False
-        return val
+        return item_open_p(self.item)
 
 
 ######################
@@ -202,6 +797,30 @@ class GenericPage(webapp2.RequestHandler):
                                 % (self.__class__.__name__, dbmodel.__name__, message))
         return
 
+    def fetch_page(self, query, page_size = PAGE_SIZE, log_message = ''):
+        """Fetches the page of query (which must be ordered) given by the "page" request parameter, an
+        url-safe cursor, so any page costs the same to read as the first one. Returns its entities and
+        the pager for pager.html: the "next_page" token, and the "prev_page" one if "prev_p"."""
+        token = self.request.get("page")
+        try:
+            cursor = Cursor(urlsafe = token) if token else None
+        except datastore_errors.BadValueError:
+            cursor = None
+        self.log_read(ndb.Model._lookup_model(query.kind), "Fetching a page with %s results. %s" % (page_size, log_message))
+        items, next_cursor, more_p = query.fetch_page(page_size, start_cursor = cursor)
+        pager = {"next_page" : next_cursor.urlsafe() if (more_p and next_cursor) else None,
+                 "prev_p" : False,
+                 "prev_page" : None}
+        if cursor:
+            # The previous page is found reading back from the same cursor with the query reversed
+            reverse = ndb.Query(kind = query.kind, ancestor = query.ancestor, filters = query.filters,
+                                orders = query.orders.reversed())
+            self.log_read(ndb.Model._lookup_model(query.kind), "Fetching the keys of the previous page. ")
+            prev_keys, prev_cursor, prev_more_p = reverse.fetch_page(page_size, start_cursor = cursor.reversed(), keys_only = True)
+            pager["prev_p"] = bool(prev_keys)
+            if prev_more_p and prev_cursor: pager["prev_page"] = prev_cursor.reversed().urlsafe()
+        return items, pager
+
     # Writing the Datastore
     def log_and_put(self, instance, message = ''):
         if DEBUG: logging.debug("DB WRITE: Handler %s is writing an instance of %s. %s"
@@ -239,22 +858,39 @@ class GenericPage(webapp2.RequestHandler):
 
     # Users
     def get_login_user(self):
-        cookie = self.request.cookies.get("username")
-        if not cookie: return None
-        cookie_username = cookie.split("|")[0]
-        self.log_read(RegisteredUsers, "Getting logged in user. ")
-        u = RegisteredUsers.query(RegisteredUsers.username == cookie_username).get()
-        if not u: return None
-        if not get_secure_val(cookie, u.salt): return None
-        return u
+        # Looked up once, then kept in the request's registry for the rest of the dispatch
+        if "login_user" not in self.request.registry:
+            self.log_read(RegisteredUsers, "Getting logged in user. ")
+            u, legacy_p = get_user_by_cookies(self.request.cookies)
+            if legacy_p: self.set_login_cookie(u)
+            self.request.registry["login_user"] = u
+            # Pages will need the navigation bar, fetched while the handler does its own work
+            if u and self.request.method == "GET": self.request.registry["sidebar"] = u.sidebar_async()
+        return self.request.registry["login_user"]
+
+    def set_login_cookie(self, user):
+        self.set_cookie(LOGIN_COOKIE, str(user.key.integer_id()), user.salt, max_age = LOGIN_COOKIE_MAXAGE)
+        self.remove_cookie(LEGACY_LOGIN_COOKIE)
+        self.request.registry["login_user"] = user
+        self.request.registry.pop("sidebar", None)
+
+    def remove_login_cookie(self):
+        self.remove_cookie(LOGIN_COOKIE)
+        self.remove_cookie(LEGACY_LOGIN_COOKIE)
+        self.request.registry["login_user"] = None
+        self.request.registry.pop("sidebar", None)
 
     def get_user_by_username(self, username, log_message = ''):
         self.log_read(RegisteredUsers, log_message)
-        return RegisteredUsers.query(RegisteredUsers.username == username).get()
+        return get_user_by_username(username)
 
     def get_user_by_email(self, email, log_message = ''):
         self.log_read(RegisteredUsers, log_message)
-        return RegisteredUsers.query(RegisteredUsers.email == email).get()
+        return get_user_by_email(email)
+
+    def items_open_p(self, item_keys):
+        "See items_open_p, the settings are looked up once per request."
+        return items_open_p(item_keys, self.request.registry.setdefault("visibility", {}))
 
     # Rendering
     def write(self, *a, **kw):
@@ -271,8 +907,12 @@ class GenericPage(webapp2.RequestHandler):
         kw["GOOGLE_PLUS_PAGE"] = GOOGLE_PLUS_PAGE
         kw['user'] = self.get_login_user()
         if kw["user"]:
-            kw["list_of_projects"] = kw["user"].list_of_projects()
-            kw["list_of_groups"]   = kw["user"].list_of_groups()
+            sidebar = self.request.registry.pop("sidebar", None)
+            sidebar = sidebar.get_result() if sidebar else None
+            if not (sidebar and sidebar["keys"] == kw["user"].membership_keys_async().get_result()):
+                sidebar = kw["user"].sidebar_async().get_result()       # Not started or the user changed since
+            kw["list_of_projects"] = sidebar["projects"]
+            kw["list_of_groups"]   = sidebar["groups"]
         self.write(self.render_str(template, **kw))
 
     # for simpleauth
@@ -319,22 +959,25 @@ class GenericBlobstoreUpload(blobstore_handlers.BlobstoreUploadHandler):
 
     # Users
     def get_login_user(self):
-        cookie = self.request.cookies.get("username")
-        if not cookie: return None
-        cookie_username = cookie.split("|")[0]
-        self.log_read(RegisteredUsers, "Getting logged in user. ")
-        u = RegisteredUsers.query(RegisteredUsers.username == cookie_username).get()
-        if not u: return None
-        if not get_secure_val(cookie, u.salt): return None
-        return u
+        # Legacy cookies are replaced on the next GenericPage request, uploads have no cookie helpers
+        if "login_user" not in self.request.registry:
+            self.log_read(RegisteredUsers, "Getting logged in user. ")
+            self.request.registry["login_user"] = get_user_by_cookies(self.request.cookies)[0]
+        return self.request.registry["login_user"]
 
     def get_user_by_username(self, username, log_message = ''):
         self.log_read(RegisteredUsers, log_message)
-        return RegisteredUsers.query(RegisteredUsers.username == username).get()
+        return get_user_by_username(username)
 
 
 class RenderPreview(GenericPage):
+    def get(self):
+        # The sanitizer policy, previews are rendered on the browser when possible
+        self.response.headers["Content-Type"] = "application/json"
+        self.write(json.dumps(filters.sanitizer_policy()))
+
     def post(self):
         content = self.request.get("content")
         wiki_p_id = self.request.get("wiki_p_id")
-        self.write(filters.md(content, wiki_p_id))
+        # A preview per keystroke, in memcache they would evict the html of saved content
+        self.write(filters.md_blocks(content, wiki_p_id, local_only = True))
@@ -1,6 +1,7 @@
 # groups.py
 # For creating, managing and updating groups.
 
+import logging
 from datetime import datetime, timedelta
 from google.appengine.ext import ndb
 import generic, email_messages, projects
@@ -8,22 +9,29 @@ import bibliography   # I should move stuff from bibliography to a more generic
 
 UPDATES_TO_DISPLAY = 30           # number of updates to display in the Overview tab
 DATETIME_STR = "%d.%m.%Y %H:%M"   # For converting to and from python's datetime and datetimepicker.js
+MESSAGES_PER_PAGE = 20            # number of messages in a page of the board
 
 ###########################
 ##   Datastore Objects   ##
 ###########################
 
-class Groups(ndb.Model):
+class Groups(generic.CachedRoot, ndb.Model):
     name         = ndb.StringProperty(required = True)
     description  = ndb.TextProperty(required = False)
-    members      = ndb.KeyProperty(repeated = True)
+    members      = ndb.KeyProperty(repeated = True)     # Now in generic.Memberships, maintenance.MoveMemberships empties it
     started      = ndb.DateTimeProperty(auto_now_add = True)
     last_updated = ndb.DateTimeProperty(auto_now = True)
+    cached_fields = ["name", "description", "members", "started", "last_updated"]     # See generic.CachedRoot
+
+    def _post_put_hook(self, future):
+        # The members' navigation bars show the name and are sorted by last_updated. After the commit as CachedRoot's.
+        generic.after_commit(lambda: generic.clear_sidebar_cache(self.member_keys()))
+        super(Groups, self)._post_put_hook(future)
 
     def list_members(self):
         members_list = []
-        for u_key in self.members:
-            member = u_key.get()
+        member_keys = self.member_keys()
+        for u_key, member in zip(member_keys, ndb.get_multi(member_keys)):
             if member:
                 members_list.append(member)
             else:
@@ -31,18 +39,24 @@ class Groups(ndb.Model):
                                 % (self.key, u_key))
         return members_list
 
+    _member_keys = None
+
+    def member_keys(self):
+        "The members, see generic.members_of, looked up once per instance. add_member keeps it up to date."
+        if self._member_keys is None:
+            self._member_keys = self.members + [k for k in generic.members_of(self.key) if k not in self.members]
+        return self._member_keys
+
     def user_is_member(self, user):
-        result = False
-        for u_key in self.members:
-            if user.key == u_key: result = True
-        return result
+        # From the user's memberships, see Projects.user_is_author
+        if not user: return False
+        return user.key in self.members or self.key in user.membership_keys_async().get_result()
 
     def add_member(self, requesting_handler, user):
-        if user.key in self.members: return False
-        self.members.append(user.key)
-        requesting_handler.log_and_put(self, "Adding a new member. ")
-        user.my_groups.append(self.key)
-        requesting_handler.log_and_put(user, "Adding a new group to my_groups property")
+        if self.user_is_member(user): return False
+        # Neither the group nor the user are written
+        generic.join(user, self, "member")
+        if self._member_keys is not None: self._member_keys = self._member_keys + [user.key]
         return True
 
     def list_updates(self, requesting_handler, n = UPDATES_TO_DISPLAY):
@@ -104,20 +118,31 @@ class GroupBoardMessages(ndb.Model):
 ######################
 
 class GroupPage(generic.GenericPage):
+    cached_group_p = True       # GET handlers only read the group, so they get a cached copy
+
     def get_group(self, group_id, log_message = ''):
-        self.log_read(Groups, log_message)
-        return Groups.get_by_id(int(group_id))
-
-    def put_and_report(self, item, author, group, other_to_update = None):
-        self.log_and_put(item)
-        # Log user activity
-        u_activity = generic.UserActivities(parent = author.key, item = item.key, relative_to = project.key, actv_kind = "Groups")
-        self.log_and_put(u_activity)
-        # Log group update
-        g_update = GroupUpdates(parent = group.key, author = author.key, item = item.key)
-        self.log_and_put(g_update)
-        self.log_and_put(group)
-        if other_to_update: self.log_and_put(other_to_update)
+        # Fetched once per request, later calls get the same instance
+        fetched = self.request.registry.setdefault("groups", {})
+        if int(group_id) not in fetched:
+            if self.cached_group_p and self.request.method == "GET":
+                fetched[int(group_id)] = Groups.get_cached(int(group_id))
+            else:
+                self.log_read(Groups, log_message)
+                fetched[int(group_id)] = Groups.get_by_id(int(group_id))
+        return fetched[int(group_id)]
+
+    def render(self, template, **kw):
+        # Templates check member_p instead of calling group.user_is_member(user) again
+        if kw.get("group") and "member_p" not in kw:
+            kw["member_p"] = kw["group"].user_is_member(self.get_login_user())
+        generic.GenericPage.render(self, template, **kw)
+
+    def put_and_report(self, item, author, group, other_to_update = None, atomic_p = False):
+        # The item, its user activity and group update, the group and other_to_update in one batch
+        generic.allocate_key(item)
+        reports = [generic.UserActivities(parent = author.key, item = item.key, relative_to = group.key, actv_kind = "Groups"),
+                   GroupUpdates(parent = group.key, author = author.key, item = item.key)]
+        generic.put_reported(item, reports, [group] + ([other_to_update] if other_to_update else []), atomic_p)
         return
 
     def get_message(self, group, messageid):
@@ -147,7 +172,7 @@ class NewGroupPage(generic.GenericPage):
         groups = Groups.query(Groups.name == kw["g_name"]).fetch()
         if groups:
             for g in groups:
-                if user.key in g.members:
+                if g.user_is_member(user):
                     have_error = True
                     kw["error"] = "You are already in a group named " + kw["g_name"]
                     kw["name_class"] = "has-error"
@@ -155,11 +180,9 @@ class NewGroupPage(generic.GenericPage):
             self.render("group_new.html", **kw)
         else:
             group = Groups(name = kw["g_name"],
-                           description = kw["g_description"],
-                           members = [user.key])
+                           description = kw["g_description"])
             group.put()
-            user.my_groups.append(group.key)
-            user.put()
+            generic.join(user, group, "member")
             self.redirect("/g/%s" % group.key.integer_id())
 
 class ViewGroupPage(GroupPage):
@@ -331,7 +354,7 @@ class AdminPage(GroupPage):
                 kw["error_message"] = "No username <em>%s</em> found" % kw["username"]
             elif not group.user_is_member(user):
                 kw["error_message"] = "You are not a member of this group"
-            elif invited_user.key in group.members:
+            elif group.user_is_member(invited_user):
                 kw["error_message"] = "%s is already a member of %s" % (invited_user.username.capitalize(), group.name)
             else:
                 email_messages.send_invitation_to_group(group = group,
@@ -344,6 +367,8 @@ class AdminPage(GroupPage):
 
 
 class InvitedPage(GroupPage):
+    cached_group_p = False      # Adds the invited member
+
     def get(self, groupid):
         user = self.get_login_user()
         if not user:
@@ -432,7 +457,7 @@ class SendBiblioNotifications(GroupPage):
                 if bib.last_updated > one_week_ago:
                     items.append(bib)
             if items:
-                for user in group.members:
+                for user in group.member_keys():
                     email_messages.send_group_biblio_notification(group = group, user = user.get(), bibitems = items)
                     
 class BoardPage(GroupPage):
@@ -448,8 +473,9 @@ class BoardPage(GroupPage):
         if not group:
             self.render("404.html", info = "Group %s not found." % groupid)
             return
-        messages = GroupBoardMessages.query(ancestor = group.key).order(-GroupBoardMessages.last_modified).fetch()
-        self.render("group_board.html", user = user, group = group, messages = messages)
+        messages, pager = self.fetch_page(GroupBoardMessages.query(ancestor = group.key).order(-GroupBoardMessages.last_modified),
+                                          MESSAGES_PER_PAGE)
+        self.render("group_board.html", user = user, group = group, messages = messages, pager = pager)
 
 
 class BoardPageNew(BoardPage):
@@ -41,10 +41,8 @@ class ImagesPage(projects.ProjectPage):
         self.log_read(Images, "Fetching all the images inside a project")
         return Images.query(ancestor = project.key).order(-Images.date).fetch(projection = [Images.date, Images.title])
 
-    def get_images_list(self, project, page = 0, log_message = ''):
-        assert type(page) == int
-        self.log_read(Images, "Fetching a page with %s results. %s" % (IMAGES_PER_PAGE, log_message))
-        return Images.query(ancestor = project.key).order(-Images.date).fetch_page(IMAGES_PER_PAGE, offset = IMAGES_PER_PAGE * page)
+    def get_images_list(self, project, log_message = ''):
+        return self.fetch_page(Images.query(ancestor = project.key).order(-Images.date), IMAGES_PER_PAGE, log_message)
 
     def get_image(self, project, imageid, log_message = ''):
         self.log_read(Images, log_message)
@@ -62,12 +60,8 @@ class MainPage(ImagesPage):
             self.error(404)
             self.render("404.html", info = 'Project with key <em>%s</em> not found' % projectid)
             return
-        kw = {"page" : self.request.get("page")}
-        try:
-            kw["page"] = int(kw["page"])
-        except ValueError:
-            kw["page"] = 0
-        kw["images"], kw["next_page_cursor"], kw["more_p"] = self.get_images_list(project, kw["page"])
+        kw = {}
+        kw["images"], kw["pager"] = self.get_images_list(project)
         self.render("images_main.html", project = project, user = user, **kw) 
 
 
@@ -229,6 +223,7 @@ class EditImage(projects.ProjectBlobstoreUpload):
             url = url + '?' + urllib.urlencode(kw)
             self.redirect(url)
         else:
+            visibility_changed_p = kw["open_p"] != image.open_p
             image.title = kw["i_title"]
             image.open_p = kw["open_p"]
             image.description = kw["i_description"]
@@ -236,6 +231,7 @@ class EditImage(projects.ProjectBlobstoreUpload):
                 blobstore.BlobInfo.get(image.image_key).delete()
                 image.image_key = new_image[0].key()
             image.put()
+            if visibility_changed_p: projects.update_visibility(image.key, image.open_p)
             self.redirect("/%s/images/" % projectid)
 
 
@@ -0,0 +1,473 @@
+# maintenance.py
+# Batched jobs to backfill and migrate existing entities. Each request processes a single batch
+# and queues the next one with a cursor. They are routed under /cron/ so only admins can run them,
+# as is the load test of concurrent writes to a project at the end.
+
+import contextlib, datetime, logging, json, threading, time
+from google.appengine.api import taskqueue, datastore_errors, users
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+import generic
+import bibliography, code, collab_writing, datasets, email_messages, forum, groups, notebooks, outreach, projects, wiki
+
+BATCH_SIZE = 100
+LOAD_TEST_WRITERS = 10      # Defaults of LoadTestProjectWrites
+LOAD_TEST_WRITES = 5        # per writer
+LOAD_TEST_ATTEMPTS = 6      # A commit that fails this many times is given up
+
+##########################
+##   Helper Functions   ##
+##########################
+
+# Rewriting an entity would otherwise bump its auto_now dates (e.g. BiblioItems.last_updated).
+# This only affects the current instance and only for the duration of the batch.
+@contextlib.contextmanager
+def auto_now_disabled(model):
+    props = [p for p in model._properties.values() if getattr(p, "_auto_now", False)]
+    for p in props: p._auto_now = False
+    try:
+        yield
+    finally:
+        for p in props: p._auto_now = True
+
+# What the datastore holds for a property: its value as loaded if it hasn't been read since,
+# or else what it would be written as (compressed or not, see ndb's BlobProperty).
+def stored_value(entity, prop):
+    value = entity._values.get(prop._name)
+    if isinstance(value, ndb.model._BaseValue): return value.b_val
+    return None if value is None else prop._call_to_base_type(value)
+
+def stored_bytes(value):
+    if value is None: return 0
+    if isinstance(value, ndb.model._CompressedValue): return len(value.z_val)
+    if isinstance(value, unicode): value = value.encode("utf-8")
+    return len(value)
+
+
+######################
+##   Web Handlers   ##
+######################
+
+class BatchJob(generic.GenericPage):
+    # Subclasses list the models to go through in order and define process_batch(model, entities)
+    models = []
+    batch_size = BATCH_SIZE
+    migration = None        # If set, recorded in generic.CompletedMigrations when the job finishes
+
+    def get(self):
+        kind_i = int(self.request.get("kind") or 0)
+        # Running totals that process_batch may keep, passed along to the next batch and reported at the end
+        self.stats = json.loads(self.request.get("stats") or "{}")
+        if kind_i >= len(self.models):
+            report = " ".join("%s: %s." % (k, v) for k, v in sorted(self.stats.items()))
+            logging.info("BATCH JOB: %s finished. %s" % (self.__class__.__name__, report))
+            if self.migration: self.log_and_put(generic.CompletedMigrations(id = self.migration))
+            self.write("Done. %s" % report)
+            return
+        model = self.models[kind_i]
+        cursor = self.request.get("cursor")
+        cursor = Cursor(urlsafe = cursor) if cursor else None
+        self.log_read(model, "Fetching a batch of %s for %s. " % (self.batch_size, self.__class__.__name__))
+        entities, next_cursor, more_p = model.query().fetch_page(self.batch_size, start_cursor = cursor)
+        self.process_batch(model, entities)
+        if more_p and next_cursor:
+            params = {"kind" : kind_i, "cursor" : next_cursor.urlsafe()}
+        else:
+            params = {"kind" : kind_i + 1}
+        if self.stats: params["stats"] = json.dumps(self.stats)
+        taskqueue.add(url = self.request.path, params = params, method = "GET")
+        self.write("Processed %s entities of kind %s. " % (len(entities), model.__name__))
+
+    def process_batch(self, model, entities):
+        raise NotImplementedError
+
+
+class BackfillRenderedHtml(BatchJob):
+    models = [notebooks.NotebookNotes, notebooks.NoteComments,
+              wiki.WikiPages, wiki.WikiComments, collab_writing.WritingComments,
+              forum.ForumThreads, forum.ForumComments,
+              code.CodeComments, outreach.OutreachPosts, bibliography.BiblioComments]
+
+    def process_batch(self, model, entities):
+        stale = [e for e in entities if not e.rendered_p()]
+        if not stale: return
+        if generic.DEBUG: logging.debug("DB WRITE: Handler %s is writing %s instances of %s. "
+                                        % (self.__class__.__name__, len(stale), model.__name__))
+        with auto_now_disabled(model):
+            ndb.put_multi(stale)      # RenderedMarkdown._pre_put_hook renders them
+
+
+class BackfillUserIndexes(BatchJob):
+    # Registered users go first so they keep a username or email also held by an unverified one
+    models = [generic.RegisteredUsers, generic.UnverifiedUsers]
+    migration = generic.USER_INDEXES_MIGRATION
+
+    def process_batch(self, model, entities):
+        claims = []
+        for e in entities:
+            claims.append((generic.UniqueUsernames, generic.username_key(e.username), e))
+            if e.email: claims.append((generic.UniqueEmails, generic.email_key(e.email), e))
+        if not claims: return
+        indexes = ndb.get_multi([key for index_model, key, e in claims])
+        missing = {}
+        for (index_model, key, e), index in zip(claims, indexes):
+            if index or key in missing:
+                owner = index.owner if index else missing[key].owner
+                if owner != e.key:
+                    logging.warning("BATCH JOB: %s is held by %s, not indexing it for %s. " % (key, owner, e.key))
+                continue
+            missing[key] = index_model(key = key, owner = e.key)
+        if not missing: return
+        if generic.DEBUG: logging.debug("DB WRITE: Handler %s is writing %s index entities for %s. "
+                                        % (self.__class__.__name__, len(missing), model.__name__))
+        ndb.put_multi(missing.values())
+
+
+class BackfillActivitySnapshots(BatchJob):
+    models = [projects.ProjectUpdates, generic.UserActivities]
+
+    def process_batch(self, model, entities):
+        stale = [e for e in entities if e.snapshot is None and (model is projects.ProjectUpdates or e.actv_kind == "Projects")]
+        if not stale: return
+        if model is projects.ProjectUpdates:
+            authors = [e.author for e in stale]
+            owners = [e.project_key() for e in stale]
+        else:
+            authors = [e.key.parent() for e in stale]
+            owners = [e.relative_to for e in stale]
+        fetched = ndb.get_multi([e.item for e in stale] + authors + owners)
+        n = len(stale)
+        done = []
+        for e, item, author, project in zip(stale, fetched[:n], fetched[n:2*n], fetched[2*n:]):
+            if not (item and author and project):
+                logging.warning("BATCH JOB: Not taking a snapshot of %s, its item, author or project is gone. " % e.key)
+                continue
+            e.snapshot = generic.activity_snapshot(item, author, project)
+            done.append(e)
+        if not done: return
+        if generic.DEBUG: logging.debug("DB WRITE: Handler %s is writing %s instances of %s. "
+                                        % (self.__class__.__name__, len(done), model.__name__))
+        ndb.put_multi(done)
+
+
+class BackfillUpdateFlags(BatchJob):
+    models = [projects.ProjectUpdates]
+    migration = projects.UPDATE_FLAGS_MIGRATION
+
+    def process_batch(self, model, entities):
+        stale = [e for e in entities if e.visibility_key is None]
+        if not stale: return
+        for e, item in zip(stale, ndb.get_multi([e.item for e in stale])):
+            if item:
+                e.set_update_flags(item)
+            else:
+                # Hidden, as ProjectUpdates.is_open_p did for them
+                e.item_kind, e.is_open, e.visibility_key = e.item.kind(), False, generic.visibility_key(e.item)
+        if generic.DEBUG: logging.debug("DB WRITE: Handler %s is writing %s instances of %s. "
+                                        % (self.__class__.__name__, len(stale), model.__name__))
+        ndb.put_multi(stale)
+
+
+class MoveProjectUpdates(BatchJob):
+    # Rewrites the updates that have their project as parent without one, see projects.ProjectUpdates
+    models = [projects.ProjectUpdates]
+    migration = projects.PROJECT_UPDATES_MIGRATION
+
+    def process_batch(self, model, entities):
+        stale = [e for e in entities if e.key.parent()]
+        if not stale: return
+        moved = [model(id = e.item.urlsafe(), **dict(e.to_dict(), project = e.key.parent())) for e in stale]
+        if generic.DEBUG: logging.debug("DB WRITE: Handler %s is moving %s instances of %s. "
+                                        % (self.__class__.__name__, len(stale), model.__name__))
+        ndb.put_multi(moved)
+        ndb.delete_multi([e.key for e in stale])
+        self.stats["moved"] = self.stats.get("moved", 0) + len(stale)
+
+
+class MoveNotificationLists(BatchJob):
+    # Writes the subscriptions kept in the lists of each project as projects.ProjectSubscriptions and
+    # empties them. Subscriptions already written were edited since, so they are left as they are.
+    models = [projects.Projects]
+    migration = projects.SUBSCRIPTIONS_MIGRATION
+
+    def process_batch(self, model, entities):
+        lists = projects.LEGACY_NOTIFICATION_LISTS.values()
+        stale = [p for p in entities if any(getattr(p, l) for l in lists)]
+        if not stale: return
+        subscriptions = [projects.legacy_subscription(p, k) for p in stale for k in p.author_keys()]
+        subscriptions = [s for s, e in zip(subscriptions, ndb.get_multi([s.key for s in subscriptions])) if not e]
+        for p in stale:
+            for l in lists: setattr(p, l, [])
+        if generic.DEBUG: logging.debug("DB WRITE: Handler %s is writing %s instances of ProjectSubscriptions and %s of %s. "
+                                        % (self.__class__.__name__, len(subscriptions), len(stale), model.__name__))
+        ndb.put_multi(subscriptions)
+        with auto_now_disabled(model):
+            ndb.put_multi(stale)
+        for stat, n in [("projects", len(stale)), ("subscriptions", len(subscriptions))]:
+            self.stats[stat] = self.stats.get(stat, 0) + n
+
+
+class MoveMemberships(BatchJob):
+    # Writes the generic.Memberships kept in the lists of projects, groups and users and empties them.
+    # The lists of both sides were kept by hand, so a membership in either of them is written.
+    models = [projects.Projects, groups.Groups, generic.RegisteredUsers]
+    migration = generic.MEMBERSHIPS_MIGRATION
+    lists = {projects.Projects : ["authors"], groups.Groups : ["members"], generic.RegisteredUsers : ["my_projects", "my_groups"]}
+
+    def process_batch(self, model, entities):
+        pairs, stale = [], []       # (user key, project or group key) and the entities holding them
+        for e in entities:
+            keys = sum([getattr(e, l) for l in self.lists[model]], [])
+            if not keys: continue
+            pairs += [(e.key, k) if model is generic.RegisteredUsers else (k, e.key) for k in keys]
+            for l in self.lists[model]: setattr(e, l, [])
+            stale.append(e)
+        if not stale: return
+        missing = {}
+        keys = [generic.Memberships.key_for(u, t) for u, t in pairs]
+        for key, (u, t), m in zip(keys, pairs, ndb.get_multi(keys)):
+            if not (m or key in missing):
+                missing[key] = generic.Memberships(key = key, target = t, role = "author" if t.kind() == "Projects" else "member")
+        if generic.DEBUG: logging.debug("DB WRITE: Handler %s is writing %s instances of Memberships and %s of %s. "
+                                        % (self.__class__.__name__, len(missing), len(stale), model.__name__))
+        ndb.put_multi(missing.values())
+        with auto_now_disabled(model):
+            ndb.put_multi(stale)
+        generic.forget_memberships(list(set(u for u, t in pairs)), list(set(t for u, t in pairs)))
+        for stat, n in [(model.__name__, len(stale)), ("memberships", len(missing))]:
+            self.stats[stat] = self.stats.get(stat, 0) + n
+
+
+class ReconcileCounters(BatchJob):
+    # Recounts from scratch the children counted by generic.ChildCounters models
+    models = [notebooks.Notebooks, notebooks.NotebookNotes, forum.ForumThreads, code.CodeRepositories,
+              bibliography.BiblioItems, datasets.DataSets, datasets.DataConcepts]
+
+    def process_batch(self, model, entities):
+        fixed = 0
+        with auto_now_disabled(model):
+            for e in entities:
+                if self.reconcile(e.key): fixed += 1
+        if fixed: logging.info("BATCH JOB: Fixed the counters of %s instances of %s. " % (fixed, model.__name__))
+
+    @ndb.transactional
+    def reconcile(self, key):
+        # Counted in the same transaction that put_reported uses, so no increment gets lost
+        e = key.get()
+        changed_p = False
+        for counter, kind in e.counters.items():
+            count = ndb.Query(kind = kind, ancestor = key).count()
+            if getattr(e, counter) != count:
+                setattr(e, counter, count)
+                changed_p = True
+        if changed_p:
+            if generic.DEBUG: logging.debug("DB WRITE: Handler %s is writing an instance of %s. "
+                                            % (self.__class__.__name__, e.__class__.__name__))
+            e.put()
+        return changed_p
+
+
+class BackfillRevisionMetadata(BatchJob):
+    models = [wiki.WikiRevisions, collab_writing.WritingRevisions]
+    migration = generic.REVISION_METADATA_MIGRATION
+
+    def process_batch(self, model, entities):
+        if not entities: return
+        if generic.DEBUG: logging.debug("DB WRITE: Handler %s is writing %s instances of RevisionMetadata. "
+                                        % (self.__class__.__name__, len(entities)))
+        ndb.put_multi([e.metadata() for e in entities])
+
+
+class CompactRevisions(BatchJob):
+    # Stores the revisions of each document as in generic.Revision: the newest whole, one whole every
+    # generic.REVISION_SNAPSHOT_INTERVAL and reverse deltas in between. Revisions written before
+    # that existed are all whole. Running it again only rewrites revisions that are out of place.
+    models = [wiki.WikiPages, collab_writing.CollaborativeWritings]
+    revision_models = {wiki.WikiPages : wiki.WikiRevisions, collab_writing.CollaborativeWritings : collab_writing.WritingRevisions}
+    batch_size = 5          # All the revisions of each document are fetched
+
+    def process_batch(self, model, entities):
+        for document in entities:
+            # In a transaction, as the edits that add to the chain (see generic.Revision.writes_with)
+            counts = ndb.transaction(lambda: self.compact(self.revision_models[model], document))
+            for stat, n in counts:
+                self.stats[stat] = self.stats.get(stat, 0) + n
+
+    def compact(self, revision_model, document):
+        "Returns the stats of the document's revisions as (name, number) pairs."
+        self.log_read(revision_model, "All the revisions of a document, to compact them. ")
+        revisions = revision_model.query(ancestor = document.key).order(revision_model.date).fetch()
+        if not revisions: return []
+        before = sum(self.stored_bytes(r) for r in revisions)      # Before reading any of them
+        # Whole contents, rebuilt from the newest
+        contents = [None] * len(revisions)
+        for i in reversed(range(len(revisions))):
+            r = revisions[i]
+            if not r.delta_p():
+                contents[i] = r.content
+            elif i + 1 < len(revisions) and r.base == revisions[i + 1].key:
+                contents[i] = generic.apply_delta(contents[i + 1], r.delta)
+            else:
+                contents[i] = r.get_content()
+        changed = {}        # By key, models aren't hashable
+        whole, behind = revisions[-1], 0
+        if whole.delta_p(): changed[whole.key] = self.make_whole(whole, contents[-1])
+        for i in reversed(range(len(revisions) - 1)):
+            r, newer = revisions[i], revisions[i + 1]
+            if behind + 1 < generic.REVISION_SNAPSHOT_INTERVAL:
+                behind += 1
+                if not (r.delta_p() and r.base == newer.key):
+                    r.content = contents[i]
+                    changed[r.key] = r.store_as_delta(newer, contents[i + 1])
+            else:
+                if whole.deltas_behind != behind:
+                    whole.deltas_behind = behind
+                    changed[whole.key] = whole
+                whole, behind = r, 0
+                if r.delta_p(): changed[r.key] = self.make_whole(r, contents[i])
+        if whole.deltas_behind != behind:
+            whole.deltas_behind = behind
+            changed[whole.key] = whole
+        for r in revisions:
+            if r.drop_rendered_html(): changed[r.key] = r
+        if changed:
+            if generic.DEBUG: logging.debug("DB WRITE: Handler %s is writing %s instances of %s. "
+                                            % (self.__class__.__name__, len(changed), revision_model.__name__))
+            ndb.put_multi(changed.values())
+        after = sum(self.stored_bytes(r) for r in revisions)
+        return [("revisions", len(revisions)), ("bytes_before", before), ("bytes_after", after), ("bytes_saved", before - after)]
+
+    def make_whole(self, revision, content):
+        revision.content, revision.delta, revision.base = content, None, None
+        return revision
+
+    def stored_bytes(self, revision):
+        # With the html of the revisions written before generic.Revision.drop_rendered_html
+        props = [revision._properties.get(n) for n in ["content", "delta", "rendered_html"]]
+        return sum(stored_bytes(stored_value(revision, p)) for p in props if p)
+
+
+class CompressTextProperties(BatchJob):
+    # Rewrites the entities stored before their large text and JSON properties had compressed = True.
+    # Those still read fine as they are. Reports the bytes these properties take per kind.
+    models = [notebooks.NotebookNotes, wiki.WikiPages, wiki.WikiRevisions, collab_writing.WritingRevisions,
+              email_messages.EmailsToSend, generic.EmailNotifications, code.CodeRepositories]
+
+    def process_batch(self, model, entities):
+        props = [p for p in model._properties.values() if getattr(p, "_compressed", False)]
+        stale = []
+        before = after = 0
+        for e in entities:
+            values = [stored_value(e, p) for p in props]
+            size = sum(stored_bytes(v) for v in values)
+            before += size
+            if any(v is not None and not isinstance(v, ndb.model._CompressedValue) for v in values):
+                stale.append(e)
+            else:
+                after += size
+        if stale:
+            if generic.DEBUG: logging.debug("DB WRITE: Handler %s is writing %s instances of %s. "
+                                            % (self.__class__.__name__, len(stale), model.__name__))
+            with auto_now_disabled(model):
+                ndb.put_multi(stale)
+            after += sum(stored_bytes(stored_value(e, p)) for e in stale for p in props)
+        for stat, n in [("bytes_before", before), ("bytes_after", after), ("rewritten", len(stale))]:
+            stat = "%s_%s" % (model.__name__, stat)
+            self.stats[stat] = self.stats.get(stat, 0) + n
+
+
+class LoadTestProjectWrites(generic.GenericPage):
+    # Simulates ?writers=N collaborators each saving ?writes=M notes at the same time in a scratch project,
+    # with the same commits as projects.put_and_report and ReportItem: the note and its notebook's count
+    # in a transaction, then its reports along with the project when it is due. It runs twice, with
+    # projects.touch_due_p debouncing the writes to the project and writing it with every report as it
+    # used to be, and reports the latency of these commits and how often they had to be retried. Then
+    # it deletes everything it wrote, also if it fails. Only a POST from an admin starts it, so that
+    # following a link can't.
+    def post(self):
+        user = self.get_login_user()
+        if not (user and users.is_current_user_admin()):
+            self.error(403)
+            return
+        writers = int(self.request.get("writers") or LOAD_TEST_WRITERS)
+        writes = int(self.request.get("writes") or LOAD_TEST_WRITES)
+        lines = []
+        for debounce_p in [True, False]:
+            lines.append("%s: " % ("Debouncing the project writes" if debounce_p else "Writing the project with every report"))
+            lines += self.run(user, writers, writes, debounce_p)
+        report = "\n".join(lines)
+        logging.info("LOAD TEST: %s" % report.replace("\n", ""))
+        self.write(report.replace("\n", "<br>"))
+
+    def run(self, user, writers, writes, debounce_p):
+        # Last updated long enough ago that the first report is due to write it, as in a project nobody was
+        # editing. The subscribers aren't notified about these notes, they are deleted before the task would run.
+        project = projects.Projects(name = "Load test", default_open_p = False,
+                                    last_updated = datetime.datetime.now() - datetime.timedelta(days = 1))
+        generic.allocate_key(project)
+        commits = {"item" : [], "report" : []}     # (seconds, attempts, done_p) of each
+        note_keys, touches, threads = [], [0], []
+        lock = threading.Lock()
+        try:
+            with auto_now_disabled(projects.Projects):
+                self.log_and_put(project)
+            notebook = notebooks.Notebooks(owner = user.key, name = "Load test", description = "", shared_p = True, parent = project.key)
+            generic.allocate_key(notebook)
+            self.log_and_put(notebook)
+
+            def commit(stat, write, transactional_p):
+                start, attempts, done_p, result = time.time(), 0, False, None
+                while not done_p and attempts < LOAD_TEST_ATTEMPTS:
+                    attempts += 1
+                    try:
+                        result = ndb.transaction(write, retries = 0) if transactional_p else write()
+                        done_p = True
+                    except (datastore_errors.TransactionFailedError, datastore_errors.Timeout):
+                        if attempts < LOAD_TEST_ATTEMPTS: time.sleep(0.1 * 2 ** attempts)     # As ndb backs off between its own retries
+                with lock: commits[stat].append((time.time() - start, attempts, done_p))
+                return result
+
+            def writer(i):
+                # Each thread has its own ndb context, so its own copy of the project as ReportItem would
+                p = project.key.get()
+                for j in range(writes):
+                    note = notebooks.NotebookNotes(title = "Note %s of writer %s" % (j + 1, i + 1), content = "Load test. ",
+                                                   author = user.key, parent = notebook.key)
+                    generic.allocate_key(note)
+                    with lock: note_keys.append(note.key)
+                    commit("item", lambda: generic.put_counted_with(note, note.parent_counter, []), True)
+                    reports = commit("report", lambda: projects.report_item(note, user, p, debounce_p = debounce_p,
+                                                                            notify_p = False), False) or []
+                    if p in reports:
+                        with lock: touches[0] += 1
+
+            start = time.time()
+            threads = [threading.Thread(target = writer, args = (i,)) for i in range(writers)]
+            for t in threads: t.start()
+            for t in threads: t.join()
+            elapsed = time.time() - start
+            lines = ["%s writers, %s notes each, in %.2f s. " % (writers, writes, elapsed)]
+            for stat in ["item", "report"]:
+                results = commits[stat]
+                if not results: continue
+                latencies = sorted(seconds * 1000 for seconds, attempts, done_p in results)
+                attempts = sum(a for seconds, a, done_p in results)
+                lines.append("%s commits: %s, failed %s. Latency (ms) mean %.0f, median %.0f, 95th percentile %.0f, max %.0f. "
+                             "Attempts %s, retry rate %.1f%%. "
+                             % (stat.capitalize(), len(results), len([r for r in results if not r[2]]),
+                                sum(latencies) / len(latencies), latencies[len(latencies) // 2],
+                                latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], latencies[-1],
+                                attempts, 100.0 * (attempts - len(results)) / attempts))
+            lines.append("Project written %s times while reporting. " % touches[0])
+            return lines
+        finally:
+            # Whatever got written, once no writer is left: the project, notebook and notes, and the
+            # reports kept out of the project's entity group
+            for t in threads:
+                if t.ident: t.join()
+            keys = ndb.Query(ancestor = project.key).fetch(keys_only = True)
+            for k in note_keys:
+                keys += [ndb.Key(projects.ProjectUpdates, k.urlsafe()), ndb.Key(generic.UserActivities, k.urlsafe(), parent = user.key)]
+            if generic.DEBUG: logging.debug("DB WRITE: Handler %s is deleting the %s entities it wrote. " % (self.__class__.__name__, len(keys)))
+            ndb.delete_multi(keys)
+            generic.clear_sidebar_cache([user.key])
@@ -12,7 +12,7 @@ NOTES_PER_PAGE = 5   # Number of notes displayed in a single page while viewing
 ###########################
 
 # Notebooks have a Project as parent.
-class Notebooks(ndb.Model):
+class Notebooks(generic.ChildCounters, ndb.Model):
     owner = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
     name = ndb.StringProperty(required = True)
     description = ndb.TextProperty(required = True)
@@ -22,9 +22,11 @@ class Notebooks(ndb.Model):
     # For an open notebook it's one of ONS-ACI, ONS-ACD, ONS-SCI, ONS-SCD according in its (A)ll or (S)elected content and (I)mmediately or (D)elayed. 
     # Another option is "CNS" for closed notebooks.
     claims = ndb.StringProperty(required = True, default = 'ONS-ACI')
+    notes_count = ndb.IntegerProperty(required = False, indexed = False)
+    counters = {"notes_count" : "NotebookNotes"}
 
     def get_number_of_notes(self):
-        return NotebookNotes.query(ancestor = self.key).count()
+        return self.get_count("notes_count")
 
     def is_open_p(self):
         return not self.claims == "CNS"
@@ -52,17 +54,20 @@ class Notebooks(ndb.Model):
 
 
 # Each note should be a child of a Notebook.
-class NotebookNotes(ndb.Model):
+class NotebookNotes(generic.RenderedMarkdown, generic.ChildCounters, ndb.Model):
+    parent_counter = "notes_count"
     title = ndb.StringProperty(required = True)
-    content = ndb.TextProperty(required = True)
+    content = ndb.TextProperty(required = True, compressed = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = False) # This is required for shared notebooks, otherwise it can be inferred from its parent.
+    comments_count = ndb.IntegerProperty(required = False, indexed = False)
+    counters = {"comments_count" : "NoteComments"}
 
     def get_number_of_comments(self):
-        return NoteComments.query(ancestor = self.key).count()
+        return self.get_count("comments_count")
 
     def is_open_p(self):
-        return self.key.parent().get().is_open_p()
+        return generic.item_open_p(self.key)
 
     def get_author(self):
         if self.author:
@@ -77,13 +82,15 @@ class NotebookNotes(ndb.Model):
 
         
 # Each comment should be a child of a NotebookNote
-class NoteComments(ndb.Model):
+class NoteComments(generic.RenderedMarkdown, ndb.Model):
+    md_source = "comment"
+    parent_counter = "comments_count"
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
     comment = ndb.TextProperty(required = True)
 
     def is_open_p(self):
-        return self.key.parent().get().is_open_p()
+        return generic.item_open_p(self.key)
 
 
 ######################
@@ -99,10 +106,8 @@ class NotebookPage(projects.ProjectPage):
         self.log_read(Notebooks, log_message)
         return Notebooks.get_by_id(int(nbid), parent = project.key)
 
-    def get_notes_list(self, notebook, page = 0, log_message = ''):
-        assert type(page) == int
-        self.log_read(NotebookNotes, "Fetching a page with %s results. %s" % (NOTES_PER_PAGE, log_message))
-        return NotebookNotes.query(ancestor = notebook.key).order(-NotebookNotes.date).fetch_page(NOTES_PER_PAGE, offset = NOTES_PER_PAGE * page)
+    def get_notes_list(self, notebook, log_message = ''):
+        return self.fetch_page(NotebookNotes.query(ancestor = notebook.key).order(-NotebookNotes.date), NOTES_PER_PAGE, log_message)
 
     def get_note(self, notebook, noteid, log_message = ''):
         self.log_read(NotebookNotes, log_message)
@@ -216,12 +221,8 @@ class NotebookMainPage(NotebookPage):
         if not (notebook.is_open_p() or (user and project.user_is_author(user))):
             self.render("project_page_not_visible.html", project = project, user = user)
             return
-        kw = {"page" : self.request.get("page")}
-        try:
-            kw["page"] = int(kw["page"])
-        except ValueError:
-            kw["page"] = 0
-        kw["notes"], kw["next_page_cursor"], kw["more_p"] = self.get_notes_list(notebook, kw["page"])
+        kw = {}
+        kw["notes"], kw["pager"] = self.get_notes_list(notebook)
         self.render("notebook_main.html", project = project, notebook = notebook, 
                     writable_p = user and (notebook.owner == user.key or notebook.shared_p),
                     owner = notebook.owner.get(), **kw)
@@ -446,10 +447,12 @@ class EditNotebookPage(NotebookPage):
                   "error_message" : error_message}
             self.render("notebook_new.html", project = project, **kw)
         else:
+            was_open_p = notebook.is_open_p()
             notebook.name = n_name
             notebook.description = n_description
             notebook.claims = n_claims
             self.log_and_put(notebook)
+            if was_open_p != notebook.is_open_p(): projects.update_visibility(notebook.key, notebook.is_open_p())
             self.redirect("/%s/notebooks/%s" % (projectid, nbid))
 
 
@@ -11,7 +11,7 @@ POSTS_PER_PAGE = 10
 ###########################
 
 # Each one should have a RegisteredUser as parent
-class OutreachPosts(ndb.Model):
+class OutreachPosts(generic.RenderedMarkdown, ndb.Model):
     title = ndb.StringProperty(required = True)
     content = ndb.TextProperty(required = True)
     published = ndb.DateTimeProperty(auto_now_add = True)
@@ -29,18 +29,17 @@ class OutreachPosts(ndb.Model):
 
 class PostPage(generic.GenericPage):
     def put_and_report(self, item, author):
-        self.log_and_put(item)
+        # Both in the author's entity group, so a single batch
+        generic.allocate_key(item)
         u_actv = generic.UserActivities(actv_kind = "Outreach", item = item.key, relative_to = author.key, parent = author.key)
-        self.log_and_put(u_actv)
+        generic.put_reported(item, [u_actv])
 
     def get_post(self, author, postid):
         self.log_read(OutreachPosts)
         return OutreachPosts.get_by_id(int(postid), parent = author.key)
 
-    def get_posts_list(self, author, page = 0):
-        assert type(page) == int
-        self.log_read(OutreachPosts, "Fetching a page with %s results. " % (POSTS_PER_PAGE))
-        return OutreachPosts.query(ancestor = author.key).order(-OutreachPosts.published).fetch_page(POSTS_PER_PAGE, offset = POSTS_PER_PAGE * page)
+    def get_posts_list(self, author):
+        return self.fetch_page(OutreachPosts.query(ancestor = author.key).order(-OutreachPosts.published), POSTS_PER_PAGE)
 
 
 class MainPage(PostPage):
@@ -50,15 +49,10 @@ class MainPage(PostPage):
         if not page_user:
             self.render("404.html", info = "User %s not found." % username)
             return
-        kw = {"page" : self.request.get("page"),
-              "plusone_p" : True,
+        kw = {"plusone_p" : True,
               "fb_p" : True,
               "FACEBOOK_APP_ID" : secrets.FACEBOOK_APP_ID}
-        try:
-            kw["page"] = int(kw["page"])
-        except ValueError:
-            kw["page"] = 0
-        kw["posts"], kw["next_page_cursor"], kw["more_p"] = self.get_posts_list(page_user, kw["page"])
+        kw["posts"], kw["pager"] = self.get_posts_list(page_user)
         self.render("outreach_MainPage.html", page_user = page_user, user = user, **kw)
     
 
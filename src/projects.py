@@ -1,27 +1,67 @@
 # projects.py
 # For creating, managing and updating projects.
 
+import collections, datetime, heapq, logging
 from google.appengine.ext import ndb
+from google.appengine.api import memcache
 import generic, email_messages
 
 SHORT_DESCRIPTION_LENGTH = 150
 UPDATES_TO_DISPLAY = 30           # number of updates to display in the Overview tab
+MERGE_BATCH_SIZE = 5              # fewest updates fetched at a time from each project when merging them
+UPDATE_FLAGS_MIGRATION = "update_flags"
+PROJECT_UPDATES_MIGRATION = "project_updates"
+LAST_UPDATED_DEBOUNCE = 60        # In seconds, reporting an item writes its project at most this often, see report_item
+TOUCHED_MEMCACHE_NAMESPACE = "touched"
+REPORT_ITEM_URL = "/cron/report_item"
+NOTIFY_SUBSCRIBERS_URL = "/cron/notify_subscribers"
+SUBSCRIPTIONS_MIGRATION = "subscriptions"
+# Parts of a project whose updates its authors can get emails about, bit i of ProjectSubscriptions.modules
+# is the i-th. The form in project_admin.html has a checkbox named after each with "_p".
+NOTIFICATION_MODULES = ["wiki", "notebooks", "writings", "code", "datasets", "forum_threads", "forum_posts"]
+# Where Projects kept the subscriptions to each before ProjectSubscriptions
+LEGACY_NOTIFICATION_LISTS = {"wiki" : "wiki_notifications_list", "notebooks" : "nb_notifications_list",
+                             "writings" : "writings_notifications_list", "code" : "code_notifications_list",
+                             "datasets" : "datasets_notifications_list", "forum_threads" : "forum_threads_notifications_list",
+                             "forum_posts" : "forum_posts_notifications_list"}
+# The kinds of items the subscribers to a module get emails about: (module, template in templates/emails,
+# names the template gives the item, its parent and grandparent). See notify_subscribers.
+NOTIFICATION_EMAILS = {"WikiRevisions" : ("wiki", "wiki", ["revision", "wikipage"]),
+                       "NotebookNotes" : ("notebooks", "note", ["note", "notebook"]),
+                       "NoteComments" : ("notebooks", "note_comment", ["comment", "note", "notebook"]),
+                       "WritingRevisions" : ("writings", "writing", ["revision", "writing"]),
+                       "CodeRepositories" : ("code", "code", ["code"]),
+                       "CodeComments" : ("code", "code_comment", ["comment", "code"]),
+                       "DataRevisions" : ("datasets", "datarev", ["rev", "datac", "dataset"]),
+                       "ForumThreads" : ("forum_threads", "forum_thread", ["thread"]),
+                       "ForumComments" : ("forum_posts", "forum_comment", ["comment", "thread"])}
+# Filters for the updates in the Overview tab: (name, label, kinds of items shown)
+UPDATE_FILTERS = [("notebooks", "Notebooks", ["Notebooks", "NotebookNotes", "NoteComments"]),
+                  ("wiki", "Wiki", ["WikiPages", "WikiRevisions", "WikiComments"]),
+                  ("writings", "Writings", ["CollaborativeWritings", "WritingRevisions", "WritingComments"]),
+                  ("code", "Code", ["CodeRepositories", "CodeComments"]),
+                  ("datasets", "Datasets", ["DataSets", "DataConcepts", "DataRevisions"]),
+                  ("forum", "Forum", ["ForumThreads", "ForumComments"]),
+                  ("bibliography", "Bibliography", ["BiblioItems", "BiblioComments"]),
+                  ("images", "Images", ["Images"])]
 ALLOWED_PROJECT_LICENSES = ["","CC BY","CC BY-SA","CC BY-ND","CC BY-NC","CC BY-NC-SA","CC BY-NC-ND"]
 
 ###########################
 ##   Datastore Objects   ##
 ###########################
 
-class Projects(ndb.Model):
+class Projects(generic.CachedRoot, ndb.Model):
     name = ndb.StringProperty(required = True)
     description = ndb.TextProperty(required = False)
-    authors = ndb.KeyProperty(repeated = True)                        # There's no such thing as an "owner"
+    # There's no such thing as an "owner". Now in generic.Memberships, maintenance.MoveMemberships empties it.
+    authors = ndb.KeyProperty(repeated = True)
     started = ndb.DateTimeProperty(auto_now_add = True)
     last_updated = ndb.DateTimeProperty(auto_now = True)
     default_open_p = ndb.BooleanProperty(default = True)
     wiki_open_p = ndb.BooleanProperty(default = True)
     default_license = ndb.StringProperty(default = "")
-    # Lists of authors to send notifications after an update
+    # Lists of authors to send notifications after an update. Now in ProjectSubscriptions,
+    # maintenance.MoveNotificationLists empties them.
     wiki_notifications_list = ndb.KeyProperty(repeated = True)
     nb_notifications_list = ndb.KeyProperty(repeated = True)
     writings_notifications_list = ndb.KeyProperty(repeated = True)
@@ -29,13 +69,19 @@ class Projects(ndb.Model):
     datasets_notifications_list = ndb.KeyProperty(repeated = True)
     forum_threads_notifications_list = ndb.KeyProperty(repeated = True)
     forum_posts_notifications_list = ndb.KeyProperty(repeated = True)
+    # What pages that only read the project need, see generic.CachedRoot
+    cached_fields = ["name", "description", "authors", "started", "last_updated", "default_open_p", "wiki_open_p", "default_license"]
 
+    def _post_put_hook(self, future):
+        # The authors' navigation bars show the name and are sorted by last_updated. After the commit as CachedRoot's.
+        generic.after_commit(lambda: generic.clear_sidebar_cache(self.author_keys()))
+        super(Projects, self)._post_put_hook(future)
 
     def list_of_authors(self, requesting_handler):
         authors_list = []
-        for author_key in self.authors:
-            requesting_handler.log_read(generic.RegisteredUsers, "Getting an author from a Project's list of authors. ")
-            author = author_key.get()
+        author_keys = self.author_keys()
+        requesting_handler.log_read(generic.RegisteredUsers, "Getting the %s authors of a project. " % len(author_keys))
+        for author_key, author in zip(author_keys, ndb.get_multi(author_keys)):
             if author:
                 authors_list.append(author)
             else:
@@ -43,11 +89,18 @@ class Projects(ndb.Model):
                                 % (self.key, author_key))
         return authors_list
 
+    _author_keys = None
+
+    def author_keys(self):
+        "The authors, see generic.members_of, looked up once per instance. add_author keeps it up to date."
+        if self._author_keys is None:
+            self._author_keys = self.authors + [k for k in generic.members_of(self.key) if k not in self.authors]
+        return self._author_keys
+
     def user_is_author(self, user):
-        result = False
-        for author_key in self.authors:
-            if user.key == author_key: result = True
-        return result
+        # From the user's memberships, which are read once for all the projects in a page
+        if not user: return False
+        return user.key in self.authors or self.key in user.membership_keys_async().get_result()
 
     def short_description(self):
         if len(self.description) < SHORT_DESCRIPTION_LENGTH:
@@ -56,29 +109,17 @@ class Projects(ndb.Model):
             return self.description[0:SHORT_DESCRIPTION_LENGTH - 3] + "..."
 
     def add_author(self, requesting_handler, user):
-        if user.key in self.authors: return False
-        self.authors.append(user.key)
-        self.wiki_notifications_list.append(user.key)
-        self.nb_notifications_list.append(user.key)
-        self.writings_notifications_list.append(user.key)
-        self.code_notifications_list.append(user.key)
-        self.datasets_notifications_list.append(user.key)
-        self.forum_threads_notifications_list.append(user.key)
-        self.forum_posts_notifications_list.append(user.key)
-        requesting_handler.log_and_put(self, "Adding a new author. ")
-        user.my_projects.append(self.key)
-        requesting_handler.log_and_put(user, "Adding a new project to my_projects property")
+        if self.user_is_author(user): return False
+        # Neither the project nor the user are written
+        generic.join(user, self, "author")
+        if self._author_keys is not None: self._author_keys = self._author_keys + [user.key]
+        requesting_handler.log_and_put(subscribe_to_all(self, user), "Subscribing a new author to the project's emails. ")
         return True
 
-    def list_updates(self, requesting_handler, user = None, n = UPDATES_TO_DISPLAY):
+    def list_updates(self, requesting_handler, user = None, n = UPDATES_TO_DISPLAY, kinds = None):
         assert type(n) == int
         assert n > 0
-        requesting_handler.log_read(ProjectUpdates, "Requesting %s updates. " % n)
-        updates = []
-        for u in ProjectUpdates.query(ancestor = self.key).order(-ProjectUpdates.date).iter():
-            if u.is_open_p() or (user and self.user_is_author(user)): updates.append(u)
-            if len(updates) >= n: break
-        return updates
+        return merge_updates(requesting_handler, [self], user, n, kinds)
 
     def license_html(self):
         lic = self.default_license
@@ -115,21 +156,222 @@ class Projects(ndb.Model):
 
 
 
-# Should have a Project as parent
+# Keyed by the reported item's key with no parent, so that reporting doesn't write to the project's
+# entity group. The older ones have the project as parent until maintenance.MoveProjectUpdates runs.
 class ProjectUpdates(ndb.Model):
+    project = ndb.KeyProperty(kind = Projects, required = False)
     date = ndb.DateTimeProperty(auto_now_add = True)
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
     item = ndb.KeyProperty(required = True)
-
-    def description_html(self, project, show_project_p = True):
-        return generic.render_str("project_activity.html", author = self.author.get(), item = self.item, project = project, show_project_p = show_project_p)
+    snapshot = ndb.JsonProperty(required = False)     # See generic.activity_snapshot
+    # Copied from the item so feeds can be filtered in the query, see set_update_flags
+    item_kind = ndb.StringProperty(required = False)
+    is_open = ndb.BooleanProperty(required = False)
+    visibility_key = ndb.KeyProperty(required = False)  # Whose visibility setting decides is_open
+
+    def project_key(self):
+        return self.project or self.key.parent()
+
+    def get_snapshot(self):
+        # Older updates don't have one until maintenance.BackfillActivitySnapshots gets to them.
+        # None if their item, author or project is gone, those aren't shown.
+        if self.snapshot is None:
+            item, author, project = ndb.get_multi([self.item, self.author, self.project_key()])
+            if not (item and author and project): return None
+            self.snapshot = generic.activity_snapshot(item, author, project)
+        return self.snapshot
+
+    def description_html(self, show_project_p = True):
+        if not self.get_snapshot(): return ''
+        return generic.render_str("project_activity.html", s = self.get_snapshot(), project_id = self.project_key().integer_id(),
+                                  show_project_p = show_project_p)
 
     def is_open_p(self):
-        try:
-            val = self.item.get().is_open_p()
-        except:
-            val = False
-        return val
+        if self.is_open is not None: return self.is_open
+        return generic.item_open_p(self.item)
+
+    def set_update_flags(self, item):
+        self.item_kind = item.key.kind()
+        self.is_open = item.is_open_p()
+        self.visibility_key = generic.visibility_key(item.key)
+
+
+# One for each author of a project with the modules they get emails about, whether or not there are
+# any. The user is the parent and the project's id the id. Apart from the project so that changing
+# them doesn't write it.
+class ProjectSubscriptions(ndb.Model):
+    project = ndb.KeyProperty(kind = Projects, required = True)
+    modules = ndb.IntegerProperty(default = 0, indexed = False)      # Bit i is set for NOTIFICATION_MODULES[i]
+    # The same, for querying the subscribers to a module, see subscriber_keys
+    module_names = ndb.ComputedProperty(lambda self: self.module_list(), repeated = True)
+
+    @classmethod
+    def key_for(cls, project_key, user_key):
+        return ndb.Key(cls, project_key.integer_id(), parent = user_key)
+
+    def module_list(self):
+        return [m for m in NOTIFICATION_MODULES if self.subscribed_p(m)]
+
+    def subscribed_p(self, module):
+        return bool(self.modules & module_bit(module))
+
+    def set_subscribed(self, module, subscribed_p):
+        if subscribed_p:
+            self.modules |= module_bit(module)
+        else:
+            self.modules &= ~module_bit(module)
+
+
+def module_bit(module):
+    return 1 << NOTIFICATION_MODULES.index(module)
+
+def subscribe_to_all(project, user):
+    "A new author's subscription, to every module. Not written yet."
+    return ProjectSubscriptions(key = ProjectSubscriptions.key_for(project.key, user.key), project = project.key,
+                                modules = (1 << len(NOTIFICATION_MODULES)) - 1)
+
+def legacy_subscription(project, user_key):
+    "The subscription of user_key as kept in project's lists, see LEGACY_NOTIFICATION_LISTS. Not written yet."
+    modules = sum(module_bit(m) for m in NOTIFICATION_MODULES if user_key in getattr(project, LEGACY_NOTIFICATION_LISTS[m]))
+    return ProjectSubscriptions(key = ProjectSubscriptions.key_for(project.key, user_key), project = project.key, modules = modules)
+
+def get_subscription(project, user_key):
+    "The one of user_key to project. Until maintenance.MoveNotificationLists gets to it, maybe still in its lists."
+    return ProjectSubscriptions.key_for(project.key, user_key).get() or legacy_subscription(project, user_key)
+
+def subscriber_keys(project, module):
+    "The keys of the authors of project that get emails about module."
+    if generic.migration_done_p(SUBSCRIPTIONS_MIGRATION):
+        return [s.key.parent() for s in ProjectSubscriptions.query(ProjectSubscriptions.project == project.key,
+                                                                   ProjectSubscriptions.module_names == module)]
+    subs = dict((s.key.parent(), s) for s in ProjectSubscriptions.query(ProjectSubscriptions.project == project.key))
+    return [k for k in project.author_keys() if (subs.get(k) or legacy_subscription(project, k)).subscribed_p(module)]
+
+
+def make_reports(item, author, project):
+    """The UserActivities and ProjectUpdates reporting a new item. They are keyed by the item's key, so
+    reporting it again only rewrites them."""
+    snapshot = generic.activity_snapshot(item, author, project)
+    u_activity = generic.UserActivities(id = item.key.urlsafe(), parent = author.key, item = item.key, relative_to = project.key,
+                                        actv_kind = "Projects", snapshot = snapshot)
+    p_update = ProjectUpdates(id = item.key.urlsafe(), project = project.key, author = author.key, item = item.key, snapshot = snapshot)
+    p_update.set_update_flags(item)
+    return [u_activity, p_update]
+
+def put_and_report(item, author, project, others = [], touch_project_p = True, more_writes = None):
+    """Writes item, others and more_writes (see generic.put_and_enqueue) and queues the task that
+    reports it and, if touch_project_p, writes the project to bump its last_updated. See report_item."""
+    generic.allocate_key(item)
+    params = {"item" : item.key.urlsafe(), "author" : author.key.urlsafe(), "project" : project.key.urlsafe(),
+              "touch_project_p" : str(touch_project_p)}
+    generic.put_and_enqueue(item, others, REPORT_ITEM_URL, params, more_writes)
+
+def report_item(item, author, project, touch_project_p = True, debounce_p = True, notify_p = True):
+    """Writes the reports of item that aren't there yet and, if touch_project_p, the project to bump its
+    last_updated. Any write to the project contends with the ones to its items, so on a busy project
+    that is done once every LAST_UPDATED_DEBOUNCE seconds instead of after each item, unless not
+    debounce_p. The first time, if notify_p, also queues the task that notifies the subscribers, see
+    notify_subscribers. Returns the entities written."""
+    reports = make_reports(item, author, project)
+    to_put = [r for r, e in zip(reports, ndb.get_multi([r.key for r in reports])) if not e]
+    # Queued before the reports are written so a retry can't miss it, notify_subscribers doesn't mind twice
+    if notify_p and any(isinstance(r, ProjectUpdates) for r in to_put) and item.key.kind() in NOTIFICATION_EMAILS:
+        generic.enqueue(NOTIFY_SUBSCRIBERS_URL, {"item" : item.key.urlsafe(), "author" : author.key.urlsafe(),
+                                                 "project" : project.key.urlsafe()})
+    if touch_project_p and (not debounce_p or touch_due_p(project)): to_put.append(project)
+    if not to_put: return []
+    if generic.DEBUG: logging.debug("DB WRITE: Writing %s entities reporting an instance of %s. "
+                                    % (len(to_put), item.__class__.__name__))
+    ndb.put_multi(to_put)
+    return to_put
+
+def notify_subscribers(item, author, project):
+    """Writes an EmailNotifications about item for each author of project subscribed to its module,
+    but its own author, for email_messages.SendNotifications to send. They are keyed by the item, so
+    the ones already written are left as they are. Returns the ones written."""
+    if item.key.kind() not in NOTIFICATION_EMAILS: return []
+    module, template, names = NOTIFICATION_EMAILS[item.key.kind()]
+    keys = [ndb.Key(generic.EmailNotifications, item.key.urlsafe(), parent = k)
+            for k in subscriber_keys(project, module) if k != author.key]
+    keys = [k for k, n in zip(keys, ndb.get_multi(keys)) if not n]
+    if not keys: return []
+    snapshot = generic.activity_snapshot(item, author, project)
+    project_link = "%s/%s" % (generic.APP_URL, project.key.integer_id())
+    kw = {"project" : project, "author" : author, "project_absolute_link" : project_link,
+          "author_absolute_link" : "%s/%s" % (generic.APP_URL, author.username)}
+    ancestors = [item.key.parent(), item.key.parent() and item.key.parent().parent()][:len(names) - 1]
+    paths = [snapshot["path"], snapshot["parent_path"], snapshot["grandparent_path"]]
+    for name, e, path in zip(names, [item] + ndb.get_multi(ancestors), paths):
+        kw[name] = e
+        kw[name + "_absolute_link"] = "%s/%s" % (project_link, path)
+    html = generic.render_str("emails/%s.html" % template, **kw)
+    txt = generic.render_str("emails/%s.txt" % template, **kw)
+    notifications = [generic.EmailNotifications(key = k, author = author.key, category = item.key.kind(),
+                                                html = html, txt = txt, sent = False) for k in keys]
+    if generic.DEBUG: logging.debug("DB WRITE: Writing %s instances of EmailNotifications about an instance of %s. "
+                                    % (len(notifications), item.key.kind()))
+    ndb.put_multi(notifications)
+    return notifications
+
+def touch_due_p(project):
+    if datetime.datetime.now() - project.last_updated < datetime.timedelta(seconds = LAST_UPDATED_DEBOUNCE): return False
+    # Only one of the reports that read the project before it was written gets to write it
+    return memcache.add(project.key.urlsafe(), True, time = LAST_UPDATED_DEBOUNCE, namespace = TOUCHED_MEMCACHE_NAMESPACE)
+
+def update_visibility(key, open_p):
+    """Call it after the setting of key (see generic.visibility_key) changes to open_p. Updates is_open
+    in the updates it decides and forgets the memcached setting."""
+    generic.forget_visibility(key)
+    # Not an ancestor query so it finds them both in and out of the project's entity group
+    stale = ProjectUpdates.query(ProjectUpdates.visibility_key == key, ProjectUpdates.is_open == (not open_p)).fetch()
+    if not stale: return
+    for u in stale: u.is_open = open_p
+    if generic.DEBUG: logging.debug("DB WRITE: Updating the visibility of %s instances of ProjectUpdates. " % len(stale))
+    ndb.put_multi(stale)
+
+def merge_updates(requesting_handler, project_list, user = None, n = UPDATES_TO_DISPLAY, kinds = None):
+    """The latest n updates of these projects that user can see, newest first, only of these kinds of
+    items if given. The updates of each project come already sorted by date, so they are merged with
+    a heap: every project starts with a small page, all of them fetched in parallel, and a project
+    only fetches its next page when the merge runs through the previous one. Until the updates with a
+    project as parent are moved out of it (see ProjectUpdates) those are merged in as another query."""
+    assert type(n) == int
+    assert n > 0
+    if not project_list: return []
+    # Until maintenance.BackfillUpdateFlags is done the flags can't be used in the queries
+    flags_p = generic.migration_done_p(UPDATE_FLAGS_MIGRATION)
+    moved_p = generic.migration_done_p(PROJECT_UPDATES_MIGRATION)
+    queries, visible_p = [], []
+    for p in project_list:
+        author_p = bool(user) and p.user_is_author(user)
+        bases = [ProjectUpdates.query(ProjectUpdates.project == p.key)]
+        if not moved_p: bases.append(ProjectUpdates.query(ancestor = p.key))
+        for query in bases:
+            if flags_p and not author_p: query = query.filter(ProjectUpdates.is_open == True)
+            for kind in (kinds if flags_p and kinds else [None]):
+                queries.append((query.filter(ProjectUpdates.item_kind == kind) if kind else query).order(-ProjectUpdates.date))
+                visible_p.append(author_p or flags_p)
+    batch_size = min(n, max(MERGE_BATCH_SIZE, -(-n // len(queries))))
+    requesting_handler.log_read(ProjectUpdates, "Merging %s queries for the updates of %s projects, %s at a time. "
+                                % (len(queries), len(project_list), batch_size))
+    pages = [f.get_result() for f in [q.fetch_page_async(batch_size) for q in queries]]
+    buffers = [collections.deque(results) for results, cursor, more_p in pages]
+    cursors = [cursor if more_p else None for results, cursor, more_p in pages]
+    # The newest date gives the smallest key
+    heap = [(datetime.datetime.max - b[0].date, i) for i, b in enumerate(buffers) if b]
+    heapq.heapify(heap)
+    updates = []
+    while heap and len(updates) < n:
+        i = heapq.heappop(heap)[1]
+        u = buffers[i].popleft()
+        if (visible_p[i] or u.is_open_p()) and (flags_p or not kinds or u.item.kind() in kinds): updates.append(u)
+        if not buffers[i] and cursors[i] and len(updates) < n:
+            requesting_handler.log_read(ProjectUpdates, "Fetching %s more updates of a project. " % batch_size)
+            results, cursor, more_p = queries[i].fetch_page(batch_size, start_cursor = cursors[i])
+            buffers[i].extend(results)
+            cursors[i] = cursor if more_p else None
+        if buffers[i]: heapq.heappush(heap, (datetime.datetime.max - buffers[i][0].date, i))
+    return updates
 
 
 ######################
@@ -137,24 +379,58 @@ class ProjectUpdates(ndb.Model):
 ######################
 
 class ProjectPage(generic.GenericPage):
-    def get_project(self, projectid, log_message = ''):
-        self.log_read(Projects, log_message)
-        project = Projects.get_by_id(int(projectid))
-        return project
+    cached_project_p = True     # GET handlers only read the project, so they get a cached copy
 
-    def put_and_report(self, item, author, project, other_to_update = None):
-        self.log_and_put(item)
-        # Log user activity
-        u_activity = generic.UserActivities(parent = author.key, item = item.key, relative_to = project.key, actv_kind = "Projects")
-        self.log_and_put(u_activity)
-        # Log project update
-        p_update = ProjectUpdates(parent = project.key, author = author.key, item = item.key)
-        self.log_and_put(p_update)
-        self.log_and_put(project)
-        if other_to_update: self.log_and_put(other_to_update)
+    def get_project(self, projectid, log_message = ''):
+        # Fetched once per request, later calls get the same instance
+        fetched = self.request.registry.setdefault("projects", {})
+        if int(projectid) not in fetched:
+            if self.cached_project_p and self.request.method == "GET":
+                fetched[int(projectid)] = Projects.get_cached(int(projectid))
+            else:
+                self.log_read(Projects, log_message)
+                fetched[int(projectid)] = Projects.get_by_id(int(projectid))
+        return fetched[int(projectid)]
+
+    def render(self, template, **kw):
+        # Templates check author_p instead of calling project.user_is_author(user) again
+        if kw.get("project") and "author_p" not in kw:
+            kw["author_p"] = kw["project"].user_is_author(self.get_login_user())
+        generic.GenericPage.render(self, template, **kw)
+
+    def put_and_report(self, item, author, project, other_to_update = None, more_writes = None):
+        # Only the item, other_to_update and more_writes are written before the response, see ReportItem
+        put_and_report(item, author, project, [other_to_update] if other_to_update else [], more_writes = more_writes)
         return
 
 
+class ReportItem(generic.GenericPage):
+    # The task queued by put_and_report. The task queue retries it until it succeeds, and as the
+    # reports are keyed by the item the ones already written are left as they are.
+    def post(self):
+        keys = [ndb.Key(urlsafe = self.request.get(p)) for p in ["item", "author", "project"]]
+        self.log_read(Projects, "The item, author and project to report. ")
+        item, author, project = ndb.get_multi(keys)
+        if not (item and author and project):
+            logging.warning("TASK: Not reporting %s, it or its author or project is gone. " % keys[0])
+            return
+        self.log_read(ProjectUpdates, "Checking if it was already reported. ")
+        report_item(item, author, project, self.request.get("touch_project_p") == "True")
+
+
+class NotifySubscribers(generic.GenericPage):
+    # The task queued by report_item, retried until it succeeds as well
+    def post(self):
+        keys = [ndb.Key(urlsafe = self.request.get(p)) for p in ["item", "author", "project"]]
+        self.log_read(Projects, "The item, author and project to notify about. ")
+        item, author, project = ndb.get_multi(keys)
+        if not (item and author and project):
+            logging.warning("TASK: Not notifying about %s, it or its author or project is gone. " % keys[0])
+            return
+        self.log_read(ProjectSubscriptions, "Looking up the subscribers. ")
+        notify_subscribers(item, author, project)
+
+
 class NewProjectPage(generic.GenericPage):
     def get(self):
         user = self.get_login_user()
@@ -189,22 +465,16 @@ class NewProjectPage(generic.GenericPage):
                                    description = kw["p_description"],
                                    default_open_p = kw["open_p"],
                                    default_license = kw["default_license"],
-                                   wiki_open_p = kw["open_p"],
-                                   authors = [user.key],
-                                   wiki_notifications_list = [user.key],
-                                   nb_notifications_list = [user.key],
-                                   writings_notifications_list = [user.key],
-                                   code_notifications_list = [user.key],
-                                   datasets_notifications_list = [user.key],
-                                   forum_threads_notifications_list = [user.key],
-                                   forum_posts_notifications_list = [user.key])
+                                   wiki_open_p = kw["open_p"])
             self.log_and_put(new_project, "Creating a new project. ")
-            user.my_projects.append(new_project.key)
-            self.log_and_put(user, "Appending a project to a RegisteredUser's my_projects list ")
+            generic.join(user, new_project, "author")
+            self.log_and_put(subscribe_to_all(new_project, user), "Subscribing the author to the project's emails. ")
             self.redirect("/%s" % new_project.key.integer_id())
 
 
 class AdminPage(ProjectPage):
+    cached_project_p = False    # Edits the project and adds invited authors
+
     def render(self, *a, **kw):
         ProjectPage.render(self, admin_tab_class = "active", *a, **kw)
 
@@ -229,17 +499,14 @@ class AdminPage(ProjectPage):
         if not project.user_is_author(user):
             self.redirect("/%s" % projectid)
             return
-        kw = {"wiki_p"          : "checked" if user.key in project.wiki_notifications_list else "",
-              "notebooks_p"     : "checked" if user.key in project.nb_notifications_list else "",
-              "writings_p"      : "checked" if user.key in project.writings_notifications_list else "",
-              "code_p"          : "checked" if user.key in project.code_notifications_list else "",
-              "datasets_p"      : "checked" if user.key in project.datasets_notifications_list else "",
-              "forum_threads_p" : "checked" if user.key in project.forum_threads_notifications_list else "",
-              "forum_posts_p"   : "checked" if user.key in project.forum_posts_notifications_list else "",
-              "p_description"   : project.description,
+        kw = {"p_description"   : project.description,
               "p_name"          : project.name,
               "authors"         : project.list_of_authors(self),
               "info_message"    : self.request.get("info")}
+        self.log_read(ProjectSubscriptions)
+        subscription = get_subscription(project, user.key)
+        for m in NOTIFICATION_MODULES:
+            kw[m + "_p"] = "checked" if subscription.subscribed_p(m) else ""
         self.render('project_admin.html', project = project, **kw)
 
     def post(self, projectid):
@@ -253,23 +520,19 @@ class AdminPage(ProjectPage):
             self.error(404)
             self.render("404.html", info = "Project with key <em>%s</em> not found" % projectid)
             return
-        kw = {"wiki_p"          : self.request.get("wiki_p"),
-              "notebooks_p"     : self.request.get('notebooks_p'),
-              "writings_p"      : self.request.get('writings_p'),
-              "code_p"          : self.request.get('code_p'),
-              "datasets_p"      : self.request.get('datasets_p'),
-              "forum_threads_p" : self.request.get('forum_threads_p'),
-              "forum_posts_p"   : self.request.get('forum_posts_p'),
-              "p_description"   : self.request.get('p_description'),
+        kw = {"p_description"   : self.request.get('p_description'),
               "p_name"          : self.request.get('p_name'),
               "default_open_p"  : self.request.get('open_p') == 'True',
               "default_license" : self.request.get("default_license"),
               "authors"         : project.list_of_authors(self)}
+        for m in NOTIFICATION_MODULES:
+            kw[m + "_p"] = self.request.get(m + "_p")
         have_error = False
         kw["error"] = ''
         if not project.user_is_author(user):
             self.redirect("/%s" % projectid)
             return
+        before = [project.name, project.description, project.default_open_p, project.default_license]
         ## Project's name, description, open_p and default_license
         if kw["p_name"]:
             project.name = kw["p_name"]
@@ -287,39 +550,18 @@ class AdminPage(ProjectPage):
         assert kw["default_license"] in ALLOWED_PROJECT_LICENSES
         project.default_license = kw["default_license"]
         ## Email notifications
-        # Add to list
-        if kw["wiki_p"] and not (user.key in project.wiki_notifications_list):
-            project.wiki_notifications_list.append(user.key)
-        if kw["notebooks_p"] and not (user.key in project.nb_notifications_list):
-            project.nb_notifications_list.append(user.key)
-        if kw["writings_p"] and not (user.key in project.writings_notifications_list):
-            project.writings_notifications_list.append(user.key)
-        if kw["code_p"] and not (user.key in project.code_notifications_list):
-            project.code_notifications_list.append(user.key)
-        if kw["datasets_p"] and not (user.key in project.datasets_notifications_list):
-            project.datasets_notifications_list.append(user.key)
-        if kw["forum_threads_p"] and not (user.key in project.forum_threads_notifications_list):
-            project.forum_threads_notifications_list.append(user.key)
-        if kw["forum_posts_p"] and not (user.key in project.forum_posts_notifications_list):
-            project.forum_posts_notifications_list.append(user.key)
-        # Remove from list
-        if (not kw["wiki_p"]) and (user.key in project.wiki_notifications_list):
-            project.wiki_notifications_list.remove(user.key)
-        if (not kw["notebooks_p"]) and (user.key in project.nb_notifications_list):
-            project.nb_notifications_list.remove(user.key)
-        if (not kw["writings_p"]) and (user.key in project.writings_notifications_list):
-            project.writings_notifications_list.remove(user.key)
-        if (not kw["code_p"]) and (user.key in project.code_notifications_list):
-            project.code_notifications_list.remove(user.key)
-        if (not kw["datasets_p"]) and (user.key in project.datasets_notifications_list):
-            project.datasets_notifications_list.remove(user.key)
-        if (not kw["forum_threads_p"]) and (user.key in project.forum_threads_notifications_list):
-            project.forum_threads_notifications_list.remove(user.key)
-        if (not kw["forum_posts_p"]) and (user.key in project.forum_posts_notifications_list):
-            project.forum_posts_notifications_list.remove(user.key)
-
+        self.log_read(ProjectSubscriptions)
+        stored = ProjectSubscriptions.key_for(project.key, user.key).get()
+        subscription = stored or legacy_subscription(project, user.key)
+        modules = subscription.modules
+        for m in NOTIFICATION_MODULES:
+            subscription.set_subscribed(m, bool(kw[m + "_p"]))
         if not have_error:
-            self.log_and_put(project, "Updating email notifications and/or description. ")
+            # Each is written only if it changed, the subscription apart from the project
+            if [project.name, project.description, project.default_open_p, project.default_license] != before:
+                self.log_and_put(project, "Updating the project's description. ")
+            if subscription.modules != modules or not stored:
+                self.log_and_put(subscription, "Updating email notifications. ")
             kw["info_message"] = "Changes saved"
         self.render('project_admin.html', project = project, **kw)
 
@@ -399,14 +641,5 @@ class ProjectBlobstoreUpload(generic.GenericBlobstoreUpload):
         return project
 
     def put_and_report(self, item, author, project, list_of_things_to_update = []):
-        self.log_and_put(item)
-        # Log user activity
-        u_activity = generic.UserActivities(parent = author.key, item = item.key, relative_to = project.key, actv_kind = "Projects")
-        self.log_and_put(u_activity)
-        # Log project update
-        p_update = ProjectUpdates(parent = project.key, author = author.key, item = item.key)
-        self.log_and_put(p_update)
-        self.log_and_put(project)
-        for i in list_of_things_to_update:
-            self.log_and_put(i)
+        put_and_report(item, author, project, list_of_things_to_update)
         return
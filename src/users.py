@@ -5,9 +5,9 @@ import generic, projects, email_messages, secrets, simpleauth, groups
 import bibliography, code, collab_writing, datasets, forum, images, notebooks, wiki
 import hashlib, re, logging, json
 from google.appengine.api import mail, urlfetch
+from google.appengine.ext import ndb
 from webapp2_extras import auth
 
-LOGIN_COOKIE_MAXAGE = 2 * 604800 # In seconds; 604800s = 1 week
 EMAIL_RE = r'^[\S]+@[\S]+\.[\S]+$'
 USERNAME_RE = r'^[a-zA-Z][a-zA-Z0-9_-]{2,20}$'
 PASSWORD_RE = r'^.{3,20}$'
@@ -53,7 +53,7 @@ class LoginPage(generic.GenericPage):
 #            u.salt = generic.make_salt()
 #            u.password_hash = generic.hash_str(password + u.salt)
 #            self.log_and_put(u, "Making new salt. ")
-            self.set_cookie("username", u.username, u.salt, max_age = LOGIN_COOKIE_MAXAGE)
+            self.set_login_cookie(u)
             if kw['goback']: 
                 self.redirect(kw['goback'])
                 return
@@ -76,16 +76,24 @@ class UserPage(generic.GenericPage):
               "p_counts" : page_user.get_project_contributions_counts(30, page_user.key == user.key if user else False),
               "plusone_p": True,
               "show_project_p": True}
+        # Only the ones this user can see, with the visibility and authorship looked up in batches
+        actvs = kw["recent_actv"]["Projects"]
+        open_p = self.items_open_p([a.item for a in actvs])
+        author_p = {}
+        if user:
+            self.log_read(projects.Projects, "Projects of the recent activities. ")
+            project_keys = list(set(a.relative_to for a in actvs if not open_p[a.item]))
+            author_p = dict((k, bool(p) and p.user_is_author(user)) for k, p in zip(project_keys, ndb.get_multi(project_keys)))
+        kw["recent_actv"]["Projects"] = [a for a in actvs if open_p[a.item] or author_p.get(a.relative_to)]
         for a in kw["recent_actv"]["Projects"]:
-            if a.is_open_p() or (user and a.actv_kind == "Projects" and a.relative_to.get().user_is_author(user)):
-                if a.item.kind() in ["Notebooks", "NotebookNotes", "NoteComments"]: kw["p_stats"]["Notebooks"] += 1
-                elif a.item.kind() in ["CodeRepositories", "CodeComments"]: kw["p_stats"]["Code"] += 1
-                elif a.item.kind() in ["DataSets", "DataConcepts", "DataRevisions"]: kw["p_stats"]["Datasets"] += 1
-                elif a.item.kind() in ["WikiRevisions"]: kw["p_stats"]["Wiki"] += 1
-                elif a.item.kind() in ["CollaborativeWritings", "WritingRevisions", "WritingComments"]: kw["p_stats"]["Writings"] += 1
-                elif a.item.kind() in ["ForumThreads", "ForumComments"]: kw["p_stats"]["Forum"] += 1
-                elif a.item.kind() in ["BiblioItems", "BiblioComments"]: kw["p_stats"]["Bibliography"] += 1
-                elif a.item.kind() in ["Images"]: kw["p_stats"]["Images"] += 1
+            if a.item.kind() in ["Notebooks", "NotebookNotes", "NoteComments"]: kw["p_stats"]["Notebooks"] += 1
+            elif a.item.kind() in ["CodeRepositories", "CodeComments"]: kw["p_stats"]["Code"] += 1
+            elif a.item.kind() in ["DataSets", "DataConcepts", "DataRevisions"]: kw["p_stats"]["Datasets"] += 1
+            elif a.item.kind() in ["WikiRevisions"]: kw["p_stats"]["Wiki"] += 1
+            elif a.item.kind() in ["CollaborativeWritings", "WritingRevisions", "WritingComments"]: kw["p_stats"]["Writings"] += 1
+            elif a.item.kind() in ["ForumThreads", "ForumComments"]: kw["p_stats"]["Forum"] += 1
+            elif a.item.kind() in ["BiblioItems", "BiblioComments"]: kw["p_stats"]["Bibliography"] += 1
+            elif a.item.kind() in ["Images"]: kw["p_stats"]["Images"] += 1
         self.render("user.html", page_user = page_user, **kw)
 
 
@@ -129,36 +137,33 @@ class SignupPage(generic.GenericPage):
             have_error = True
         if not have_error:
             usern = usern.lower()
-            # Available username
-            another_user = self.get_user_by_username(usern, "Checking if username is available")
-            if not another_user:
-                self.log_read(generic.UnverifiedUsers, "Checking if username is available. ")
-                another_user = generic.UnverifiedUsers.query(generic.UnverifiedUsers.username == usern).get()
+            # Available username and email, registered or still unverified
+            self.log_read(generic.UniqueUsernames, "Checking if username and email are available. ")
+            another_user, another_email = generic.get_unique_owners(usern, email)
             if another_user:
                 have_error = True
                 kw['error_username'] = True
                 kw['error'] += 'That username is not available. '
-            # Available email
-            another_email = self.get_user_by_email(email, "Checking if email is available. ")
-            if another_email:
+            if another_email and another_email.kind() == "RegisteredUsers":
                 have_error = True
                 kw['error_email'] = True
                 kw['error'] += 'That email is already in use by someone. Did you <a href="/recover_password?email=%s">forget your password?. </a>' % email
-            else:
-                self.log_read(generic.UnverifiedUsers, "Checking if email is available. ")
-                another_email = generic.UnverifiedUsers.query(generic.UnverifiedUsers.email == email).get()
-                if another_email:
-                    have_error = True
-                    kw['error_email'] = True
-                    kw['error'] = 'This email is already registered but it still needs to be verified, click <a href="/verify_email?email=%s">here</a> to send the verification email again.' % email
+            elif another_email:
+                have_error = True
+                kw['error_email'] = True
+                kw['error'] = 'This email is already registered but it still needs to be verified, click <a href="/verify_email?email=%s">here</a> to send the verification email again.' % email
+        if not have_error:
+            salt = generic.make_salt()
+            ph = generic.hash_str(password + salt)
+            u = generic.UnverifiedUsers(username = usern, password_hash = ph, salt = salt, email = email)
+            if generic.DEBUG: logging.debug("DB WRITE: Handler SignupPage is writing an instance of UnverifiedUsers. New user registration")
+            if not generic.put_user_p(u):
+                have_error = True
+                kw['error'] = "That username or email has just been taken, please choose another one. "
         # Render
         if have_error:
             self.render('signup.html', **kw)
         else:
-            salt = generic.make_salt()
-            ph = generic.hash_str(password + salt)
-            u = generic.UnverifiedUsers(username = usern, password_hash = ph, salt = salt, email = email)
-            self.log_and_put(u, "New user registration")
             email_messages.send_verify_email(u)
             self.render('signup.html', info = "A message has been sent to your email, please follow the instructions provided there.")
 
@@ -191,18 +196,19 @@ class SettingsPage(generic.GenericPage):
               "plusone_p": True}
         have_error = False
         if kw["usern"]: kw["usern"] = kw["usern"].lower()
-        if user.username != kw["usern"]:
-            u2 = self.get_user_by_username(kw["usern"], "Checking if new username is available. ")
-            if u2 or (not re.match(USERNAME_RE, kw["usern"])):
-                kw["uname_error_p"] = True
-                kw['error'] = "Sorry, that username is not available. "
-                have_error = True
-        if user.email != kw["email"]:
-            u2 = self.get_user_by_email(kw["email"], "Checking if new email is available. ")
-            if u2:
-                kw["email_error_p"] = True
-                kw["error"] += "That email is already in use by someone. "
-                have_error = True
+        new_username = kw["usern"] if user.username != kw["usern"] else None
+        new_email = kw["email"] if user.email != kw["email"] else None
+        if new_username or new_email:
+            self.log_read(generic.UniqueUsernames, "Checking if the new username and email are available. ")
+            u2, u3 = generic.get_unique_owners(new_username, new_email)
+        if new_username and ((u2 and u2 != user.key) or (not re.match(USERNAME_RE, kw["usern"]))):
+            kw["uname_error_p"] = True
+            kw['error'] = "Sorry, that username is not available. "
+            have_error = True
+        if new_email and u3 and u3 != user.key:
+            kw["email_error_p"] = True
+            kw["error"] += "That email is already in use by someone. "
+            have_error = True
         if not re.match(EMAIL_RE, kw["email"]):
                 kw["email_error_p"] = True
                 kw["error"] += "That doesn't seem like a valid email. "
@@ -211,9 +217,8 @@ class SettingsPage(generic.GenericPage):
             kw["passwd_error_p"] = True
             kw["error"] = "The new password doesn't match. Please type it again"
             have_error = True
-        if have_error:
-            self.render("settings.html", **kw)
-        else:
+        if not have_error:
+            old_username, old_email = user.username, user.email
             user.username = kw["usern"] 
             user.email = kw["email"]
             user.about_me = kw["about_me"]
@@ -221,10 +226,17 @@ class SettingsPage(generic.GenericPage):
                 salt = generic.make_salt()
                 user.salt = salt
                 user.password_hash = generic.hash_str(kw["passwd"] + salt)
+            if generic.DEBUG: logging.debug("DB WRITE: Handler SettingsPage is writing an instance of RegisteredUsers. Updating settings.")
+            if not generic.put_user_p(user, old_username, old_email):
+                user.username, user.email = old_username, old_email
+                kw["error"] = "That username or email has just been taken, please choose another one. "
+                have_error = True
+        if have_error:
+            self.render("settings.html", **kw)
+        else:
             if user.gplusid: user.set_gplus_profile()
-            self.log_and_put(user, "Updating settings.")
             user.set_profile_image_url("google" if user.gplus_profile_json else "gravatar")
-            self.set_cookie("username", user.username, user.salt, max_age = LOGIN_COOKIE_MAXAGE)
+            self.set_login_cookie(user)
             self.redirect("/settings?info=Changes saved")
 
 
@@ -306,14 +318,16 @@ class VerifyEmailPage(generic.GenericPage):
         username = self.request.get("username")
         email = self.request.get("email").strip()
         if email:
-            u = generic.UnverifiedUsers.query(generic.UnverifiedUsers.email == email).get()
+            u = generic.get_unique_owners(email = email)[1]
+            u = u.get() if u and u.kind() == "UnverifiedUsers" else None
             if u:
                 email_messages.send_verify_email(u)
                 self.redirect("signup?info=A message has been sent to your email, please follow the instructions provided there.")
                 return
         h = self.request.get("h")
         self.log_read(generic.UnverifiedUsers)
-        u = generic.UnverifiedUsers.query(generic.UnverifiedUsers.username == username).get()
+        u = generic.get_unique_owners(username = username)[0] if username else None
+        u = u.get() if u and u.kind() == "UnverifiedUsers" else None
         if not u:
             logging.warning("Handler VerifyEmailPage attempted to verify an email not in Datastore.")
             self.error(404)
@@ -324,11 +338,12 @@ class VerifyEmailPage(generic.GenericPage):
                                                salt = u.salt,
                                                email = u.email,
                                                about_me = '',
-                                               my_projects = [],
                                                profile_image_url = "https://secure.gravatar.com/avatar/" + hashlib.md5(u.email.strip().lower()).hexdigest())
-            self.log_and_put(new_user)
-            self.log_and_delete(u)
-            self.set_cookie("username", new_user.username, new_user.salt, max_age = LOGIN_COOKIE_MAXAGE)
+            if generic.DEBUG: logging.debug("DB WRITE: Handler VerifyEmailPage is replacing an UnverifiedUsers with a RegisteredUsers. ")
+            if not generic.put_user_p(new_user, replaces = u.key):
+                self.render("signup.html", error = "That username or email is not available anymore, please sign up again. ")
+                return
+            self.set_login_cookie(new_user)
             self.render("email_verified.html")
         else:
             logging.warning("Handler VerifyEmailPage attempted to verify an email with the wrong hash.")
@@ -353,13 +368,20 @@ class AuthHandler(generic.GenericPage, simpleauth.SimpleAuthHandler):
         new_user_p = False
         if not user:
             prefix = data['email'].split("@")[0]
-            test_user = self.get_user_by_username(prefix)
+            self.log_read(generic.UniqueUsernames, "Checking if username is available. ")
+            test_user, pending = generic.get_unique_owners(prefix, data['email'])
             username = ("g." + prefix) if test_user else prefix
             salt = generic.make_salt()
             user = generic.RegisteredUsers(username = username,
                                            password_hash = generic.hash_str(generic.make_salt() + salt),
                                            salt = salt,
                                            email = data['email'])
+            if data['picture']: user.profile_image_url = data['picture']
+            if generic.DEBUG: logging.debug("DB WRITE: Handler AuthHandler is writing an instance of RegisteredUsers. ")
+            # An unfinished signup with the same email is superseded, the email was just verified by the provider
+            if not generic.put_user_p(user, replaces = pending if pending and pending.kind() == "UnverifiedUsers" else None):
+                self.redirect("/login?r_error_message=Sorry, we couldn't find a username for you, please sign up instead. ")
+                return
             if data['id']: 
                 user.gplusid = data['id']
                 user.set_gplus_profile()
@@ -367,8 +389,7 @@ class AuthHandler(generic.GenericPage, simpleauth.SimpleAuthHandler):
                     user.about_me = user.gplus_profile_json['aboutMe']
                 except:
                     pass
-            if data['picture']: user.profile_image_url = data['picture']
-            self.log_and_put(user)
+                self.log_and_put(user)
             new_user_p = True
         if (not new_user_p) and data['id']:
             try:
@@ -377,12 +398,12 @@ class AuthHandler(generic.GenericPage, simpleauth.SimpleAuthHandler):
                 user.set_profile_image_url(provider = "google")
             except:
                 logging.error("There was a problem fetching a gplus profile and/or profile image url for an existing user. ")
-        self.set_cookie("username", user.username, user.salt, max_age = LOGIN_COOKIE_MAXAGE)
+        self.set_login_cookie(user)
         self.redirect("/settings" if new_user_p else "/")
 
         
     def logout(self):
-        self.remove_cookie("username")
+        self.remove_login_cookie()
         self.auth.unset_session()
         self.redirect('/')
 
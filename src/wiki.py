@@ -5,37 +5,48 @@ from google.appengine.ext import ndb
 import re
 import generic, projects, groups
 
+REVISIONS_PER_PAGE = 20
+COMMENTS_PER_PAGE = 20
+
 ###########################
 ##   Datastore Objects   ##
 ###########################
 
 # Each WikiPage should have a Project as parent.
-class WikiPages(ndb.Model):
+class WikiPages(generic.RenderedMarkdown, ndb.Model):
+    md_blocks_p = True
     url = ndb.StringProperty(required = True)
-    content = ndb.TextProperty(required = True)      # Should be equal to the lastest WikiRevision's content
+    content = ndb.TextProperty(required = True, compressed = True)      # Should be equal to the lastest WikiRevision's content
 
     def is_open_p(self):
-        return self.key.parent().get().wiki_open_p
+        return generic.item_open_p(self.key)
+
+    def md_wiki_p_id(self):
+        return self.key.parent().integer_id()
 
 # Each WikiRevision should have a WikiPage as parent.
-class WikiRevisions(ndb.Model):
+class WikiRevisions(generic.Revision, ndb.Model):
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
-    content = ndb.TextProperty(required = True)
+    content = ndb.TextProperty(required = False, compressed = True)     # None when stored as a delta, see generic.Revision
     summary = ndb.StringProperty(required = False)
 
     def is_open_p(self):
-        return self.key.parent().get().is_open_p()
+        return generic.item_open_p(self.key)
+
+    def md_wiki_p_id(self):
+        return self.key.parent().parent().integer_id()
 
 
 # Each comment should be a parent of a WikiPage
-class WikiComments(ndb.Model):
+class WikiComments(generic.RenderedMarkdown, ndb.Model):
+    md_source = "comment"
     author = ndb.KeyProperty(kind = generic.RegisteredUsers, required = True)
     date = ndb.DateTimeProperty(auto_now_add = True)
     comment = ndb.TextProperty(required = True)
 
     def is_open_p(self):
-        return self.key.parent().get().is_open_p()
+        return generic.item_open_p(self.key)
 
 
 ######################
@@ -52,20 +63,20 @@ class GenericWikiPage(projects.ProjectPage):
         return WikiPages.query(WikiPages.url == url, ancestor = project.key).get()
 
     def get_revisions(self, wikipage, log_message = ''):
-        revisions = []
-        if not wikipage: return []
-        for rev in WikiRevisions.query(ancestor = wikipage.key).order(-WikiRevisions.date).iter():
-            self.log_read(WikiRevisions, log_message)
-            revisions.append(rev)
-        return revisions
+        if not wikipage: return [], None
+        return generic.get_revisions_page(self, wikipage, WikiRevisions, REVISIONS_PER_PAGE, log_message)
 
     def get_revision(self, wikipage, revid, log_message = ''):
         self.log_read(WikiRevisions, log_message)
         return WikiRevisions.get_by_id(int(revid), parent = wikipage.key)
 
+    def get_last_revision(self, wikipage, log_message = ''):
+        self.log_read(WikiRevisions, log_message)
+        return WikiRevisions.query(ancestor = wikipage.key).order(-WikiRevisions.date).get()
+
     def get_comments_list(self, wikipage):
-        self.log_read(WikiComments, "Fetching all the comments in the Talk page for a wiki page. ")
-        return WikiComments.query(ancestor = wikipage.key).order(-WikiComments.date).fetch()
+        return self.fetch_page(WikiComments.query(ancestor = wikipage.key).order(-WikiComments.date), COMMENTS_PER_PAGE,
+                               "Comments in the Talk page for a wiki page. ")
 
 
 class RedirectMainPage(GenericWikiPage):
@@ -109,6 +120,7 @@ class ViewWikiPage(GenericWikiPage):
             return
         project.wiki_open_p = not project.wiki_open_p 
         self.log_and_put(project)
+        projects.update_visibility(project.key, project.wiki_open_p)
         self.redirect("/%s/wiki/page/Main_Page" % projectid)
 
 
@@ -157,13 +169,13 @@ class EditWikiPage(GenericWikiPage):
         if not have_error:
             if not wikipage:
                 wikipage = WikiPages(url = wikiurl, content = content, parent = project.key)
-                self.log_and_put(wikipage, "New instance. ")
+                generic.allocate_key(wikipage)
             else:
                 wikipage.content = content
-                self.log_and_put(wikipage, "Changing content." )
             new_revision = WikiRevisions(author = user.key, content = content, summary = summary,
                                          parent = wikipage.key)
-            self.put_and_report(new_revision, user, project)
+            # The page, the revision and the previous one stored as a delta, in a single transaction
+            self.put_and_report(new_revision, user, project, wikipage, new_revision.writes_with)
             self.redirect("/%s/wiki/page/%s" % (projectid, wikiurl))
         else:
             self.render("wiki_edit.html", project = project, wikipage = wikipage, wikiurl = wikiurl,
@@ -182,10 +194,10 @@ class HistoryWikiPage(GenericWikiPage):
             self.render("project_page_not_visible.html", project = project, user = user)
             return
         wikipage = self.get_wikipage(project, wikiurl)
-        revisions = self.get_revisions(wikipage)
+        revisions, pager = self.get_revisions(wikipage)
         self.render("wiki_history.html", project = project, hist_p = True,
                     visitor_p = not (user and project.user_is_author(user)),
-                    wikiurl = wikiurl, wikipage = wikipage, revisions = revisions)
+                    wikiurl = wikiurl, wikipage = wikipage, revisions = revisions, pager = pager)
 
 
 class RevisionWikiPage(GenericWikiPage):
@@ -209,7 +221,7 @@ class RevisionWikiPage(GenericWikiPage):
             self.error(404)
             self.render("404.html", info = "Revision %s not found" % revid)
             return
-        wikitext = revision.content if revision else ''
+        wikitext = revision.get_content() if revision else ''
         self.render("wiki_revision.html", project = project, hist_p = True,
                     visitor_p = not (user and project.user_is_author(user)),
                     wikiurl = wikiurl, revision = revision, wikitext = wikitext)
@@ -230,9 +242,9 @@ class TalkWikiPage(GenericWikiPage):
             self.error(404)
             self.render("wiki_view.html", wikipage = False, project = project, wikiurl = wikiurl, talk_p = True)
             return
-        comments = self.get_comments_list(wikipage)
+        comments, pager = self.get_comments_list(wikipage)
         self.render("wiki_talk.html", project = project, error_message = self.request.get("error"),
-                    wikiurl = wikiurl, comments = comments, talk_p = True)
+                    wikiurl = wikiurl, comments = comments, pager = pager, talk_p = True)
 
     def post(self, projectid, wikiurl):
         user = self.get_login_user()
@@ -0,0 +1,40 @@
+# bench_markdown_engine.py
+# Per-call overhead of filters.render_md reusing a Markdown instance per thread, against building
+# a new one per call as before. Run it from this directory: python bench_markdown_engine.py [rounds]
+
+import copy, sys, timeit
+import gae_env
+import markdown_corpus
+
+def renders_p(doc):
+    # A few fragments in the corpus make the doi links fail, see test_sanitizer.py
+    import filters
+    try:
+        filters.render_md(doc)
+        return True
+    except Exception:
+        return False
+
+def main(rounds):
+    testbed = gae_env.activate()
+    import bleach, markdown, filters
+    docs = [d for d in markdown_corpus.documents(20, seed = 3) if renders_p(d)]
+    attrs = copy.deepcopy(filters.ALLOWED_ATTRS)
+    def before(doc):
+        # As render_md was: lists bleach grows in place on every call, see filters.SANITIZER_ATTRS
+        html = markdown.markdown(filters.DOI_RE.sub(filters.make_doi_link, doc), extensions = filters.MD_EXTENSIONS)
+        return bleach.clean(html, tags = filters.ALLOWED_TAGS, attributes = attrs)
+    def new_markdown():
+        return markdown.Markdown(extensions = filters.MD_EXTENSIONS + [filters.SanitizeExtension()])
+    def after(doc):
+        return filters.render_md(doc)
+    for name, render in [("before", before), ("after", after),
+                         ("new Markdown per call, convert only", lambda d: new_markdown().convert(d)),
+                         ("reused Markdown, convert only", lambda d: filters.get_markdown().convert(d))]:
+        seconds = timeit.timeit(lambda: [render(d) for d in docs], number = rounds)
+        print "%-36s %6.2f ms per document" % (name, 1000 * seconds / (rounds * len(docs)))
+    testbed.deactivate()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,27 @@
+# gae_env.py
+# Puts the app and the App Engine SDK on sys.path, for the tests and scripts in this directory.
+# Set GAE_SDK to the SDK's directory (the one with dev_appserver.py) if it isn't on the path already.
+
+import os, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if os.environ.get("GAE_SDK"):
+    sys.path.insert(0, os.environ["GAE_SDK"])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+sys.path[:0] = [os.path.join(ROOT, "lib"), os.path.join(ROOT, "src"), ROOT]
+
+from google.appengine.ext import testbed
+
+def activate(datastore_p = False):
+    """Stubs the services filters.py uses and, if datastore_p, the datastore with queries as consistent
+    as ancestor queries. Returns the testbed, deactivate it when done."""
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_memcache_stub()
+    if datastore_p:
+        from google.appengine.datastore import datastore_stub_util
+        tb.init_datastore_v3_stub(consistency_policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability = 1))
+        tb.init_taskqueue_stub()
+    return tb
@@ -0,0 +1,33 @@
+# markdown_corpus.py
+# Markdown documents shared by the renderer tests and benchmarks, built from the fragments in
+# fixtures/markdown_corpus.json. The same seed always gives the same documents.
+
+import io, json, os, random
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "markdown_corpus.json")
+
+def fragments():
+    "Each fragment on its own, with %d replaced by its position."
+    with io.open(FIXTURE, encoding = "utf-8") as f:
+        return [frag.replace("%d", str(i)) for i, frag in enumerate(json.load(f)["fragments"])]
+
+def documents(n, seed = 5, most = 12):
+    "The fragments on their own, then n documents joining 1 to most of them at random."
+    frags = fragments()
+    rand = random.Random(seed)
+    return frags + [u"\n\n".join(rand.sample(frags, rand.randint(1, most))) for i in range(n)]
+
+def reference_render(value, wiki_p_id = ""):
+    """What filters.render_md did before sanitizing in the Markdown pipeline: a new Markdown instance
+    per document and bleach.clean on its output with ALLOWED_TAGS and ALLOWED_ATTRS."""
+    import bleach, copy, markdown, filters
+    value = filters.DOI_RE.sub(filters.make_doi_link, value)
+    if wiki_p_id: value = filters.WIKILINKS_RE_COMPILED.sub(filters.make_sub_repl(wiki_p_id), value)
+    html = markdown.markdown(value, extensions = filters.MD_EXTENSIONS)
+    # A copy, bleach appends the '*' attributes to the lists it's given
+    return bleach.clean(html, tags = filters.ALLOWED_TAGS, attributes = copy.deepcopy(filters.ALLOWED_ATTRS))
+
+def normalized(html):
+    "html as html5lib parses and bleach serializes it, so equivalent markup compares equal."
+    import bleach, html5lib
+    return bleach._render(html5lib.HTMLParser().parseFragment(html)).strip()
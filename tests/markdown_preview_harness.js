@@ -0,0 +1,10 @@
+// markdown_preview_harness.js -- Runs js/markdown_preview.js under node for test_markdown_preview.py
+//
+// Reads {"policy" : filters.sanitizer_policy(), "docs" : [{"src" : ..., "w" : wiki_p_id}, ...]} from
+// stdin and writes the list of what MarkdownPreview.render returned for each document to stdout.
+
+var fs = require("fs"), path = require("path"), vm = require("vm");
+vm.runInThisContext(fs.readFileSync(path.join(__dirname, "..", "js", "markdown_preview.js"), "utf8"));
+var cases = JSON.parse(fs.readFileSync(0, "utf8"));
+MarkdownPreview.setPolicy(cases.policy);
+process.stdout.write(JSON.stringify(cases.docs.map(function (c) { return MarkdownPreview.render(c.src, c.w); })));
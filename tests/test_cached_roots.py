@@ -0,0 +1,42 @@
+# test_cached_roots.py
+# generic.CachedRoot: Projects.get_cached serves a memcached copy until the project is written.
+
+import unittest
+import gae_env
+from google.appengine.ext import ndb
+
+class CachedRootTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = gae_env.activate(datastore_p = True)
+        import projects
+        self.project = projects.Projects(name = "Before")
+        self.project.put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def cached_name(self):
+        import projects
+        return projects.Projects.get_cached(self.project.key.id()).name
+
+    def test_written(self):
+        self.assertEqual(self.cached_name(), "Before")
+        self.project.name = "After"
+        self.project.put()
+        self.assertEqual(self.cached_name(), "After")
+
+    def test_written_in_a_transaction(self):
+        self.assertEqual(self.cached_name(), "Before")
+        seen = []
+        def txn():
+            self.project.name = "After"
+            self.project.put()
+            # Read by another request before the commit, it caches what is committed
+            seen.append(self.cached_name())
+        ndb.transaction(txn)
+        self.assertEqual(seen, ["Before"])
+        self.assertEqual(self.cached_name(), "After")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+# test_markdown_preview.py
+# The previews rendered on the browser by js/markdown_preview.js must be the html filters.render_md
+# gives. Renders the documents in markdown_corpus with both, the browser's under node (see
+# markdown_preview_harness.js), and compares them. Skipped if node isn't installed.
+
+import json, os, re, subprocess, unittest
+import gae_env
+import markdown_corpus
+
+DOCUMENTS = 2000
+HARNESS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "markdown_preview_harness.js")
+CODEHILITE_RE = re.compile(r'<div class="codehilite"><pre>.*?</pre></div>', re.DOTALL)
+SPAN_RE = re.compile(r'</?span[^>]*>')
+
+def node_p():
+    try:
+        subprocess.check_output(["node", "--version"])
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+def without_highlighting(html):
+    "The browser has no pygments, so its code blocks don't have the token spans."
+    return CODEHILITE_RE.sub(lambda m: SPAN_RE.sub('', m.group(0)), html)
+
+@unittest.skipUnless(node_p(), "node is not installed")
+class MarkdownPreviewTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = gae_env.activate()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def server_render(self, doc, wiki_p_id):
+        "The html and whether it went through bleach.clean, or None if render_md fails."
+        import filters
+        try:
+            html = filters.render_md(doc, wiki_p_id)
+        except Exception:
+            return None, None
+        engine = filters._md_local.engine
+        sanitizer = [e for e in engine.registeredExtensions if isinstance(e, filters.SanitizeExtension)][0]
+        bleached_p = sanitizer.needs_bleach_p or any(not safe and not filters.ENTITY_ONLY_RE.match(h)
+                                                     for h, safe in engine.htmlStash.rawHtmlBlocks)
+        return html, bleached_p
+
+    def test_same_as_server(self):
+        import filters
+        cases = [{"src" : doc, "w" : w} for doc in markdown_corpus.documents(DOCUMENTS) for w in ("", "7")]
+        node = subprocess.Popen(["node", HARNESS], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+        out, err = node.communicate(json.dumps({"policy" : filters.sanitizer_policy(), "docs" : cases}))
+        self.assertEqual(node.returncode, 0)
+        previews = json.loads(out)
+        self.assertEqual(len(previews), len(cases))
+        mismatches, rendered = [], 0
+        for c, preview in zip(cases, previews):
+            html, bleached_p = self.server_render(c["src"], c["w"])
+            # None means the preview is left to the server
+            if preview is None or html is None: continue
+            rendered += 1
+            html = without_highlighting(html)
+            if html == preview: continue
+            # bleach reserializes the whole document, only equivalent html can be expected then
+            if bleached_p and markdown_corpus.normalized(html) == markdown_corpus.normalized(preview): continue
+            mismatches.append((c["src"], c["w"], html, preview))
+        self.assertEqual(mismatches, [], "%s mismatches, the first: %r" % (len(mismatches), mismatches[:1]))
+        # Joined documents often have a fragment the preview leaves to the server, but not most
+        self.assertGreater(rendered, len(cases) / 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+# test_md_blocks.py
+# filters.md_blocks renders long wiki pages and writings block by block, and should give the same
+# html as filters.md rendering them whole. Checked on the documents in markdown_corpus, with every
+# document rendered by blocks however short it is.
+
+import re, unittest
+import gae_env
+import markdown_corpus
+
+DOCUMENTS = 1000
+BETWEEN_TAGS_RE = re.compile(r'>\s+<')
+WHITESPACE_RE = re.compile(r'\s+')
+
+def normalized(html):
+    "Blocks are joined with a single new line, Markdown leaves blank lines between some."
+    return WHITESPACE_RE.sub(' ', BETWEEN_TAGS_RE.sub('><', markdown_corpus.normalized(html)))
+
+class MdBlocksTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = gae_env.activate()
+        import filters
+        self.min_size, filters.MD_BLOCKS_MIN_SIZE = filters.MD_BLOCKS_MIN_SIZE, 0
+
+    def tearDown(self):
+        import filters
+        filters.MD_BLOCKS_MIN_SIZE = self.min_size
+        self.testbed.deactivate()
+
+    def rendered(self, render, doc, wiki_p_id):
+        # md and md_blocks cache the whole document under the same key
+        import filters
+        from google.appengine.api import memcache
+        filters._md_cache.clear()
+        memcache.flush_all()
+        try:
+            return normalized(render(doc, wiki_p_id))
+        except Exception, e:
+            return e.__class__.__name__
+
+    def test_same_as_md(self):
+        import filters
+        mismatches, split = [], 0
+        for doc in markdown_corpus.documents(DOCUMENTS):
+            for wiki_p_id in ("", "7"):
+                expected = self.rendered(filters.md, doc, wiki_p_id)
+                got = self.rendered(filters.md_blocks, doc, wiki_p_id)
+                if got != expected: mismatches.append((doc, wiki_p_id, expected, got))
+            try:
+                blocks = filters.split_md_blocks(doc)
+            except Exception:
+                continue
+            if blocks and len(blocks[0]) > 1: split += 1
+        self.assertEqual(mismatches, [], "%s mismatches, the first: %r" % (len(mismatches), mismatches[:1]))
+        # Not a test of md against itself: most of the documents are rendered by blocks
+        self.assertGreater(split, DOCUMENTS / 2)
+
+    def test_whole_render_when_split_changes_it(self):
+        import filters
+        # Markdown joins adjacent definition lists, and an unclosed tag takes in the blocks after it
+        for doc in [u"Term\n: definition\n\nTerm 2\n: another", u"Some <b>bold\n\nstill bold</b>",
+                    u"* item\n\n    return '<a>' & 1\n\nafter"]:
+            self.assertIsNone(filters.split_md_blocks(doc))
+        self.assertIsNotNone(filters.split_md_blocks(u"Term\n: definition\n\nA paragraph\n\nTerm 2\n: another"))
+        self.assertIsNotNone(filters.split_md_blocks(u"Tags in `<code>`\n\n```\n<div>\n```\n\nand <b>closed</b>"))
+
+    def test_local_only(self):
+        "Previews (generic.RenderPreview) stay out of memcache."
+        import filters
+        from google.appengine.api import memcache
+        doc = u"# Title\n\nA paragraph.\n\nAnother one[^1].\n\n[^1]: A footnote."
+        filters._md_cache.clear()
+        memcache.flush_all()
+        html = filters.md_blocks(doc, "", local_only = True)
+        self.assertEqual(memcache.get_stats()["items"], 0)
+        self.assertEqual(filters.md_blocks(doc, "", local_only = True), html)
+        self.assertEqual(normalized(html), self.rendered(filters.md, doc, ""))
+
+
+if __name__ == "__main__":
+    unittest.main()
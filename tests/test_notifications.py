@@ -0,0 +1,85 @@
+# test_notifications.py
+# projects.notify_subscribers, the task that writes the EmailNotifications about a new item, and
+# email_messages.SendNotifications, which sends them.
+
+import unittest
+import gae_env
+from google.appengine.ext import ndb
+
+class NotificationsTestCase(unittest.TestCase):
+    "A project with three authors, all subscribed to its notebooks but the last, and a note by the first."
+    def setUp(self):
+        self.testbed = gae_env.activate(datastore_p = True)
+        import generic, projects, notebooks
+        self.users = []
+        for name in ["author", "subscriber", "unsubscribed"]:
+            user = generic.RegisteredUsers(username = name, password_hash = "x", salt = "x", email = "%s@example.com" % name,
+                                           profile_image_url = "/static/avatar.png")
+            user.put()
+            self.users.append(user)
+        self.project = projects.Projects(name = "Project")
+        self.project.put()
+        for user in self.users:
+            generic.join(user, self.project, "author")
+            subscription = projects.subscribe_to_all(self.project, user)
+            if user.username == "unsubscribed": subscription.set_subscribed("notebooks", False)
+            subscription.put()
+        # As the task reads it, the instance above looked up its authors when it was written
+        ndb.get_context().clear_cache()
+        self.project = self.project.key.get()
+        notebook = notebooks.Notebooks(owner = self.users[0].key, name = "Notebook", description = "", parent = self.project.key)
+        notebook.put()
+        self.note = notebooks.NotebookNotes(title = "Note", content = "Some *content*", author = self.users[0].key, parent = notebook.key)
+        self.note.put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+
+class NotifySubscribersTest(NotificationsTestCase):
+    def test_subscribers_but_the_author(self):
+        import projects
+        notifications = projects.notify_subscribers(self.note, self.users[0], self.project)
+        self.assertEqual([n.key.parent() for n in notifications], [self.users[1].key])
+        n = notifications[0]
+        self.assertEqual((n.category, n.sent, n.author), ("NotebookNotes", False, self.users[0].key))
+        self.assertIn("/%s/notebooks/" % self.project.key.integer_id(), n.html)
+        self.assertIn("<em>content</em>", n.html)
+
+    def test_once_per_item(self):
+        import generic, projects
+        first = projects.notify_subscribers(self.note, self.users[0], self.project)
+        first[0].sent = True
+        first[0].put()
+        # A retried task leaves the ones already written, sent or not, as they are
+        self.assertEqual(projects.notify_subscribers(self.note, self.users[0], self.project), [])
+        self.assertEqual(generic.EmailNotifications.query().count(), 1)
+        self.assertTrue(first[0].key.get().sent)
+
+    def test_queued_by_the_first_report(self):
+        import generic, projects
+        generic.LOCAL_TASK_QUEUE = []
+        try:
+            projects.report_item(self.note, self.users[0], self.project)
+            projects.report_item(self.note, self.users[0], self.project)
+            self.assertEqual([url for url, params in generic.LOCAL_TASK_QUEUE], [projects.NOTIFY_SUBSCRIBERS_URL])
+        finally:
+            generic.LOCAL_TASK_QUEUE = None
+
+
+class SendNotificationsTest(NotificationsTestCase):
+    def test_one_email_per_user(self):
+        import webapp2, generic, projects, email_messages
+        self.testbed.init_mail_stub()
+        projects.notify_subscribers(self.note, self.users[0], self.project)
+        email_messages.SendNotifications(webapp2.Request.blank("/cron/send_email_notifications"), webapp2.Response()).get()
+        sent = self.testbed.get_stub("mail").get_sent_messages()
+        self.assertEqual([m.to for m in sent], ["subscriber@example.com"])
+        self.assertTrue(all(n.sent for n in generic.EmailNotifications.query()))
+        # Nothing new to send the next day
+        email_messages.SendNotifications(webapp2.Request.blank("/cron/send_email_notifications"), webapp2.Response()).get()
+        self.assertEqual(len(self.testbed.get_stub("mail").get_sent_messages()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
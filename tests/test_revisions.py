@@ -0,0 +1,112 @@
+# test_revisions.py
+# Wiki edits as EditWikiPage.post writes them: the page, the new revision with its metadata and the
+# previous revision stored as a reverse delta, in one transaction (see generic.Revision.writes_with).
+
+import unittest
+import gae_env
+
+EDITS = 25
+
+class RevisionsTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = gae_env.activate(datastore_p = True)
+        import generic, projects, wiki
+        generic.LOCAL_TASK_QUEUE = []
+        self.user = generic.RegisteredUsers(username = "author", password_hash = "x", salt = "x")
+        self.user.put()
+        self.project = projects.Projects(name = "Project")
+        self.project.put()
+        self.page = wiki.WikiPages(url = "Main_Page", content = "", parent = self.project.key)
+        generic.allocate_key(self.page)
+
+    def tearDown(self):
+        import generic
+        generic.LOCAL_TASK_QUEUE = None
+        self.testbed.deactivate()
+
+    def edit(self, content):
+        import projects, wiki
+        self.page.content = content
+        revision = wiki.WikiRevisions(author = self.user.key, content = content, summary = "", parent = self.page.key)
+        projects.put_and_report(revision, self.user, self.project, [self.page], more_writes = revision.writes_with)
+        return revision.key
+
+    def contents(self, n):
+        return ["# Version %s\n\n" % i + "".join("Paragraph %s, %s.\n\n" % (j, "edited" if j == i else "") for j in range(30))
+                for i in range(n)]
+
+    def test_chain(self):
+        import generic, wiki
+        contents = self.contents(EDITS)
+        keys = [self.edit(c) for c in contents]
+        revisions = [k.get() for k in keys]
+        self.assertEqual([r.get_content() for r in revisions], contents)
+        self.assertEqual(self.page.key.get().content, contents[-1])
+        self.check_chain(revisions, keys)
+        # Rendered from the rebuilt content, not stored
+        import filters
+        self.assertEqual(revisions[0].content_html(), filters.md(contents[0], self.project.key.integer_id()))
+        self.assertNotIn("rendered_html", revisions[0]._values)
+        # Written with their metadata, not after
+        metadata = generic.RevisionMetadata.query(ancestor = self.page.key).order(generic.RevisionMetadata.date).fetch()
+        self.assertEqual([m.key.id() for m in metadata], [k.id() for k in keys])
+        self.assertTrue(all(m.date == r.date for m, r in zip(metadata, revisions)))
+
+    def check_chain(self, revisions, keys):
+        "The newest is whole and no revision is more than REVISION_SNAPSHOT_INTERVAL - 1 deltas away from a whole one."
+        import generic
+        self.assertFalse(revisions[-1].delta_p())
+        behind = 0
+        for i in reversed(range(len(revisions) - 1)):
+            if revisions[i].delta_p():
+                self.assertEqual(revisions[i].base, keys[i + 1])
+                behind += 1
+                self.assertLess(behind, generic.REVISION_SNAPSHOT_INTERVAL)
+            else:
+                behind = 0
+
+    def test_compact(self):
+        import maintenance, wiki
+        contents = self.contents(EDITS)
+        keys = [self.edit(c) for c in contents]
+        job = maintenance.CompactRevisions()
+        job.stats = {}
+        job.process_batch(wiki.WikiPages, [self.page])
+        revisions = [k.get() for k in keys]
+        self.assertEqual([r.get_content() for r in revisions], contents)
+        self.check_chain(revisions, keys)
+        self.assertEqual(job.stats["revisions"], EDITS)
+        # Compacting again leaves it alone, and the next edit follows on from it
+        stored = [k.get().to_dict() for k in keys]
+        job.process_batch(wiki.WikiPages, [self.page])
+        self.assertEqual([k.get().to_dict() for k in keys], stored)
+        contents.append("The end. ")
+        keys.append(self.edit(contents[-1]))
+        revisions = [k.get() for k in keys]
+        self.assertEqual([r.get_content() for r in revisions], contents)
+        self.check_chain(revisions, keys)
+
+    def test_compact_drops_rendered_html(self):
+        "Revisions used to store their html, see generic.Revision.drop_rendered_html."
+        import maintenance, wiki
+        from google.appengine.api import datastore, datastore_types
+        from google.appengine.ext import ndb
+        contents = self.contents(3)
+        keys = [self.edit(c) for c in contents]
+        for k in keys:
+            entity = datastore.Get(k.to_old_key())
+            entity["rendered_html"] = datastore_types.Text(u"<p>Stored</p>" * 100)
+            entity["rendered_version"] = "1"
+            datastore.Put(entity)
+        ndb.get_context().clear_cache()
+        job = maintenance.CompactRevisions()
+        job.stats = {}
+        job.process_batch(wiki.WikiPages, [self.page])
+        self.assertGreater(job.stats["bytes_saved"], 0)
+        for k in keys:
+            self.assertNotIn("rendered_html", datastore.Get(k.to_old_key()))
+        ndb.get_context().clear_cache()
+        self.assertEqual([k.get().get_content() for k in keys], contents)
+
+if __name__ == "__main__":
+    unittest.main()